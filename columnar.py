@@ -0,0 +1,446 @@
+import os
+import json
+import tempfile
+from collections import defaultdict
+
+import numpy as np
+
+
+def direction_key(direction):
+    '''
+    direction_id as the INTEGER column of trips compares it, i.e. 1 and '1' are the same direction
+    '''
+    try:
+        return int(direction)
+    except (TypeError, ValueError):
+        return direction
+
+
+def sql_order(value):
+    '''
+    sort key ordering mixed values like SQLite does, NULL before numbers before text
+    '''
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, value)
+
+
+class StringTable:
+    '''
+    immutable list of strings stored as one UTF-8 buffer and an offsets array,
+    so it can be written to and memory-mapped from a snapshot like any other array
+
+    order is the permutation sorting the strings by their UTF-8 bytes, find() binary
+    searches it; tables that are never searched keep it empty
+    '''
+
+    def __init__(self, data, offsets, order):
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+
+    @classmethod
+    def from_list(cls, strings, searchable=False):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        if searchable:
+            order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int64)
+        else:
+            order = np.zeros(0, dtype=np.int64)
+        return cls(data, offsets, order)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+    def __getitem__(self, index):
+        return self.raw(index).decode('utf-8')
+
+    def find(self, string):
+        '''
+        returns the index of string, None if the table does not hold it
+        '''
+        key = str(string).encode('utf-8')
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.raw(self.order[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.order) and self.raw(self.order[low]) == key:
+            return int(self.order[low])
+        return None
+
+
+class ColumnarTimetable:
+    '''
+    in-memory copy of the timetable in the GTFS SQLite database, answering the
+    GTFS query methods with binary searches instead of SQL
+
+    stop_times are held as NumPy columns sorted by (stop, arrival_secs) with
+    stop, trip and route ids interned to integers, so the rows of a stop are the
+    slice stop_offsets[stop]:stop_offsets[stop + 1]. Ties keep the database row
+    order, which is the order the SQL path returns them in.
+
+    every attribute is a NumPy array or a StringTable, so the whole timetable can be
+    written as a snapshot and memory-mapped back without rebuilding anything
+    '''
+
+    # arrival_secs of stop_times rows without an arrival time, sorts before any real time
+    NO_TIME = -1
+
+    # snapshot file layout:
+    #   SNAPSHOT_MAGIC, uint32 SNAPSHOT_VERSION, uint32 header length,
+    #   JSON header {'fingerprint': feed fingerprint, 'arrays': {array: [dtype, shape, offset]}},
+    #   then the arrays, offsets count from the first SNAPSHOT_ALIGN boundary after the header
+    SNAPSHOT_MAGIC = b'GTFSNAP\0'
+    SNAPSHOT_VERSION = 2
+    SNAPSHOT_ALIGN = 64
+
+    STRING_TABLES = ['stop_ids', 'stop_names', 'trip_ids', 'trip_headsign', 'route_ids', 'st_arrival_time', 'group_keys']
+
+    ARRAYS = [
+        'stop_named',
+        'trip_route', 'trip_service', 'trip_direction_order',
+        'service_dates', 'service_mask',
+        'st_stop', 'st_trip', 'st_arrival', 'st_sequence',
+        'stop_offsets', 'trip_rows', 'trip_offsets',
+        'group_offsets', 'group_first_arrival', 'group_trips',
+    ]
+
+    def __init__(self, arrays):
+        '''
+        arrays: {name: array} for every name in ARRAYS, and name.data, name.offsets
+                and name.order for every name in STRING_TABLES
+        '''
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        for name in self.STRING_TABLES:
+            setattr(self, name, StringTable(arrays[f'{name}.data'], arrays[f'{name}.offsets'], arrays[f'{name}.order']))
+
+        self.no_service = np.zeros(self.service_mask.shape[1], dtype=bool)
+
+    def arrays(self):
+        '''
+        returns the {name: array} the timetable was built from
+        '''
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        for name in self.STRING_TABLES:
+            table = getattr(self, name)
+            arrays[f'{name}.data'] = table.data
+            arrays[f'{name}.offsets'] = table.offsets
+            arrays[f'{name}.order'] = table.order
+        return arrays
+
+    @classmethod
+    def from_sqlite(cls, conn):
+        '''
+        conn: connection to a database built by GTFS.gtfs_to_sql
+        '''
+        cursor = conn.cursor()
+        arrays = {}
+
+        def strings(name, values, searchable=False):
+            table = StringTable.from_list(values, searchable)
+            arrays[f'{name}.data'] = table.data
+            arrays[f'{name}.offsets'] = table.offsets
+            arrays[f'{name}.order'] = table.order
+
+        # Routes and trips
+        cursor.execute('SELECT trip_id, route_id, service_id, direction_id, trip_headsign FROM trips ORDER BY rowid')
+        trips = cursor.fetchall()
+
+        trip_ids = [trip[0] for trip in trips]
+        trip_index = {trip_id: index for index, trip_id in enumerate(trip_ids)}
+        route_ids = list(dict.fromkeys(trip[1] for trip in trips))
+        route_index = {route_id: index for index, route_id in enumerate(route_ids)}
+        service_ids = list(dict.fromkeys(trip[2] for trip in trips))
+        service_index = {service_id: index for index, service_id in enumerate(service_ids)}
+        trip_direction = [direction_key(trip[3]) for trip in trips]
+        direction_order = {direction: index for index, direction in enumerate(sorted(set(trip_direction), key=sql_order))}
+
+        strings('trip_ids', trip_ids)
+        strings('trip_headsign', [trip[4] for trip in trips])
+        strings('route_ids', route_ids, searchable=True)
+        arrays['trip_route'] = np.array([route_index[trip[1]] for trip in trips], dtype=np.int32)
+        arrays['trip_service'] = np.array([service_index[trip[2]] for trip in trips], dtype=np.int32)
+        # rank of the direction in SQLite order, ties in get_remaining_stops are broken on it
+        arrays['trip_direction_order'] = np.array([direction_order[direction] for direction in trip_direction], dtype=np.int32)
+
+        # Service days as a (date, service) mask, dates sorted as integers
+        cursor.execute('SELECT date, service_id FROM active_services')
+        active_services = defaultdict(list)
+        for date, service_id in cursor.fetchall():
+            if service_id in service_index and date.isdigit():
+                active_services[int(date)].append(service_index[service_id])
+        service_dates = sorted(active_services)
+        service_mask = np.zeros((len(service_dates), len(service_ids)), dtype=bool)
+        for date_index, date in enumerate(service_dates):
+            service_mask[date_index, active_services[date]] = True
+        arrays['service_dates'] = np.array(service_dates, dtype=np.int64)
+        arrays['service_mask'] = service_mask
+
+        # Stop times, rows of unknown trips are dropped like the SQL joins do
+        cursor.execute('''
+            SELECT st.stop_id, st.trip_id, st.arrival_secs, st.stop_sequence, st.arrival_time
+            FROM stop_times st
+            JOIN trips t ON st.trip_id = t.trip_id
+            ORDER BY st.rowid
+        ''')
+        rows = cursor.fetchall()
+
+        stop_ids = list(dict.fromkeys(row[0] for row in rows))
+        stop_index = {stop_id: index for index, stop_id in enumerate(stop_ids)}
+
+        # Stops, stop_times stops missing from stops.txt have no name
+        cursor.execute('SELECT stop_id, stop_name FROM stops')
+        stop_names = dict(cursor.fetchall())
+        strings('stop_ids', stop_ids, searchable=True)
+        strings('stop_names', [stop_names.get(stop_id) or '' for stop_id in stop_ids])
+        arrays['stop_named'] = np.array([stop_id in stop_names for stop_id in stop_ids], dtype=bool)
+
+        stop = np.array([stop_index[row[0]] for row in rows], dtype=np.int32)
+        trip = np.array([trip_index[row[1]] for row in rows], dtype=np.int32)
+        arrival = np.array([cls.NO_TIME if row[2] is None else row[2] for row in rows], dtype=np.int64)
+        sequence = np.array([row[3] for row in rows], dtype=np.int64)
+
+        # lexsort is stable, so equal keys keep the row order
+        order = np.lexsort((arrival, stop))
+        st_stop = arrays['st_stop'] = stop[order]
+        st_trip = arrays['st_trip'] = trip[order]
+        st_arrival = arrays['st_arrival'] = arrival[order]
+        st_sequence = arrays['st_sequence'] = sequence[order]
+        strings('st_arrival_time', [rows[index][4] for index in order])
+        arrays['stop_offsets'] = np.searchsorted(st_stop, np.arange(len(stop_ids) + 1))
+
+        # rows of each trip in stop_sequence order, as positions in the st_ columns
+        trip_rows = arrays['trip_rows'] = np.lexsort((order, st_sequence, st_trip))
+        arrays['trip_offsets'] = np.searchsorted(st_trip[trip_rows], np.arange(len(trip_ids) + 1))
+
+        # first arrival of each trip, the key get_all_trip_stops orders trips by
+        no_arrival = np.iinfo(np.int64).max
+        first_arrival = np.full(len(trip_ids), no_arrival)
+        timed = st_arrival != cls.NO_TIME
+        np.minimum.at(first_arrival, st_trip[timed], st_arrival[timed])
+
+        # trips of each (route_id, direction_id) group sorted by (first arrival, trip_id)
+        groups = defaultdict(list)
+        for index, trip_id in enumerate(trip_ids):
+            if first_arrival[index] != no_arrival:
+                key = cls.group_key(trips[index][1], trip_direction[index])
+                groups[key].append((int(first_arrival[index]), trip_id, index))
+        group_keys = list(groups)
+        for key in group_keys:
+            groups[key].sort()
+        strings('group_keys', group_keys, searchable=True)
+        arrays['group_offsets'] = np.cumsum([0] + [len(groups[key]) for key in group_keys], dtype=np.int64)
+        arrays['group_first_arrival'] = np.array([trip[0] for key in group_keys for trip in groups[key]], dtype=np.int64)
+        arrays['group_trips'] = np.array([trip[2] for key in group_keys for trip in groups[key]], dtype=np.int32)
+
+        return cls(arrays)
+
+    @classmethod
+    def data_start(cls, header_length):
+        '''
+        returns the file offset of the first array of a snapshot
+        '''
+        prefix = len(cls.SNAPSHOT_MAGIC) + 8 + header_length
+        return -(-prefix // cls.SNAPSHOT_ALIGN) * cls.SNAPSHOT_ALIGN
+
+    def write_snapshot(self, path, fingerprint=None):
+        '''
+        writes the timetable to a snapshot file, replacing path atomically
+
+        fingerprint: string identifying the feed the timetable was built from, see open_snapshot
+        '''
+        arrays = {name: np.ascontiguousarray(array) for name, array in self.arrays().items()}
+
+        header = {}
+        offset = 0
+        for name, array in arrays.items():
+            offset = -(-offset // self.SNAPSHOT_ALIGN) * self.SNAPSHOT_ALIGN
+            header[name] = [array.dtype.str, list(array.shape), offset]
+            offset += array.nbytes
+        encoded_header = json.dumps({'fingerprint': fingerprint, 'arrays': header}).encode('utf-8')
+        start = self.data_start(len(encoded_header))
+
+        # a temporary file of its own, processes building the same snapshot do not
+        # write into each other's file
+        descriptor, temp_path = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(self.SNAPSHOT_MAGIC)
+                file.write(np.array([self.SNAPSHOT_VERSION, len(encoded_header)], dtype='<u4').tobytes())
+                file.write(encoded_header)
+                for name, array in arrays.items():
+                    file.seek(start + header[name][2])
+                    file.write(array.tobytes())
+            # mkstemp creates the file readable by its owner only
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    @classmethod
+    def open_snapshot(cls, path, fingerprint=None):
+        '''
+        memory-maps a snapshot written by write_snapshot, pages are only read when a
+        query touches them, so opening does not depend on the feed size and processes
+        opening the same file share its pages
+
+        fingerprint: the snapshot must have been written with this fingerprint, when given
+
+        return: ColumnarTimetable, None if path is not a snapshot of this SNAPSHOT_VERSION
+                or of the feed with fingerprint
+        '''
+        with open(path, 'rb') as file:
+            magic = file.read(len(cls.SNAPSHOT_MAGIC))
+            version_header = file.read(8)
+            if magic != cls.SNAPSHOT_MAGIC or len(version_header) != 8:
+                return None
+            version, header_length = (int(value) for value in np.frombuffer(version_header, dtype='<u4'))
+            if version != cls.SNAPSHOT_VERSION:
+                return None
+            header = json.loads(file.read(header_length))
+        if fingerprint is not None and header['fingerprint'] != fingerprint:
+            return None
+
+        start = cls.data_start(header_length)
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+
+        arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            arrays[name] = buffer[start + offset:start + offset + size].view(dtype).reshape(shape)
+        return cls(arrays)
+
+    @staticmethod
+    def group_key(route_id, direction):
+        return f'{route_id}\0{direction_key(direction)}'
+
+    def active(self, query_date):
+        '''
+        returns the mask of the services running on query_date
+        '''
+        if not str(query_date).isdigit():
+            return self.no_service
+        date = int(query_date)
+        index = np.searchsorted(self.service_dates, date)
+        if index < len(self.service_dates) and self.service_dates[index] == date:
+            return self.service_mask[index]
+        return self.no_service
+
+    def stop_rows(self, stop_id, query_secs):
+        '''
+        returns the positions of the rows of stop_id arriving after query_secs, in arrival order
+        '''
+        stop = self.stop_ids.find(stop_id)
+        if stop is None:
+            return np.arange(0)
+        start, end = self.stop_offsets[stop], self.stop_offsets[stop + 1]
+        start += np.searchsorted(self.st_arrival[start:end], query_secs, side='right')
+        return np.arange(start, end)
+
+    def trip_stops(self, trip, min_sequence=None):
+        '''
+        returns [(stop_id, stop_sequence, stop_name, arrival_time)] of a trip in stop_sequence order
+        '''
+        rows = self.trip_rows[self.trip_offsets[trip]:self.trip_offsets[trip + 1]]
+
+        result = []
+        for row in rows:
+            sequence = int(self.st_sequence[row])
+            stop = self.st_stop[row]
+            # stops missing from stops.txt are dropped like the SQL join with stops does
+            if not self.stop_named[stop] or (min_sequence is not None and sequence < min_sequence):
+                continue
+            result.append((self.stop_ids[stop], sequence, self.stop_names[stop], self.st_arrival_time[row]))
+        return result
+
+    def get_incoming_buses(self, stop_id, query_date, query_secs, count=1):
+        '''
+        return: List[(arrival_time, route_id, trip_headsign, trip_id)]
+        '''
+        rows = self.stop_rows(stop_id, query_secs)
+        rows = rows[self.active(query_date)[self.trip_service[self.st_trip[rows]]]][:count]
+
+        incoming_buses = []
+        for row in rows:
+            trip = self.st_trip[row]
+            incoming_buses.append((
+                self.st_arrival_time[row],
+                self.route_ids[self.trip_route[trip]],
+                self.trip_headsign[trip],
+                self.trip_ids[trip],
+            ))
+        return incoming_buses
+
+    def get_departure_candidates(self, stop_id, query_date, from_secs, query_secs, count):
+        '''
+        return: List[(arrival_time, route_id, trip_headsign, trip_id, arrival_secs, stop_sequence)]
+                of every arrival after from_secs up to query_secs and the first count after it
+        '''
+        rows = self.stop_rows(stop_id, from_secs)
+        rows = rows[self.active(query_date)[self.trip_service[self.st_trip[rows]]]]
+        rows = rows[:np.searchsorted(self.st_arrival[rows], query_secs, side='right') + count]
+
+        candidates = []
+        for row in rows:
+            trip = self.st_trip[row]
+            candidates.append((
+                self.st_arrival_time[row],
+                self.route_ids[self.trip_route[trip]],
+                self.trip_headsign[trip],
+                self.trip_ids[trip],
+                int(self.st_arrival[row]),
+                int(self.st_sequence[row]),
+            ))
+        return candidates
+
+    def get_all_trip_stops(self, route, direction, query_date, query_secs, offset=0):
+        '''
+        return: List[(stop_id, stop_sequence, stop_name, arrival_time)] of the offset-th trip
+                of the route and direction starting after query_secs
+        '''
+        group = self.group_keys.find(self.group_key(route, direction))
+        if group is None:
+            return []
+        start, end = self.group_offsets[group], self.group_offsets[group + 1]
+        start += np.searchsorted(self.group_first_arrival[start:end], query_secs, side='right')
+        trips = self.group_trips[start:end]
+        trips = trips[self.active(query_date)[self.trip_service[trips]]]
+
+        if offset >= len(trips):
+            return []
+        return self.trip_stops(trips[offset])
+
+    def get_remaining_stops(self, route_id, stop_id, query_date, query_secs):
+        '''
+        return: List[(stop_id, stop_sequence, stop_name, arrival_time)] from stop_id to the end
+                of the next trip of the route at stop_id after query_secs
+        '''
+        rows = self.stop_rows(stop_id, query_secs)
+        trips = self.st_trip[rows]
+
+        route = self.route_ids.find(route_id)
+        route = -1 if route is None else route
+        rows = rows[(self.trip_route[trips] == route) & self.active(query_date)[self.trip_service[trips]]]
+        if len(rows) == 0:
+            return []
+
+        # among equal arrivals, the SQL path takes the trip that comes first in
+        # (direction_id, trip row) order
+        arrival = self.st_arrival[rows[0]]
+        tied = rows[self.st_arrival[rows] == arrival]
+        row = min(tied, key=lambda row: (self.trip_direction_order[self.st_trip[row]], self.st_trip[row]))
+
+        return self.trip_stops(self.st_trip[row], int(self.st_sequence[row]))
@@ -2,101 +2,353 @@ import os
 import time
 import math
 import sqlite3
-from datetime import datetime
+import hashlib
+import json
+from datetime import datetime, timedelta
+import urllib.error
 import urllib.request
 import zipfile
 import csv
+import io
+import itertools
+import threading
+import weakref
+import queue
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
 
+import numpy as np
 
-class GTFS:
-    STATIC_DIR = 'gtfs_static'
-    SQLITE_DIR = 'sqlite3_db'
+from columnar import ColumnarTimetable
+
+
+def time_to_seconds(time_str):
+    '''
+    converts a GTFS H:MM:SS time (hours may exceed 24) to seconds since midnight
     
-    def __init__(self, agency, city, url=None, update_db=True):
-        self.agency = agency
-        self.city = city
-        self.db_path = f'{self.SQLITE_DIR}/{self.agency}_{self.city}.db'
+    return: None for an empty time, e.g. a stop_times row that is not a timepoint
+    '''
+    if not time_str:
+        return None
+    hours, minutes, seconds = time_str.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def seconds_to_time(seconds):
+    '''
+    converts seconds since midnight to a GTFS HH:MM:SS time, hours may exceed 24
+    '''
+    seconds = int(seconds)
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def service_day_start(service_date):
+    '''
+    POSIX time GTFS times of a YYYYMMDD service date count from: noon minus 12 hours,
+    which is midnight except on the days daylight saving time changes
+    '''
+    noon = datetime.strptime(service_date, '%Y%m%d') + timedelta(hours=12)
+    return int(noon.timestamp()) - 12 * 3600
+
+
+def file_chunks(file, chunk_bytes):
+    '''
+    yields blocks of about chunk_bytes read from a binary file, every block ending at a line break
+    '''
+    while True:
+        block = file.read(chunk_bytes)
+        if not block:
+            return
+        yield block + file.readline()
+
+
+def parse_chunk(header, block, columns):
+    '''
+    parses a block of feed file lines into tuples of columns, run in the worker
+    processes of GTFS.load_data_parallel
+    
+    quoted fields spanning several lines are not supported, a line break always ends a row
+    '''
+    # (index of the source column, conversion or None) for every loaded column
+    getters = []
+    for col in columns:
+        source, convert = GTFS.DERIVED_COLUMNS.get(col, (col, None))
+        getters.append((header.index(source), convert))
+    width = len(header)
+    
+    rows = []
+    for row in csv.reader(io.StringIO(block.decode('utf-8'), newline='')):
+        if not row:
+            continue
+        # short rows are padded like csv.DictReader does
+        if len(row) < width:
+            row += [None] * (width - len(row))
+        rows.append(tuple(convert(row[index]) if convert else row[index] for index, convert in getters))
+    return rows
+
+
+class FeedSource:
+    '''
+    the files of a static feed, read from the feed zip or from a directory of extracted files
+    
+    zip members are streamed through ZipFile.open, members inside a folder of the zip are
+    found by their file name
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        self.zip = None
+        self.members = {}
+        if os.path.isfile(path):
+            self.zip = zipfile.ZipFile(path)
+            for info in self.zip.infolist():
+                if not info.is_dir():
+                    self.members.setdefault(os.path.basename(info.filename), info)
+                    
+    def __enter__(self):
+        return self
         
-        if not self.gtfs_exists():
-            self.fetch_static_gtfs(url)
-           
-        if self.db_exists():
-            if update_db:
-                self.gtfs_to_sql()
-        else:
-            self.gtfs_to_sql()
-            
-    def db_exists(self):
-        return os.path.isfile(f'{self.SQLITE_DIR}/{self.agency}_{self.city}.db')
+    def __exit__(self, *exc_info):
+        self.close()
+        
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
             
-    def gtfs_exists(self):
+    def exists(self, file_name):
+        if self.zip is not None:
+            return file_name in self.members
+        return os.path.isfile(os.path.join(self.path, file_name))
+        
+    def stat(self, file_name):
         '''
-        returns whether the gtfs static file for the agency and city exists
+        return: (size, mtime_ns) of a feed file
         '''
-        return os.path.isdir( f'{self.STATIC_DIR}/{self.agency}/{self.city}')
-            
-    def load_data(self, cursor, file_path, table_name, columns, primary_key_column=None):
-        unique_keys = set() if primary_key_column else None
+        if self.zip is not None:
+            info = self.members[file_name]
+            return info.file_size, int(datetime(*info.date_time).timestamp()) * 10**9
+        stat = os.stat(os.path.join(self.path, file_name))
+        return stat.st_size, stat.st_mtime_ns
         
-        with open(file_path, 'r', encoding='utf-8-sig') as file:
-            reader = csv.DictReader(file)
-            to_db = []
-            for row in reader:
-                if primary_key_column:
-                    key = row[primary_key_column]
-                    if key not in unique_keys:
-                        unique_keys.add(key)
-                        to_db.append(tuple(row[col] for col in columns))
-                else:
-                    to_db.append(tuple(row[col] for col in columns))
+    def open(self, file_name):
+        '''
+        opens a feed file for reading bytes
+        '''
+        if self.zip is not None:
+            return self.zip.open(self.members[file_name])
+        return open(os.path.join(self.path, file_name), 'rb')
+        
+    def file_hash(self, file_name, chunk_size=1 << 20):
+        '''
+        returns the sha256 hex digest of a feed file, read in chunks
+        '''
+        sha256 = hashlib.sha256()
+        with self.open(file_name) as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+class PooledConnection:
+    '''
+    holds the connection of one thread in ConnectionPool.local, the connection is closed
+    once the holder is freed, i.e. when its thread exits
+    '''
+    __slots__ = ('conn', '__weakref__')
+    
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class ConnectionPool:
+    '''
+    one SQLite connection per thread, opened lazily and closed when the thread exits
+    
+    connections are read-only (mode=ro) unless read_only is False, they stay open across
+    a reload by gtfs_to_sql as SQLite checks the file and schema for changes at the start
+    of every read transaction
+    
+    immutable=1 additionally skips that check and all locking, only for a database file
+    that is never rewritten while the pool has connections open, see GTFS.gtfs_to_sql
+    '''
+    
+    # prepared statements kept per connection, more than the distinct queries GTFS runs
+    CACHED_STATEMENTS = 256
+    
+    def __init__(self, db_path, read_only=True, immutable=False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.immutable = immutable
+        self.local = threading.local()
+        # reentrant as a thread may exit, and close its connection, while collecting
+        # garbage inside the lock
+        self.lock = threading.RLock()
+        self.connections = set()
+        self.closed = False
+        
+    def uri(self):
+        params = []
+        if self.read_only:
+            params.append('mode=ro')
+        if self.immutable:
+            params.append('immutable=1')
+        uri = f'file:{urllib.request.pathname2url(os.path.abspath(self.db_path))}'
+        return f'{uri}?{"&".join(params)}' if params else uri
+        
+    def connection(self):
+        '''
+        returns the calling thread's connection, opening it on first use
+        
+        raises sqlite3.ProgrammingError once the pool is closed
+        '''
+        if self.closed:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed ConnectionPool.')
+        holder = getattr(self.local, 'holder', None)
+        if holder is None:
+            # check_same_thread is off only so close() and the thread exit can close it,
+            # a connection is never shared between threads
+            conn = sqlite3.connect(self.uri(), uri=True, check_same_thread=False,
+                                   cached_statements=self.CACHED_STATEMENTS)
+            with self.lock:
+                if self.closed:
+                    conn.close()
+                    raise sqlite3.ProgrammingError('Cannot operate on a closed ConnectionPool.')
+                self.connections.add(conn)
+            holder = PooledConnection(conn)
+            # the thread-local holder is freed when the thread exits, so a server running
+            # each request on a new thread does not keep a connection per finished thread
+            weakref.finalize(holder, self.discard, conn)
+            self.local.holder = holder
+        return holder.conn
+        
+    def discard(self, conn):
+        '''
+        closes the connection of a thread that exited
+        '''
+        with self.lock:
+            self.connections.discard(conn)
+        conn.close()
+        
+    def close(self):
+        '''
+        closes the pool and the connections of every thread, for shutting down once no
+        thread queries through the pool any more, later connection() calls raise
+        '''
+        with self.lock:
+            self.closed = True
+            for conn in list(self.connections):
+                conn.close()
+            self.connections = set()
+
+
+class StopGrid:
+    '''
+    bucket map of stops on a regular lat/lon grid
+    
+    radius queries only visit the cells overlapping the bounding box of the search
+    circle, so their cost depends on the stop density around the point rather than
+    on the number of stops in the feed
+    '''
+    
+    EARTH_RADIUS_KM = 6371
+    
+    def __init__(self, stops, cell_deg=0.01):
+        '''
+        stops: List[(stop_id, stop_name, stop_lat, stop_lon)]
+        cell_deg: cell size in degrees, 0.01 is about 1.1km of latitude
+        '''
+        self.stops = stops
+        self.cell_deg = cell_deg
+        self.lon_cells = round(360 / cell_deg)
+        
+        # {(lat cell, lon cell): [index into stops]}
+        self.cells = defaultdict(list)
+        for index, (_, _, stop_lat, stop_lon) in enumerate(stops):
+            self.cells[self.cell(stop_lat, stop_lon)].append(index)
             
-            placeholders = ', '.join(['?'] * len(columns))
-            query = f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES ({placeholders})'
+        # contiguous coordinates in radians for the vectorized distances
+        self.lat_rad = np.radians(np.array([stop[2] for stop in stops], dtype=np.float64))
+        self.lon_rad = np.radians(np.array([stop[3] for stop in stops], dtype=np.float64))
+        self.cos_lat = np.cos(self.lat_rad)
             
-            # Assuming 'cursor' is defined and connected to your database
-            cursor.executemany(query, to_db)
-    
-    def gtfs_to_sql(self):
+    def cell(self, lat, lon):
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg) % self.lon_cells
+        
+    def candidates(self, lon, lat, radius_km):
         '''
-        1.	Create the SQLite database and tables.
-        2.	Read data from text files.
-        3.	Insert the data into the corresponding tables in the SQLite database.
+        returns the indexes of the stops in every cell that may hold a stop within radius_km
         '''
-        os.makedirs(GTFS.SQLITE_DIR, exist_ok=True)
+        angle = radius_km / self.EARTH_RADIUS_KM
+        # pad against rounding so stops exactly on the circle are never missed
+        dlat = math.degrees(angle) + 1e-9
         
-        # Connect to SQLite database (or create it if it doesn't exist)
-        # BC Transit static
-        # - shape_id is not a primary key
-        #
-        # the following stop_ids are in stops but not stop_times
-        # 930000 'Langford Transit Centre'
-        # 900000 'Victoria Transit Centre'
-        # 100000 'UVic Exch Bay D'
+        # longitude span of the circle, every longitude once the circle reaches a pole
+        cos_lat = math.cos(math.radians(lat))
+        if angle >= math.pi / 2 or math.sin(angle) >= cos_lat:
+            dlon = 180
+        else:
+            dlon = math.degrees(math.asin(math.sin(angle) / cos_lat)) + 1e-9
+            
+        lat_range = range(math.floor((lat - dlat) / self.cell_deg), math.floor((lat + dlat) / self.cell_deg) + 1)
+        lon_range = range(math.floor((lon - dlon) / self.cell_deg), math.floor((lon + dlon) / self.cell_deg) + 1)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.executescript("""
+        # a circle larger than the populated area, every stop is a candidate
+        if len(lat_range) * min(len(lon_range), self.lon_cells) >= len(self.cells):
+            return range(len(self.stops))
+            
+        lon_cells = {lon_cell % self.lon_cells for lon_cell in lon_range}
+        candidates = []
+        for lat_cell in lat_range:
+            for lon_cell in lon_cells:
+                candidates.extend(self.cells.get((lat_cell, lon_cell), ()))
+        return candidates
+        
+    def distances(self, points):
+        '''
+        haversine distance in km from every (lon, lat) point to every stop
         
-        DROP TABLE IF EXISTS agency;
-        CREATE TABLE agency (
+        return: array of shape (len(points), len(stops))
+        '''
+        lon = np.radians(points[:, 0])[:, np.newaxis]
+        lat = np.radians(points[:, 1])[:, np.newaxis]
+        
+        dlon = self.lon_rad - lon
+        dlat = self.lat_rad - lat
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat) * self.cos_lat * np.sin(dlon / 2) ** 2
+        return 2 * self.EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class GTFS:
+    STATIC_DIR = 'gtfs_static'
+    SQLITE_DIR = 'sqlite3_db'
+    
+    # bump when TABLES or INDEXES change, databases built with another version are rebuilt
+    SCHEMA_VERSION = 2
+    
+    # BC Transit static
+    # - shape_id is not a primary key
+    #
+    # the following stop_ids are in stops but not stop_times
+    # 930000 'Langford Transit Centre'
+    # 900000 'Victoria Transit Centre'
+    # 100000 'UVic Exch Bay D'
+    TABLES = {
+        'agency': '''
             agency_id TEXT NOT NULL PRIMARY KEY,
             agency_name TEXT,
             agency_url TEXT,
             agency_timezone TEXT,
             agency_phone TEXT,
             agency_lang TEXT
-        );
-        
-        DROP TABLE IF EXISTS shapes;
-        CREATE TABLE shapes (
+        ''',
+        'shapes': '''
             shape_id TEXT,
             shape_pt_lat REAL,
             shape_pt_lon REAL,
             shape_pt_sequence TEXT
-        );
-        
-        DROP TABLE IF EXISTS calendar;
-        CREATE TABLE calendar (
+        ''',
+        'calendar': '''
             service_id TEXT NOT NULL PRIMARY KEY,
             monday INTEGER,
             tuesday INTEGER,
@@ -107,18 +359,14 @@ class GTFS:
             sunday INTEGER,
             start_date TEXT,
             end_date TEXT
-        );
-        
-        DROP TABLE IF EXISTS calendar_dates;
-        CREATE TABLE calendar_dates (
+        ''',
+        'calendar_dates': '''
             service_id TEXT,
             date TEXT,
             exception_type INTEGER,
             FOREIGN KEY (service_id) REFERENCES calendar(service_id)
-        );
-        
-        DROP TABLE IF EXISTS routes;
-        CREATE TABLE routes (
+        ''',
+        'routes': '''
             route_id TEXT NOT NULL PRIMARY KEY,
             agency_id TEXT,
             route_short_name TEXT,
@@ -129,10 +377,8 @@ class GTFS:
             route_color TEXT,
             route_text_color TEXT,
             FOREIGN KEY (agency_id) REFERENCES agency(agency_id)
-        );
-        
-        DROP TABLE IF EXISTS trips;
-        CREATE TABLE trips (
+        ''',
+        'trips': '''
             trip_id TEXT NOT NULL PRIMARY KEY,
             service_id TEXT,
             route_id TEXT,
@@ -141,10 +387,8 @@ class GTFS:
             shape_id TEXT,
             FOREIGN KEY (service_id) REFERENCES calendar(service_id),
             FOREIGN KEY (shape_id) REFERENCES shapes(shape_id)
-        );
-        
-        DROP TABLE IF EXISTS stops;
-        CREATE TABLE stops (
+        ''',
+        'stops': '''
             stop_id TEXT NOT NULL PRIMARY KEY,
             stop_code TEXT,
             stop_name TEXT,
@@ -155,15 +399,15 @@ class GTFS:
             wheelchair_boarding INTEGER,
             stop_desc TEXT,
             zone_id TEXT
-        );
-        
-        DROP TABLE IF EXISTS stop_times;
-        CREATE TABLE stop_times (
+        ''',
+        'stop_times': '''
             trip_id TEXT,
             stop_id TEXT,
-            stop_sequence TEXT,
+            stop_sequence INTEGER,
             arrival_time TEXT,
             departure_time TEXT,
+            arrival_secs INTEGER,
+            departure_secs INTEGER,
             stop_headsign TEXT,
             pickup_type INTEGER,
             drop_off_type INTEGER,
@@ -171,103 +415,601 @@ class GTFS:
             timepoint INTEGER,
             FOREIGN KEY (trip_id) REFERENCES trips(trip_id),
             FOREIGN KEY (stop_id) REFERENCES stops(stop_id)
-        );
-        
-        DROP TABLE IF EXISTS frequencies;
-        CREATE TABLE frequencies (
+        ''',
+        'active_services': '''
+            date TEXT NOT NULL,
+            service_id TEXT NOT NULL,
+            PRIMARY KEY (date, service_id)
+        ''',
+        'frequencies': '''
             trip_id TEXT,
             start_time TEXT,
             end_time TEXT,
             headway_secs TEXT,
             FOREIGN KEY (trip_id) REFERENCES trips(trip_id)
+        ''',
+    }
+    
+    # built after the load so the inserts do not maintain them row by row
+    INDEXES = {
+        'stop_times_stop_arrival': ('stop_times', ['stop_id', 'arrival_secs']),
+        'stop_times_trip_sequence': ('stop_times', ['trip_id', 'stop_sequence']),
+        'trips_route_direction': ('trips', ['route_id', 'direction_id']),
+    }
+    
+    # columns computed from another column of the same feed file while loading
+    DERIVED_COLUMNS = {
+        'arrival_secs': ('arrival_time', time_to_seconds),
+        'departure_secs': ('departure_time', time_to_seconds),
+    }
+    
+    # distances computed at once by get_nearby_bus_stops_many
+    BATCH_DISTANCES = 1 << 22
+    
+    # stop ids bound in a single get_incoming_buses_many query
+    MAX_QUERY_STOPS = 500
+    
+    # get_departures also considers buses scheduled up to this many seconds before the
+    # query time, they may still be coming late
+    DEPARTURE_LOOKBACK = 30 * 60
+    
+    # static candidates beyond count per stop, taking the place of delayed buses that
+    # drop out of the first count
+    DEPARTURE_PADDING = 5
+    
+    # rows per executemany batch, bounds the loader memory regardless of file size
+    LOAD_CHUNK_SIZE = 50000
+    
+    # bytes of a feed file parsed by one worker of the parallel loader
+    PARALLEL_CHUNK_BYTES = 1 << 22
+    
+    # connection settings used only while bulk loading, the database keeps its rollback
+    # journal so a load killed midway rolls back on the next open, only syncing is relaxed
+    LOAD_PRAGMAS = {
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,  # KiB, i.e. 64 MB
+    }
+    
+    # static feed download, seconds per blocking socket operation and attempts after a failure
+    DOWNLOAD_TIMEOUT = 60
+    DOWNLOAD_RETRIES = 3
+    # seconds before the first retry, doubled after every failed attempt
+    DOWNLOAD_BACKOFF = 2
+    DOWNLOAD_BLOCK_SIZE = 1 << 20
+    
+    # files a feed may leave out, e.g. calendar.txt when every service date is in calendar_dates.txt
+    OPTIONAL_FILES = {'calendar.txt', 'calendar_dates.txt'}
+    
+    # feed file: (table, columns loaded from the file)
+    FILES_TO_LOAD = {
+        'agency.txt': ('agency', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_phone', 'agency_lang']),
+        'shapes.txt': ('shapes', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']),
+        'calendar.txt': ('calendar', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date']),
+        'calendar_dates.txt': ('calendar_dates', ['service_id', 'date', 'exception_type']),
+        'routes.txt': ('routes', ['route_id', 'route_short_name', 'route_long_name', 'route_type', 'route_color', 'route_text_color']),
+        'stops.txt': ('stops', ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding']),
+        'trips.txt': ('trips', ['trip_id', 'service_id', 'route_id', 'trip_headsign', 'direction_id', 'shape_id']),
+        #'frequencies.txt': ('frequencies', ['trip_id', 'start_time', 'end_time', 'headway_secs']),
+        'stop_times.txt': ('stop_times', ['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time', 'arrival_secs', 'departure_secs', 'stop_headsign', 'pickup_type', 'drop_off_type', 'shape_dist_traveled', 'timepoint'])
+    }
+    
+    def __init__(self, agency, city, url=None, update_db=True, incremental=True, read_only=True, immutable=False, backend='sqlite', workers=1):
+        self.agency = agency
+        self.city = city
+        self.db_path = f'{self.SQLITE_DIR}/{self.agency}_{self.city}.db'
+        self.snapshot_path = f'{self.SQLITE_DIR}/{self.agency}_{self.city}.snapshot'
+        
+        # connections used by the query methods
+        self.pool = ConnectionPool(self.db_path, read_only, immutable)
+        
+        # spatial index for get_nearby_bus_stops, built on first use
+        self.stop_grid = None
+        self.stop_grid_lock = threading.Lock()
+        
+        # 'sqlite' answers the timetable queries with SQL, 'memory' with a ColumnarTimetable
+        if backend not in ('sqlite', 'memory'):
+            raise ValueError(f"backend must be 'sqlite' or 'memory', not {backend!r}")
+        self.backend = backend
+        self.timetable = None
+        self.timetable_lock = threading.Lock()
+        
+        if not self.gtfs_exists():
+            self.fetch_static_gtfs(url)
+           
+        if self.db_exists():
+            if update_db:
+                self.gtfs_to_sql(incremental, workers)
+        else:
+            self.gtfs_to_sql(workers=workers)
+            
+    def db_exists(self):
+        return os.path.isfile(f'{self.SQLITE_DIR}/{self.agency}_{self.city}.db')
+            
+    def gtfs_exists(self):
+        '''
+        returns whether the gtfs static file for the agency and city exists, either the
+        downloaded zip or extracted feed files
+        '''
+        directory = f'{self.STATIC_DIR}/{self.agency}/{self.city}'
+        return os.path.isfile(self.zip_path()) or os.path.isfile(f'{directory}/stops.txt')
+            
+    def zip_path(self):
+        return f'{self.STATIC_DIR}/{self.agency}/{self.city}/{self.city}.zip'
+            
+    def feed_path(self):
+        '''
+        returns the feed zip downloaded by fetch_static_gtfs, or the feed directory
+        when the feed was extracted there instead
+        '''
+        zip_path = self.zip_path()
+        return zip_path if os.path.isfile(zip_path) else os.path.dirname(zip_path)
+            
+    def read_rows(self, feed, file_name, columns, primary_key_column=None):
+        '''
+        yields one tuple of columns per row of a feed file without holding the file in memory
+        '''
+        unique_keys = set() if primary_key_column else None
+        
+        # plain columns are (column, None), derived columns are (source column, conversion)
+        getters = [self.DERIVED_COLUMNS.get(col, (col, None)) for col in columns]
+        
+        with io.TextIOWrapper(feed.open(file_name), encoding='utf-8-sig', newline='') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                if primary_key_column:
+                    key = row[primary_key_column]
+                    if key in unique_keys:
+                        continue
+                    unique_keys.add(key)
+                yield tuple(convert(row[col]) if convert else row[col] for col, convert in getters)
+    
+    def load_data(self, cursor, feed, file_name, table_name, columns, primary_key_column=None):
+        '''
+        streams a feed file into table_name in chunks of LOAD_CHUNK_SIZE rows
+        
+        return: number of rows inserted
+        '''
+        query = self.insert_query(table_name, columns)
+        
+        rows = self.read_rows(feed, file_name, columns, primary_key_column)
+        row_count = 0
+        while True:
+            chunk = list(itertools.islice(rows, self.LOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+            cursor.executemany(query, chunk)
+            row_count += len(chunk)
+        
+        return row_count
+    
+    def insert_query(self, table_name, columns):
+        placeholders = ', '.join(['?'] * len(columns))
+        return f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES ({placeholders})'
+    
+    def load_data_parallel(self, cursor, feed, stale, workers):
+        '''
+        loads the stale feed files with a pool of worker processes parsing blocks of
+        PARALLEL_CHUNK_BYTES, read from the feed by a producer thread, while this
+        thread, the only writer, inserts the parsed batches in file order
+        
+        parsed batches wait in a queue bounded to two per worker, so a slow writer
+        stalls the parsing instead of filling memory
+        
+        yields (file_name, row_count, elapsed seconds) as each file is loaded, row_count
+        is None for a file not in the feed
+        '''
+        # per file: a future per chunk, then None
+        batches = queue.Queue(maxsize=2 * workers)
+        cancelled = threading.Event()
+        
+        def submit_chunks(pool):
+            try:
+                for file_name, fingerprint in stale.items():
+                    if fingerprint[0] is None:
+                        continue
+                    columns = self.FILES_TO_LOAD[file_name][1]
+                    with feed.open(file_name) as file:
+                        header = next(csv.reader([file.readline().decode('utf-8-sig')]))
+                        for block in file_chunks(file, self.PARALLEL_CHUNK_BYTES):
+                            if cancelled.is_set():
+                                return
+                            batches.put(pool.submit(parse_chunk, header, block, columns))
+                    batches.put(None)
+            except Exception as error:
+                batches.put(error)
+        
+        with ProcessPoolExecutor(workers) as pool:
+            producer = threading.Thread(target=submit_chunks, args=(pool,), daemon=True)
+            producer.start()
+            try:
+                for file_name, fingerprint in stale.items():
+                    if fingerprint[0] is None:
+                        yield file_name, None, 0
+                        continue
+                    
+                    start = time.perf_counter()
+                    query = self.insert_query(*self.FILES_TO_LOAD[file_name])
+                    row_count = 0
+                    while True:
+                        batch = batches.get()
+                        if batch is None:
+                            break
+                        if isinstance(batch, Exception):
+                            raise batch
+                        rows = batch.result()
+                        cursor.executemany(query, rows)
+                        row_count += len(rows)
+                    yield file_name, row_count, time.perf_counter() - start
+            finally:
+                # unblock and stop the producer before the pool shuts down
+                cancelled.set()
+                while producer.is_alive():
+                    try:
+                        batch = batches.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if batch is not None and not isinstance(batch, Exception):
+                        batch.cancel()
+    
+    def gtfs_to_sql(self, incremental=True, workers=1):
+        '''
+        1.	Create the SQLite database and tables.
+        2.	Fingerprint (size, mtime, sha256) each feed file against feed_metadata.
+        3.	Reload only the tables whose source file changed.
+        
+        incremental=False drops and reloads every table regardless of the fingerprints
+        workers > 1 parses the feed files in that many processes, see load_data_parallel
+        '''
+        os.makedirs(GTFS.SQLITE_DIR, exist_ok=True)
+        
+        # immutable connections would keep reading the pages of the old file
+        if self.pool.immutable and self.pool.connections:
+            raise sqlite3.ProgrammingError('Cannot reload a database opened with immutable=1.')
+        
+        # pooled connections stay open and read the new tables once the load commits,
+        # only the data cached from the old tables is dropped
+        self.stop_grid = None
+        self.timetable = None
+        
+        # Connect to SQLite database (or create it if it doesn't exist)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        for pragma, value in self.LOAD_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        
+        # the whole refresh is a single transaction
+        cursor.execute('BEGIN')
+        
+        # fingerprints of the feed files the tables were last loaded from
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS feed_metadata (
+            file_name TEXT NOT NULL PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            sha256 TEXT
         );
         """)
         
-        ''' Uses the first column as the key in the dict
-        # Function to load data from a CSV file into a table
-        def load_data(file_path, table_name, columns):
-            primary_key = columns[0]  # Assuming the first column is the primary key
-            unique_keys = set()
-            
-            with open(file_path, 'r', encoding='utf-8-sig') as file:
-                reader = csv.DictReader(file)
-                to_db = []
-                for row in reader:
-                    key = row[primary_key]
-                    if key not in unique_keys:
-                        unique_keys.add(key)
-                        to_db.append(tuple(row[col] for col in columns))
-                
-                placeholders = ', '.join(['?'] * len(columns))
-                query = f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES ({placeholders})'
-                cursor.executemany(query, to_db)
-        '''
-        
-        # File paths (adjust these paths as necessary)
-        files_to_load = {
-            'agency.txt': ('agency', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_phone', 'agency_lang']),
-            'shapes.txt': ('shapes', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']),
-            #'calendar.txt': ('calendar', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date']),
-            'calendar_dates.txt': ('calendar_dates', ['service_id', 'date', 'exception_type']),
-            'routes.txt': ('routes', ['route_id', 'route_short_name', 'route_long_name', 'route_type', 'route_color', 'route_text_color']),
-            'stops.txt': ('stops', ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding']),
-            'trips.txt': ('trips', ['trip_id', 'service_id', 'route_id', 'trip_headsign', 'direction_id', 'shape_id']),
-            #'frequencies.txt': ('frequencies', ['trip_id', 'start_time', 'end_time', 'headway_secs']),
-            'stop_times.txt': ('stop_times', ['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time', 'stop_headsign', 'pickup_type', 'drop_off_type', 'shape_dist_traveled', 'timepoint'])
-        }
-        
-        directory = f'{self.STATIC_DIR}/{self.agency}/{self.city}/'
-        
-        # Load data from each file into the corresponding table
-        for file_path, (table_name, columns) in files_to_load.items():
-            self.load_data(cursor, directory + file_path, table_name, columns)
+        # tables built with an older schema cannot be reused
+        if cursor.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            incremental = False
+            cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        
+        if not incremental:
+            cursor.execute('DELETE FROM feed_metadata')
+        
+        # tables without a source file are only created once
+        for table_name in self.TABLES:
+            self.create_table(cursor, table_name, replace=not incremental)
+        
+        feed = FeedSource(self.feed_path())
+        
+        stale = self.stale_files(cursor, feed)
+        
+        # Reload only the tables whose source file changed
+        for file_name in stale:
+            self.create_table(cursor, self.FILES_TO_LOAD[file_name][0], replace=True)
+        
+        if workers > 1 and stale:
+            loaded = self.load_data_parallel(cursor, feed, stale, workers)
+        else:
+            loaded = self.load_data_serial(cursor, feed, stale)
+        
+        for file_name, row_count, elapsed in loaded:
+            table_name = self.FILES_TO_LOAD[file_name][0]
+            fingerprint = stale[file_name]
+            
+            if row_count is None:
+                print(f'{table_name}: {file_name} not in feed')
+            else:
+                print(f'{table_name}: {row_count} rows in {elapsed:.2f}s ({row_count / max(elapsed, 1e-9):.0f} rows/s)')
+            
+            cursor.execute(
+                'INSERT OR REPLACE INTO feed_metadata (file_name, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)',
+                (file_name, *fingerprint)
+            )
+        feed.close()
+        
+        # service days are derived from both calendar files
+        if stale.keys() & {'calendar.txt', 'calendar_dates.txt'}:
+            self.build_active_services(cursor)
+        
+        # Index building phase, only reloaded tables lost their indexes
+        for index_name, (table_name, columns) in self.INDEXES.items():
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({", ".join(columns)})')
         
         # Commit the changes and close the connection
         conn.commit()
         conn.close()
         
-        print("Data has been successfully loaded into the SQLite database.")
+        # the snapshot of the memory backend is rebuilt from the new tables on next use, one
+        # written from the old tables by another process no longer matches feed_fingerprint
+        if stale and os.path.isfile(self.snapshot_path):
+            os.remove(self.snapshot_path)
+        
+        if stale:
+            print(f"Data has been successfully loaded into the SQLite database ({', '.join(stale)}).")
+        else:
+            print("SQLite database is up to date.")
     
-    def fetch_static_gtfs(self, url):
+    def load_data_serial(self, cursor, feed, stale):
         '''
-        Fetches static GTFS zip file from URL
-        extracts the zip file into the GTFS directory 
+        loads the stale feed files one after another on this thread
+        
+        yields (file_name, row_count, elapsed seconds) like load_data_parallel
+        '''
+        for file_name, fingerprint in stale.items():
+            if fingerprint[0] is None:
+                yield file_name, None, 0
+                continue
+            
+            table_name, columns = self.FILES_TO_LOAD[file_name]
+            start = time.perf_counter()
+            row_count = self.load_data(cursor, feed, file_name, table_name, columns)
+            yield file_name, row_count, time.perf_counter() - start
+    
+    def build_active_services(self, cursor):
+        '''
+        materializes active_services(date, service_id) from the calendar weekday
+        patterns between start_date and end_date, then applies the calendar_dates
+        exceptions (1: service added, 2: service removed)
         '''
+        weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+        active = set()
+        
+        cursor.execute(f'SELECT service_id, start_date, end_date, {", ".join(weekdays)} FROM calendar')
+        for service_id, start_date, end_date, *runs in cursor.fetchall():
+            day = datetime.strptime(start_date, '%Y%m%d')
+            end = datetime.strptime(end_date, '%Y%m%d')
+            while day <= end:
+                if int(runs[day.weekday()]):
+                    active.add((day.strftime('%Y%m%d'), service_id))
+                day += timedelta(days=1)
         
+        cursor.execute('SELECT date, service_id, exception_type FROM calendar_dates')
+        for date, service_id, exception_type in cursor.fetchall():
+            if int(exception_type) == 1:
+                active.add((date, service_id))
+            elif int(exception_type) == 2:
+                active.discard((date, service_id))
+        
+        self.create_table(cursor, 'active_services', replace=True)
+        cursor.executemany('INSERT INTO active_services (date, service_id) VALUES (?, ?)', sorted(active))
+        print(f'active_services: {len(active)} service days')
+    
+    def create_table(self, cursor, table_name, replace=False):
+        '''
+        creates table_name from TABLES, dropping the existing table first if replace is set
+        '''
+        if replace:
+            cursor.execute(f'DROP TABLE IF EXISTS {table_name}')
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {table_name} ({self.TABLES[table_name]})')
+    
+    def stale_files(self, cursor, feed):
+        '''
+        compares each feed file against the fingerprint stored in feed_metadata
+        
+        return: {file_name: (size, mtime_ns, sha256)} of the files whose table must be reloaded
+        '''
+        cursor.execute('SELECT file_name, size, mtime_ns, sha256 FROM feed_metadata')
+        stored = {row[0]: row[1:] for row in cursor.fetchall()}
+        
+        stale = {}
+        for file_name in self.FILES_TO_LOAD:
+            previous = stored.get(file_name)
+            
+            # a missing optional file leaves its table empty
+            if file_name in self.OPTIONAL_FILES and not feed.exists(file_name):
+                if previous != (None, None, None):
+                    stale[file_name] = (None, None, None)
+                continue
+            
+            size, mtime_ns = feed.stat(file_name)
+            
+            # same size and mtime, trust the stored hash without reading the file
+            if previous and previous[:2] == (size, mtime_ns):
+                continue
+            
+            sha256 = feed.file_hash(file_name)
+            
+            # file was touched (e.g. re-downloaded) but its content is the same
+            if previous and previous[2] == sha256:
+                cursor.execute(
+                    'UPDATE feed_metadata SET size = ?, mtime_ns = ? WHERE file_name = ?',
+                    (size, mtime_ns, file_name)
+                )
+                continue
+            
+            stale[file_name] = (size, mtime_ns, sha256)
+        
+        return stale
+    
+    def feed_fingerprint(self, cursor):
+        '''
+        return: hash of the schema version and the file hashes in feed_metadata, changes
+                whenever a load changes the tables
+        '''
+        sha256 = hashlib.sha256(str(cursor.execute('PRAGMA user_version').fetchone()[0]).encode())
+        for file_name, file_hash in cursor.execute('SELECT file_name, sha256 FROM feed_metadata ORDER BY file_name'):
+            sha256.update(f'\0{file_name}\0{file_hash}'.encode())
+        return sha256.hexdigest()
+    
+    def feed_url(self):
+        '''
+        returns the static feed link of the agency and city in transit_gtfs_list.csv
+        '''
+        # if the list of transit file links does not exist
+        if not os.path.isfile('transit_gtfs_list.csv'):
+            print('No GTFS links provided to constructor and transit_gtfs_list.csv does not exist.')
+            return None
+            
+        # load file urls from the list of transit links
+        with open('transit_gtfs_list.csv', newline='') as transit_list:
+            spamreader = csv.reader(transit_list, delimiter=',')
+            for row in spamreader:
+                if row[0] == self.agency and row[1] == self.city:
+                    # 3rd column is the link for the static files
+                    return row[2]
+        
+        print(f'No GTFS link for {self.agency} {self.city} in transit_gtfs_list.csv.')
+        return None
+        
+    def fetch_static_gtfs(self, url=None, timeout=None, retries=None):
+        '''
+        Fetches static GTFS zip file from URL into the GTFS directory
+        the zip is kept as is, gtfs_to_sql reads its members without extracting them
+        
+        the request is conditional on the ETag / Last-Modified of the zip already
+        downloaded, stored next to it in <zip>.json, and an interrupted download
+        resumes from its .part file with a Range request
+        
+        failed attempts (connection errors, timeouts, HTTP 408, 429 and 5xx) are retried
+        up to retries times, waiting DOWNLOAD_BACKOFF seconds doubled after every attempt
+        
+        return: True when a new zip was downloaded, False when the feed is unchanged
+        (HTTP 304) or has no link
+        '''
+        url = url or self.feed_url()
         if not url:
-            # if the list of transit file links does not exist
-            if not os.path.isfile('transit_gtfs_list.csv'):
-                print('No GTFS links provided to constructor and transit_gtfs_list.csv does not exist.')
-                return  
-                
-            # load file urls from the list of transit links
-            with open('transit_gtfs_list.csv', newline='') as transit_list:
-                spamreader = csv.reader(transit_list, delimiter=',')
-                for row in spamreader:
-                    if row[0] == self.agency and row[1] == self.city:
-                        # 3rd column is the link for the static files
-                        url = row[2]
+            return False
+        timeout = self.DOWNLOAD_TIMEOUT if timeout is None else timeout
+        retries = self.DOWNLOAD_RETRIES if retries is None else retries
         
         # Path where you want to save the downloaded file
-        save_path = f'{self.STATIC_DIR}/{self.agency}/{self.city}/{self.city}.zip'
-        extract_path = f'{self.STATIC_DIR}/{self.agency}/{self.city}'
+        save_path = self.zip_path()
+        
+        # Ensure the feed directory exists
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        
+        for attempt in range(retries + 1):
+            try:
+                return self.download(url, save_path, timeout)
+            except OSError as error:
+                # client errors other than timeouts and rate limits will not go away
+                if isinstance(error, urllib.error.HTTPError) and error.code < 500 and error.code not in (408, 429):
+                    raise
+                if attempt == retries:
+                    raise
+                delay = self.DOWNLOAD_BACKOFF * 2 ** attempt
+                print(f'Download of {url} failed ({error}), retrying in {delay}s')
+                time.sleep(delay)
+                
+    def download(self, url, save_path, timeout):
+        '''
+        downloads url into save_path + '.part' and moves it to save_path once complete
+        
+        return: False when the server answers 304 Not Modified, else True
+        '''
+        part_path = save_path + '.part'
+        headers = {}
         
-        # Ensure the extraction directory exists
-        os.makedirs(extract_path, exist_ok=True)
+        # validators of the complete zip make the request conditional
+        validators = self.read_validators(save_path)
+        if os.path.isfile(save_path) and validators.get('url') == url:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
         
-        # Download the file from the URL
-        urllib.request.urlretrieve(url, save_path)
+        # validators of a partial download allow resuming it, If-Range restarts it
+        # from the beginning when the file changed on the server in the meantime
+        offset = 0
+        part_validators = self.read_validators(part_path)
+        if os.path.isfile(part_path) and part_validators.get('url') == url:
+            validator = part_validators.get('etag') or part_validators.get('last_modified')
+            if validator:
+                offset = os.path.getsize(part_path)
+                headers['Range'] = f'bytes={offset}-'
+                headers['If-Range'] = validator
         
-        print(f"GTFS zip file successfully downloaded to {save_path}")
+        start = time.perf_counter()
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                print(f'GTFS zip file {save_path} is up to date.')
+                return False
+            # the partial download is already complete or larger than the file
+            if error.code == 416 and offset:
+                os.remove(part_path)
+                return self.download(url, save_path, timeout)
+            raise
         
-        # Extract the contents of the ZIP file
-        with zipfile.ZipFile(save_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_path)
-            print(f"Contents extracted to {extract_path}")
+        with response:
+            if response.status != 206:
+                offset = 0
+                self.write_validators(part_path, url, response.headers)
+            length = response.headers.get('Content-Length')
             
-        os.remove(save_path)
+            with open(part_path, 'ab' if offset else 'wb') as file:
+                for block in iter(lambda: response.read(self.DOWNLOAD_BLOCK_SIZE), b''):
+                    file.write(block)
+                size = file.tell()
+        
+        # a dropped connection ends the body early, the retry resumes from here
+        if length is not None and size != offset + int(length):
+            raise urllib.error.ContentTooShortError(f'retrieval incomplete: got only {size} of {offset + int(length)} bytes', None)
+        
+        if not zipfile.is_zipfile(part_path):
+            os.remove(part_path)
+            os.remove(part_path + '.json')
+            raise zipfile.BadZipFile(f'{url} is not a zip file')
+        
+        # replace the previous zip only once the download is complete
+        os.replace(part_path, save_path)
+        os.replace(part_path + '.json', save_path + '.json')
         
-        print(f"File {save_path} has been deleted.")        
+        elapsed = time.perf_counter() - start
+        resumed = f', resumed at {offset} bytes' if offset else ''
+        print(f"GTFS zip file successfully downloaded to {save_path} ({size} bytes in {elapsed:.1f}s{resumed})")
+        return True
+        
+    def read_validators(self, path):
+        '''
+        returns the url, etag and last_modified stored for a downloaded file, {} if none
+        '''
+        try:
+            with open(path + '.json') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+            
+    def write_validators(self, path, url, headers):
+        with open(path + '.json', 'w') as file:
+            json.dump({'url': url, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}, file)
+        
+    def refresh(self, url=None, incremental=True, workers=1):
+        '''
+        fetches the static feed again and reloads the database only when the server
+        sent a new zip, a 304 Not Modified leaves both as they are
+        
+        return: whether the feed changed
+        '''
+        if not self.fetch_static_gtfs(url):
+            return False
+        self.gtfs_to_sql(incremental, workers)
+        return True
         
     def get_date(self):
         return datetime.now().strftime('%Y%m%d')
@@ -276,6 +1018,42 @@ class GTFS:
         return datetime.now().strftime('%H:%M:%S')
         
 
+    def close(self):
+        '''
+        closes the pooled database connections, the SQL queries raise afterwards
+        '''
+        self.pool.close()
+
+    def get_timetable(self):
+        '''
+        returns the ColumnarTimetable of the memory backend, memory-mapped from the
+        snapshot file, or built from the database and written as the snapshot when
+        there is no snapshot of the current feed_fingerprint
+        '''
+        if self.timetable is None:
+            with self.timetable_lock:
+                if self.timetable is None:
+                    conn = self.pool.connection()
+                    # one read transaction, a load committing meanwhile cannot pair the
+                    # fingerprint with tables it does not describe
+                    conn.execute('BEGIN')
+                    try:
+                        fingerprint = self.feed_fingerprint(conn.cursor())
+                        timetable = None
+                        if os.path.isfile(self.snapshot_path):
+                            timetable = ColumnarTimetable.open_snapshot(self.snapshot_path, fingerprint)
+                        if timetable is None:
+                            timetable = ColumnarTimetable.from_sqlite(conn)
+                            timetable.write_snapshot(self.snapshot_path, fingerprint)
+                            # another process may have replaced the snapshot already
+                            mapped = ColumnarTimetable.open_snapshot(self.snapshot_path, fingerprint)
+                            if mapped is not None:
+                                timetable = mapped
+                    finally:
+                        conn.rollback()
+                    self.timetable = timetable
+        return self.timetable
+
     def get_incoming_buses(self, stop_id, query_date=None, query_time=None, count = 1):
         '''
         parameters: db_path: path to sqlite GTFS db file
@@ -284,16 +1062,18 @@ class GTFS:
     
         return: List[(arrival_time, route_id, trip_headsign)]
         '''
-        # Connect to the SQLite database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         # Get the current time and date
         if not query_date:
             query_date = self.get_date()
         if not query_time:
             query_time = self.get_time()
             
+        if self.backend == 'memory':
+            return self.get_timetable().get_incoming_buses(stop_id, query_date, time_to_seconds(query_time), count)
+            
+        # Pooled connection of this thread
+        cursor = self.pool.connection().cursor()
+        
         #current_weekday = now.strftime('%w')  # '0' is Sunday, '1' is Monday, ..., '6' is Saturday
         
         #print(f"Current time: {current_time}, Current date: {current_date}")
@@ -310,28 +1090,240 @@ class GTFS:
         JOIN
             trips t ON st.trip_id = t.trip_id
         JOIN
-            calendar_dates cd ON t.service_id = cd.service_id
+            active_services a ON t.service_id = a.service_id
         WHERE
             st.stop_id = ?
-            AND st.arrival_time > ?
-            AND cd.date = ?
+            AND st.arrival_secs > ?
+            AND a.date = ?
         ORDER BY
-            st.arrival_time
+            st.arrival_secs
         LIMIT ?;
             
         """
         
         # Execute the query with the specified stop_id and current time/date
-        cursor.execute(query, (stop_id, query_time, query_date, count))
+        cursor.execute(query, (stop_id, time_to_seconds(query_time), query_date, count))
             
         # Fetch all results
         incoming_buses = cursor.fetchall()
         
-        # Close the database connection
-        conn.close()
+        return incoming_buses
+        
+    def get_incoming_buses_many(self, stop_ids, query_date=None, query_time=None, count = 1):
+        '''
+        get_incoming_buses for many stops in one query, e.g. a departure board
+        
+        parameters: stop_ids: stop sign ids
+                    count: how many rows to return per stop
+    
+        return: {stop_id: List[(arrival_time, route_id, trip_headsign, trip_id)]}
+        '''
+        # Get the current time and date
+        if not query_date:
+            query_date = self.get_date()
+        if not query_time:
+            query_time = self.get_time()
+        
+        stop_ids = list(dict.fromkeys(stop_ids))
+        
+        if self.backend == 'memory':
+            timetable = self.get_timetable()
+            return {
+                stop_id: timetable.get_incoming_buses(stop_id, query_date, time_to_seconds(query_time), count)
+                for stop_id in stop_ids
+            }
+        
+        # Pooled connection of this thread
+        cursor = self.pool.connection().cursor()
+        incoming_buses = {stop_id: [] for stop_id in stop_ids}
+        
+        # stops per query, stays below the SQLite host parameter limit
+        for start in range(0, len(stop_ids), self.MAX_QUERY_STOPS):
+            chunk = stop_ids[start:start + self.MAX_QUERY_STOPS]
+            
+            # Number the arrivals of each stop and keep the first count
+            query = f"""
+            WITH stop_arrivals AS (
+                SELECT
+                    st.stop_id,
+                    st.arrival_time,
+                    t.route_id,
+                    t.trip_headsign,
+                    t.trip_id,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY st.stop_id
+                        ORDER BY st.arrival_secs
+                    ) AS arrival_number
+                FROM
+                    stop_times st
+                JOIN
+                    trips t ON st.trip_id = t.trip_id
+                JOIN
+                    active_services a ON t.service_id = a.service_id
+                WHERE
+                    st.stop_id IN ({', '.join(['?'] * len(chunk))})
+                    AND st.arrival_secs > ?
+                    AND a.date = ?
+            )
+            SELECT
+                stop_id,
+                arrival_time,
+                route_id,
+                trip_headsign,
+                trip_id
+            FROM
+                stop_arrivals
+            WHERE
+                arrival_number <= ?
+            ORDER BY
+                stop_id,
+                arrival_number;
+            """
+            
+            cursor.execute(query, (*chunk, time_to_seconds(query_time), query_date, count))
+            
+            # Group the rows per stop
+            for stop_id, *bus in cursor.fetchall():
+                incoming_buses[stop_id].append(tuple(bus))
         
         return incoming_buses
+    
+    def get_departure_candidates(self, stop_ids, query_date, from_secs, query_secs, count):
+        '''
+        static arrivals of many stops that realtime predictions may move past query_secs
         
+        return: {stop_id: List[(arrival_time, route_id, trip_headsign, trip_id, arrival_secs, stop_sequence)]}
+                every arrival after from_secs up to query_secs and the first count after it
+        '''
+        if self.backend == 'memory':
+            timetable = self.get_timetable()
+            return {
+                stop_id: timetable.get_departure_candidates(stop_id, query_date, from_secs, query_secs, count)
+                for stop_id in stop_ids
+            }
+        
+        cursor = self.pool.connection().cursor()
+        candidates = {stop_id: [] for stop_id in stop_ids}
+        
+        for start in range(0, len(stop_ids), self.MAX_QUERY_STOPS):
+            chunk = stop_ids[start:start + self.MAX_QUERY_STOPS]
+            
+            # Number the arrivals after query_secs of each stop, the earlier ones are all kept
+            query = f"""
+            WITH stop_arrivals AS (
+                SELECT
+                    st.stop_id,
+                    st.arrival_time,
+                    t.route_id,
+                    t.trip_headsign,
+                    t.trip_id,
+                    st.arrival_secs,
+                    st.stop_sequence,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY st.stop_id, st.arrival_secs > ?
+                        ORDER BY st.arrival_secs
+                    ) AS arrival_number
+                FROM
+                    stop_times st
+                JOIN
+                    trips t ON st.trip_id = t.trip_id
+                JOIN
+                    active_services a ON t.service_id = a.service_id
+                WHERE
+                    st.stop_id IN ({', '.join(['?'] * len(chunk))})
+                    AND st.arrival_secs > ?
+                    AND a.date = ?
+            )
+            SELECT
+                stop_id,
+                arrival_time,
+                route_id,
+                trip_headsign,
+                trip_id,
+                arrival_secs,
+                stop_sequence
+            FROM
+                stop_arrivals
+            WHERE
+                arrival_secs <= ?
+                OR arrival_number <= ?
+            ORDER BY
+                stop_id,
+                arrival_secs;
+            """
+            
+            cursor.execute(query, (query_secs, *chunk, from_secs, query_date, query_secs, count))
+            
+            for stop_id, *bus in cursor.fetchall():
+                candidates[stop_id].append(tuple(bus))
+        
+        return candidates
+    
+    def get_departures(self, stop_ids, realtime, query_date=None, query_time=None, count=1):
+        '''
+        departure board of many stops with the realtime predictions merged in
+        
+        buses scheduled up to DEPARTURE_LOOKBACK seconds earlier and DEPARTURE_PADDING
+        more than count per stop are looked up, then predicted from the trip updates of
+        realtime (a Realtime or FeedSnapshot) and re-sorted by predicted arrival, so a
+        late bus shows up after the buses now ahead of it
+        
+        parameters: stop_ids: stop sign ids
+                    count: how many rows to return per stop
+        
+        return: {stop_id: List[(arrival_time, route_id, trip_headsign, trip_id, predicted_time, delay)]}
+                predicted_time is the HH:MM:SS arrival with the delay in seconds applied,
+                delay is None for a bus without realtime prediction
+        '''
+        if not query_date:
+            query_date = self.get_date()
+        if not query_time:
+            query_time = self.get_time()
+        query_secs = time_to_seconds(query_time)
+        
+        stop_ids = list(dict.fromkeys(stop_ids))
+        candidates = self.get_departure_candidates(
+            stop_ids, query_date, query_secs - self.DEPARTURE_LOOKBACK, query_secs, count + self.DEPARTURE_PADDING
+        )
+        
+        rows = [bus for stop_id in stop_ids for bus in candidates[stop_id]]
+        departures = {stop_id: [] for stop_id in stop_ids}
+        if not rows:
+            return departures
+        
+        stops = np.repeat(np.arange(len(stop_ids)), [len(candidates[stop_id]) for stop_id in stop_ids])
+        scheduled = np.array([bus[4] for bus in rows], dtype=np.int64)
+        
+        # one pass over the trip update index of the snapshot for every candidate
+        delays = realtime.get_delays(
+            [bus[3] for bus in rows],
+            [stop_ids[stop] for stop in stops],
+            [bus[5] for bus in rows],
+            (scheduled + service_day_start(query_date)).tolist(),
+        )
+        has_delay = np.array([delay is not None for delay in delays])
+        predicted = scheduled + np.array([delay or 0 for delay in delays], dtype=np.int64)
+        
+        # by stop then predicted arrival, the first count still to come at each stop
+        order = np.lexsort((predicted, stops))
+        order = order[predicted[order] > query_secs]
+        first = np.searchsorted(stops[order], np.arange(len(stop_ids)))
+        rank = np.arange(len(order)) - first[stops[order]]
+        order = order[rank < count]
+        
+        for row in order.tolist():
+            arrival_time, route_id, trip_headsign, trip_id = rows[row][:4]
+            departures[stop_ids[stops[row]]].append((
+                arrival_time,
+                route_id,
+                trip_headsign,
+                trip_id,
+                seconds_to_time(predicted[row]),
+                int(predicted[row] - scheduled[row]) if has_delay[row] else None,
+            ))
+        
+        return departures
+    
     def haversine(self, lon1, lat1, lon2, lat2):
         # Convert decimal degrees to radians
         lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
@@ -378,43 +1370,93 @@ class GTFS:
         
         return nearby_stops
     """
+    def get_stop_grid(self):
+        '''
+        returns the StopGrid of all stops, loading it from the database once per instance
+        '''
+        if self.stop_grid is None:
+            with self.stop_grid_lock:
+                if self.stop_grid is None:
+                    cursor = self.pool.connection().cursor()
+                    cursor.execute('''
+                        SELECT stop_id, stop_name, stop_lat, stop_lon
+                        FROM stops;
+                    ''')
+                    self.stop_grid = StopGrid(cursor.fetchall())
+        return self.stop_grid
+    
     def get_nearby_bus_stops(self, lon, lat, radius_km=1, limit=0):
-        # Connect to the SQLite database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Fetch all stops
-        query = '''
-            SELECT stop_id, stop_name, stop_lat, stop_lon
-            FROM stops;
         '''
+        return: List[(stop_id, stop_name, stop_lat, stop_lon, distance_km)] within radius_km
+                sorted by distance, only the nearest limit stops if limit > 0
+        '''
+        grid = self.get_stop_grid()
         
-        cursor.execute(query)
-        all_stops = cursor.fetchall()
-        
-        # Close the database connection
-        conn.close()
-        
-        # Filter and sort stops by distance
+        # Filter the stops of the candidate cells by distance
         nearby_stops = []
-        for stop in all_stops:
-            stop_id, stop_name, stop_lat, stop_lon = stop
+        for index in grid.candidates(lon, lat, radius_km):
+            stop_id, stop_name, stop_lat, stop_lon = grid.stops[index]
             distance = self.haversine(lon, lat, stop_lon, stop_lat)
             if distance <= radius_km:
-                nearby_stops.append((stop_id, stop_name, stop_lat, stop_lon, distance))
-        
-        # Sort by distance
-        nearby_stops.sort(key=lambda x: x[4])
+                # the index keeps ties in table order
+                nearby_stops.append((distance, index, (stop_id, stop_name, stop_lat, stop_lon, distance)))
         
-        # Limit results if specified
+        # Sort by distance, or only select the nearest limit stops
         if limit > 0:
-            nearby_stops = nearby_stops[:limit]
+            nearby_stops = heapq.nsmallest(limit, nearby_stops)
+        else:
+            nearby_stops.sort()
         
-        return nearby_stops
+        return [stop for _, _, stop in nearby_stops]
+
+    def get_nearby_bus_stops_many(self, points, radius_km=1, limit=0):
+        '''
+        get_nearby_bus_stops for many points at once, e.g. vehicle positions
+        
+        parameters: points: sequence of (lon, lat)
+        
+        return: one List[(stop_id, stop_name, stop_lat, stop_lon, distance_km)] per point
+        '''
+        grid = self.get_stop_grid()
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        
+        if not grid.stops:
+            return [[] for _ in range(len(points))]
+        
+        # points per distance matrix, bounds the matrix to about BATCH_DISTANCES floats
+        block_size = max(1, self.BATCH_DISTANCES // len(grid.stops))
+        
+        results = []
+        for start in range(0, len(points), block_size):
+            distances = grid.distances(points[start:start + block_size])
+            
+            for row in distances:
+                # stop indexes within the radius
+                nearby = np.flatnonzero(row <= radius_km)
+                
+                # only the nearest limit stops are sorted
+                if 0 < limit < len(nearby):
+                    nearby = nearby[np.argpartition(row[nearby], limit - 1)[:limit]]
+                    nearby.sort()
+                
+                # stable sort keeps ties in table order
+                nearby = nearby[np.argsort(row[nearby], kind='stable')]
+                
+                results.append([(*grid.stops[index], float(row[index])) for index in nearby])
+        
+        return results
 
     def get_all_trip_stops(self, route, direction, query_date=None, query_time=None, offset=0):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Get the current time and date
+        if not query_date:
+            query_date = self.get_date()
+        if not query_time:
+            query_time = self.get_time()
+        
+        if self.backend == 'memory':
+            return self.get_timetable().get_all_trip_stops(route, direction, query_date, time_to_seconds(query_time), offset)
+        
+        cursor = self.pool.connection().cursor()
 
         query = """
         WITH today_trips AS (
@@ -425,21 +1467,21 @@ class GTFS:
                 trips.direction_id
             FROM 
                 trips
-            INNER JOIN calendar_dates ON 
-                trips.service_id = calendar_dates.service_id
+            INNER JOIN active_services ON 
+                trips.service_id = active_services.service_id
             WHERE 
                 trips.route_id = ?
             AND 
                 trips.direction_id = ?
             AND
-                calendar_dates.date = ?
+                active_services.date = ?
         )
         """
         
         query += """
         ,trip_times AS (SELECT 
                 st.trip_id,
-                MIN(st.arrival_time) AS next_arrival_time
+                MIN(st.arrival_secs) AS next_arrival_time
             FROM 
                 stop_times st
             INNER JOIN today_trips tt ON 
@@ -476,32 +1518,31 @@ class GTFS:
         INNER JOIN next_trip nt ON 
             st.trip_id = nt.trip_id
         ORDER BY
-            CAST(st.stop_sequence AS int) ASC
+            st.stop_sequence ASC
         """
-        
-        # Get the current time and date
-        if not query_date:
-            query_date = self.get_date()
-        if not query_time:
-            query_time = self.get_time()
 
         limit = 1
         
         # Execute the query with the specified stop_id and current time/date
-        cursor.execute(query, (route, direction, query_date, query_time, limit, offset))
+        cursor.execute(query, (route, direction, query_date, time_to_seconds(query_time), limit, offset))
                  
         # Fetch all results
         result = cursor.fetchall()
         
-        # Close the database connection
-        conn.close()
-        
         return result
         
     def get_remaining_stops(self, route_id, stop_id, query_date=None, query_time=None):
-        # Connect to the SQLite database
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Get the current time and date
+        if not query_date:
+            query_date = self.get_date()
+        if not query_time:
+            query_time = self.get_time()
+        
+        if self.backend == 'memory':
+            return self.get_timetable().get_remaining_stops(route_id, stop_id, query_date, time_to_seconds(query_time))
+        
+        # Pooled connection of this thread
+        cursor = self.pool.connection().cursor()
         
         # Define the query
         query = """
@@ -513,18 +1554,18 @@ class GTFS:
                 trips.direction_id
             FROM 
                 trips
-            INNER JOIN calendar_dates ON 
-                trips.service_id = calendar_dates.service_id
+            INNER JOIN active_services ON 
+                trips.service_id = active_services.service_id
             WHERE 
                 trips.route_id = ?
             AND
-                calendar_dates.date = ?
+                active_services.date = ?
         ),
         trip_times AS (
             SELECT 
                 st.trip_id,
                 st.stop_id,
-                st.arrival_time AS next_arrival_time,
+                st.arrival_secs AS next_arrival_time,
                 st.stop_sequence
             FROM 
                 stop_times st
@@ -547,13 +1588,12 @@ class GTFS:
             LIMIT 1
         ), 
         target_stop_sequence AS (
+            -- sequence of stop_id within the next trip, a stop can appear at
+            -- different sequences in other trips of the route
             SELECT 
-                CAST(st.stop_sequence AS int) AS target_sequence
+                nt.stop_sequence AS target_sequence
             FROM 
-                stop_times st
-            WHERE 
-                st.stop_id = ?
-            LIMIT 1
+                next_trip nt
         )
         
         SELECT 
@@ -568,26 +1608,17 @@ class GTFS:
         INNER JOIN next_trip nt ON 
             st.trip_id = nt.trip_id
         WHERE
-            CAST(st.stop_sequence AS int) >= (SELECT target_sequence FROM target_stop_sequence)
+            st.stop_sequence >= (SELECT target_sequence FROM target_stop_sequence)
         ORDER BY
-            CAST(st.stop_sequence AS int) ASC;
+            st.stop_sequence ASC;
         """
         
-        # Get the current time and date
-        if not query_date:
-            query_date = self.get_date()
-        if not query_time:
-            query_time = self.get_time()
-        
         # Execute the query with the specified stop_id and current time/date
-        cursor.execute(query, (route_id, query_date, query_time, stop_id, stop_id))
+        cursor.execute(query, (route_id, query_date, time_to_seconds(query_time), stop_id))
         #cursor.execute(query, (current_time))
             
         # Fetch all results
         result = cursor.fetchall()
         
-        # Close the database connection
-        conn.close()
-        
         return result
         
@@ -0,0 +1,203 @@
+"""Benchmarks of the RAPTOR building blocks and engines on a timetable"""
+import argparse
+import random
+from operator import attrgetter
+from time import perf_counter
+
+import numpy as np
+from loguru import logger
+
+from pyraptor.dao.timetable import read_timetable
+from pyraptor.model.compiled import compile_timetable
+from pyraptor.model.kernel import KernelRaptorAlgorithm, raptor_round_numba
+from pyraptor.model.raptor import ArrayRaptorAlgorithm, RaptorAlgorithm
+from pyraptor.model.structures import Route, Stop, Timetable, TripStopTime
+
+
+BENCHMARKS = ("earliest_trip", "engines")
+
+
+def parse_arguments():
+    """Parse arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        default="data/output",
+        help="Input directory",
+    )
+    parser.add_argument(
+        "-n",
+        "--queries",
+        type=int,
+        default=10000,
+        help="Number of lookups per benchmark",
+    )
+    parser.add_argument(
+        "-q",
+        "--raptor-queries",
+        type=int,
+        default=20,
+        help="Number of RAPTOR queries per engine",
+    )
+    parser.add_argument(
+        "-r",
+        "--rounds",
+        type=int,
+        default=5,
+        help="Number of rounds of the RAPTOR queries",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmarks",
+        nargs="+",
+        choices=BENCHMARKS,
+        default=list(BENCHMARKS),
+        help="Benchmarks to run",
+    )
+    parser.add_argument("-s", "--seed", type=int, default=1, help="Random seed")
+    arguments = parser.parse_args()
+    return arguments
+
+
+def main(
+    input_folder: str,
+    n_queries: int,
+    n_raptor_queries: int,
+    rounds: int,
+    benchmarks=BENCHMARKS,
+    seed: int = 1,
+):
+    """Run the benchmarks"""
+
+    logger.debug("Input directory     : {}", input_folder)
+    logger.debug("Queries             : {}", n_queries)
+    logger.debug("RAPTOR queries      : {}", n_raptor_queries)
+    logger.debug("Rounds              : {}", rounds)
+
+    timetable = read_timetable(input_folder)
+    random.seed(seed)
+
+    if "earliest_trip" in benchmarks:
+        benchmark_earliest_trip(timetable, n_queries)
+    if "engines" in benchmarks:
+        benchmark_engines(timetable, n_raptor_queries, rounds)
+
+
+def linear_earliest_trip_stop_time(
+    route: Route, dts_arr: int, stop: Stop
+) -> TripStopTime:
+    """Reference lookup scanning and sorting all trips of the route on every call"""
+    stop_idx = route.stop_index(stop)
+    trip_stop_times = [trip.stop_times[stop_idx] for trip in route.trips]
+    trip_stop_times = [tst for tst in trip_stop_times if tst.dts_dep >= dts_arr]
+    trip_stop_times = sorted(trip_stop_times, key=attrgetter("dts_dep"))
+    return trip_stop_times[0] if len(trip_stop_times) > 0 else None
+
+
+def time_calls(function, queries) -> float:
+    """Mean seconds per call of function over the queries"""
+    start = perf_counter()
+    for query in queries:
+        function(*query)
+    return (perf_counter() - start) / len(queries)
+
+
+def benchmark_earliest_trip(timetable: Timetable, n_queries: int) -> None:
+    """Route.earliest_trip_stop_time against the linear scan on random route stops"""
+    routes = list(timetable.routes)
+    queries = []
+    for _ in range(n_queries):
+        route = random.choice(routes)
+        stop = random.choice(route.stops)
+        dts_arr = random.randint(0, 24 * 3600)
+        queries.append((route, dts_arr, stop))
+
+    mismatches = sum(
+        linear_earliest_trip_stop_time(route, dts_arr, stop)
+        is not route.earliest_trip_stop_time(dts_arr, stop)
+        for route, dts_arr, stop in queries
+    )
+
+    # The departure index is built by the check above, only lookups are timed
+    linear = time_calls(linear_earliest_trip_stop_time, queries)
+    indexed = time_calls(
+        lambda route, dts_arr, stop: route.earliest_trip_stop_time(dts_arr, stop),
+        queries,
+    )
+
+    mean_trips = sum(len(route) for route in routes) / len(routes)
+    logger.info(f"earliest_trip_stop_time, {mean_trips:.0f} trips per route on average")
+    logger.info(f"- Linear scan  : {linear * 1e6:.2f} us")
+    logger.info(f"- Binary search: {indexed * 1e6:.2f} us ({linear / indexed:.1f}x)")
+    logger.info(f"- Mismatches   : {mismatches}")
+
+
+def benchmark_engines(timetable: Timetable, n_queries: int, rounds: int) -> None:
+    """
+    The RAPTOR engines on identical random queries, every engine checked against the
+    labels of the legacy object-based engine
+    """
+    stations = sorted(station.name for station in timetable.stations)
+    queries = [
+        (
+            timetable.stations.get(random.choice(stations)).stops,
+            random.randint(6 * 3600, 20 * 3600),
+            rounds,
+        )
+        for _ in range(n_queries)
+    ]
+
+    start = perf_counter()
+    compiled = compile_timetable(timetable)
+    logger.info(f"Compiled timetable arrays in {perf_counter() - start:.3f} s")
+
+    engines = {
+        "Legacy objects": RaptorAlgorithm(timetable),
+        "Array engine": ArrayRaptorAlgorithm(timetable, compiled),
+        "Kernel, Python": KernelRaptorAlgorithm(timetable, compiled, use_numba=False),
+    }
+    if raptor_round_numba is not None:
+        engines["Kernel, Numba"] = KernelRaptorAlgorithm(timetable, compiled, use_numba=True)
+    else:
+        logger.info("Numba is not installed, skipping the compiled kernel")
+
+    # Logging of the rounds would dominate the timings
+    logger.disable("pyraptor.model")
+    try:
+        # Compiles the Numba kernel before timing
+        for engine in engines.values():
+            engine.run(*queries[0])
+
+        reference = [engines["Legacy objects"].run(*query) for query in queries]
+        logger.info(f"RAPTOR queries, {n_queries} queries of {rounds} rounds")
+        for name, engine in engines.items():
+            start = perf_counter()
+            results = [engine.run(*query) for query in queries]
+            duration = (perf_counter() - start) / n_queries
+
+            mismatches = sum(
+                not all(
+                    np.array_equal(getattr(result, labels), getattr(expected, labels))
+                    for labels in ("earliest_arrival_time", "trip", "from_stop")
+                )
+                for result, expected in zip(results, reference)
+            )
+            logger.info(
+                f"- {name:<15}: {duration * 1e3:.1f} ms per query, mismatches {mismatches}"
+            )
+    finally:
+        logger.enable("pyraptor.model")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(
+        args.input,
+        args.queries,
+        args.raptor_queries,
+        args.rounds,
+        args.benchmarks,
+        args.seed,
+    )
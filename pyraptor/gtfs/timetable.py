@@ -1,6 +1,7 @@
 """Parse timetable from GTFS files"""
 import os
 import argparse
+import zipfile
 from typing import List
 from dataclasses import dataclass
 from collections import defaultdict
@@ -44,7 +45,7 @@ def parse_arguments():
         "--input",
         type=str,
         default="data/input/NL-gtfs",
-        help="Input directory",
+        help="Input directory or GTFS zip file",
     )
     parser.add_argument(
         "-o",
@@ -79,17 +80,36 @@ def main(
     write_timetable(output_folder, timetable)
 
 
+def read_gtfs_file(input_folder: str, file_name: str, **kwargs) -> pd.DataFrame:
+    """
+    Read a GTFS file from a directory of extracted files, or stream it
+    straight from the member of the same name when input_folder is a zip file.
+    """
+    if not os.path.isfile(input_folder):
+        return pd.read_csv(os.path.join(input_folder, file_name), **kwargs)
+
+    with zipfile.ZipFile(input_folder) as feed:
+        # members may sit in a folder inside the zip
+        member = next(
+            info
+            for info in feed.infolist()
+            if os.path.basename(info.filename) == file_name
+        )
+        with feed.open(member) as file:
+            return pd.read_csv(file, **kwargs)
+
+
 def read_gtfs_timetable(
     input_folder: str, departure_date: str, agencies: List[str]
 ) -> GtfsTimetable:
-    """Extract operators from GTFS data"""
+    """Extract operators from GTFS data, input_folder is a directory or a GTFS zip"""
 
     logger.info("Read GTFS data")
 
     # Read agencies
     logger.debug("Read Agencies")
 
-    agencies_df = pd.read_csv(os.path.join(input_folder, "agency.txt"))
+    agencies_df = read_gtfs_file(input_folder, "agency.txt")
     agencies_df = agencies_df.loc[agencies_df["agency_name"].isin(agencies)][
         ["agency_id", "agency_name"]
     ]
@@ -98,7 +118,7 @@ def read_gtfs_timetable(
     # Read routes
     logger.debug("Read Routes")
 
-    routes = pd.read_csv(os.path.join(input_folder, "routes.txt"))
+    routes = read_gtfs_file(input_folder, "routes.txt")
     routes = routes[
         ["route_id", "route_short_name", "route_long_name", "route_type"]
     ]
@@ -106,7 +126,7 @@ def read_gtfs_timetable(
     # Read trips
     logger.debug("Read Trips")
 
-    trips = pd.read_csv(os.path.join(input_folder, "trips.txt"))
+    trips = read_gtfs_file(input_folder, "trips.txt")
     trips = trips[trips.route_id.isin(routes.route_id.values)]
     trips = trips[
         [
@@ -123,9 +143,7 @@ def read_gtfs_timetable(
     # Read calendar
     logger.debug("Read Calendar")
 
-    calendar = pd.read_csv(
-        os.path.join(input_folder, "calendar_dates.txt"), dtype={"date": str}
-    )
+    calendar = read_gtfs_file(input_folder, "calendar_dates.txt", dtype={"date": str})
     calendar = calendar[calendar.service_id.isin(trips.service_id.values)]
 
     # Add date to trips and filter on departure date
@@ -135,8 +153,8 @@ def read_gtfs_timetable(
     # Read stop times
     logger.debug("Read Stop Times")
 
-    stop_times = pd.read_csv(
-        os.path.join(input_folder, "stop_times.txt"), dtype={"stop_id": str}
+    stop_times = read_gtfs_file(
+        input_folder, "stop_times.txt", dtype={"stop_id": str}
     )
     stop_times = stop_times[stop_times.trip_id.isin(trips.trip_id.values)]
     stop_times = stop_times[
@@ -155,9 +173,7 @@ def read_gtfs_timetable(
     # Read stops (platforms)
     logger.debug("Read Stops")
 
-    stops_full = pd.read_csv(
-        os.path.join(input_folder, "stops.txt"), dtype={"stop_id": str}
-    )
+    stops_full = read_gtfs_file(input_folder, "stops.txt", dtype={"stop_id": str})
     stops = stops_full.loc[
         stops_full["stop_id"].isin(stop_times.stop_id.unique())
     ].copy()
@@ -0,0 +1,169 @@
+"""Integer-indexed timetable arrays for the array-based RAPTOR engine"""
+from __future__ import annotations
+
+from dataclasses import dataclass, fields
+from typing import Dict, List
+
+import numpy as np
+from loguru import logger
+
+from pyraptor.model.structures import Timetable
+
+
+@dataclass
+class CompiledTimetable:
+    """
+    Timetable as flat arrays with offset tables, in the layout of the RAPTOR paper.
+
+    Stops are Stop.index (column 0 is unused), routes are numbered in the order of
+    Timetable.routes and trips by their position in the route. Route r has
+    n_trips = route_trip_offsets[r + 1] - route_trip_offsets[r] trips over
+    n_stops = route_stop_offsets[r + 1] - route_stop_offsets[r] stops, with
+    n_trips * n_stops stop times from stop_time_offsets[r].
+    """
+
+    # Stops of route r: route_stops[route_stop_offsets[r]:route_stop_offsets[r + 1]]
+    route_stop_offsets: np.ndarray = None
+    route_stops: np.ndarray = None
+    # Position in the route used to look up a stop of the route, i.e. Route.stop_index,
+    # which differs from the position itself only for stops a route visits twice
+    route_stop_positions: np.ndarray = None
+
+    # Trip.id of trip t of route r: trip_ids[route_trip_offsets[r] + t]
+    route_trip_offsets: np.ndarray = None
+    trip_ids: np.ndarray = None
+
+    # Arrival and departure of trip t at position i of route r, trip-major:
+    # stop_times_arr[stop_time_offsets[r] + t * n_stops + i]
+    stop_time_offsets: np.ndarray = None
+    stop_times_arr: np.ndarray = None
+    stop_times_dep: np.ndarray = None
+
+    # Departures at position i of route r sorted ascending, position-major, and the
+    # trips departing in that order: departures[stop_time_offsets[r] + i * n_trips + j]
+    departures: np.ndarray = None
+    departure_trips: np.ndarray = None
+
+    # Routes serving stop p and the position of p in each, i.e. Routes.get_routes_of_stop:
+    # stop_routes[stop_route_offsets[p]:stop_route_offsets[p + 1]]
+    stop_route_offsets: np.ndarray = None
+    stop_routes: np.ndarray = None
+    stop_route_positions: np.ndarray = None
+
+    # Transfers from stop p to the other stops of its station:
+    # transfer_stops[transfer_offsets[p]:transfer_offsets[p + 1]]
+    transfer_offsets: np.ndarray = None
+    transfer_stops: np.ndarray = None
+    transfer_times: np.ndarray = None
+
+    @property
+    def n_stops(self) -> int:
+        """Number of stop columns, one more than the largest Stop.index"""
+        return len(self.stop_route_offsets) - 1
+
+    @property
+    def n_routes(self) -> int:
+        """Number of routes"""
+        return len(self.route_stop_offsets) - 1
+
+    def lists(self) -> Dict[str, List[int]]:
+        """The arrays as Python lists, which index faster in interpreted loops"""
+        lists = getattr(self, "_lists", None)
+        if lists is None:
+            lists = {f.name: getattr(self, f.name).tolist() for f in fields(self)}
+            self._lists = lists
+        return lists
+
+    @classmethod
+    def from_timetable(cls, timetable: Timetable) -> CompiledTimetable:
+        """Compile the arrays of a Timetable"""
+        logger.debug("Compile timetable arrays")
+
+        n_stops = max((stop.index for stop in timetable.stops), default=0) + 1
+        routes = list(timetable.routes)
+        route_number = {route: r for r, route in enumerate(routes)}
+
+        route_stop_offsets = [0]
+        route_stops = []
+        route_stop_positions = []
+        route_trip_offsets = [0]
+        trip_ids = []
+        stop_time_offsets = [0]
+        stop_times_arr = []
+        stop_times_dep = []
+        departures = []
+        departure_trips = []
+
+        for route in routes:
+            route_stops.extend(stop.index for stop in route.stops)
+            route_stop_positions.extend(route.stop_index(stop) for stop in route.stops)
+            route_stop_offsets.append(len(route_stops))
+
+            trip_ids.extend(trip.id for trip in route.trips)
+            route_trip_offsets.append(len(trip_ids))
+
+            for trip in route.trips:
+                stop_times_arr.extend(tst.dts_arr for tst in trip.stop_times)
+                stop_times_dep.extend(tst.dts_dep for tst in trip.stop_times)
+            stop_time_offsets.append(len(stop_times_arr))
+
+            # Same order as Route.departure_index, so ties resolve to the same trip
+            route_departures, route_departure_trips = route.departure_index()
+            trip_position = {trip: t for t, trip in enumerate(route.trips)}
+            for stop_departures, stop_trips in zip(route_departures, route_departure_trips):
+                departures.extend(stop_departures)
+                departure_trips.extend(trip_position[trip] for trip in stop_trips)
+
+        stop_route_offsets = [0] * (n_stops + 1)
+        stop_routes = []
+        stop_route_positions = []
+        transfer_offsets = [0] * (n_stops + 1)
+        transfer_stops = []
+        transfer_times = []
+        stop_by_index = {stop.index: stop for stop in timetable.stops}
+
+        for p in range(n_stops):
+            stop = stop_by_index.get(p)
+            if stop is not None:
+                for route in timetable.routes.get_routes_of_stop(stop):
+                    stop_routes.append(route_number[route])
+                    stop_route_positions.append(route.stop_index(stop))
+
+                for other_stop in stop.station.stops:
+                    if other_stop != stop:
+                        transfer = timetable.transfers.stop_to_stop_idx[(stop, other_stop)]
+                        transfer_stops.append(other_stop.index)
+                        transfer_times.append(transfer.layovertime)
+            stop_route_offsets[p + 1] = len(stop_routes)
+            transfer_offsets[p + 1] = len(transfer_stops)
+
+        def int_array(values):
+            return np.array(values, dtype=np.int64)
+
+        return cls(
+            route_stop_offsets=int_array(route_stop_offsets),
+            route_stops=int_array(route_stops),
+            route_stop_positions=int_array(route_stop_positions),
+            route_trip_offsets=int_array(route_trip_offsets),
+            trip_ids=int_array(trip_ids),
+            stop_time_offsets=int_array(stop_time_offsets),
+            stop_times_arr=int_array(stop_times_arr),
+            stop_times_dep=int_array(stop_times_dep),
+            departures=int_array(departures),
+            departure_trips=int_array(departure_trips),
+            stop_route_offsets=int_array(stop_route_offsets),
+            stop_routes=int_array(stop_routes),
+            stop_route_positions=int_array(stop_route_positions),
+            transfer_offsets=int_array(transfer_offsets),
+            transfer_stops=int_array(transfer_stops),
+            transfer_times=int_array(transfer_times),
+        )
+
+
+def compile_timetable(timetable: Timetable) -> CompiledTimetable:
+    """CompiledTimetable of a timetable, compiled on first use and kept on the timetable"""
+    compiled = getattr(timetable, "compiled", None)
+    if compiled is None:
+        compiled = CompiledTimetable.from_timetable(timetable)
+        timetable.compiled = compiled
+    return compiled
@@ -0,0 +1,274 @@
+"""RAPTOR round kernel on the compiled timetable arrays, compiled with Numba when installed"""
+from __future__ import annotations
+
+import numpy as np
+from loguru import logger
+
+from pyraptor.model.compiled import CompiledTimetable, compile_timetable
+from pyraptor.model.raptor import LabelStore
+from pyraptor.model.structures import Timetable
+from pyraptor.util import LARGE_NUMBER, NO_INDEX
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# Arrays of CompiledTimetable passed to raptor_round, in argument order
+KERNEL_ARRAYS = (
+    "route_stop_offsets",
+    "route_stops",
+    "route_stop_positions",
+    "route_trip_offsets",
+    "trip_ids",
+    "stop_time_offsets",
+    "stop_times_arr",
+    "stop_times_dep",
+    "departures",
+    "departure_trips",
+    "stop_route_offsets",
+    "stop_routes",
+    "stop_route_positions",
+    "transfer_offsets",
+    "transfer_stops",
+    "transfer_times",
+)
+
+
+def raptor_round(
+    route_stop_offsets,
+    route_stops,
+    route_stop_positions,
+    route_trip_offsets,
+    trip_ids,
+    stop_time_offsets,
+    stop_times_arr,
+    stop_times_dep,
+    departures,
+    departure_trips,
+    stop_route_offsets,
+    stop_routes,
+    stop_route_positions,
+    transfer_offsets,
+    transfer_stops,
+    transfer_times,
+    marked_stops,
+    n_marked,
+    arrival,
+    trip,
+    from_stop,
+    best,
+    boarding,
+    route_queue,
+    route_positions,
+    new_marked_stops,
+    is_marked,
+):
+    """
+    One full RAPTOR round over the compiled arrays, the same steps as
+    ArrayRaptorAlgorithm: accumulate the marked routes, traverse them and add the
+    transfers, updating arrival, trip, from_stop and best in place.
+
+    Written for Numba and runs unchanged on Python lists. route_positions must be
+    NO_INDEX for every route and is_marked False for every stop, both are left so.
+
+    :param marked_stops: the first n_marked stops are marked, in marking order
+    :param boarding: arrivals of the previous round trips are caught from, so round k
+        holds journeys of at most k trips, the arrivals changed in this round are
+        copied into it at the end
+    :param route_queue, route_positions: scratch of n_routes entries
+    :param new_marked_stops, is_marked: scratch of n_stops entries, receives the
+        stops marked for the next round
+    :return: number of stops in new_marked_stops
+    """
+
+    # Accumulate routes serving marked stops with their first marked position, i.e. Q,
+    # in the order the routes are first marked
+    n_routes = 0
+    for m in range(n_marked):
+        p = marked_stops[m]
+        for i in range(stop_route_offsets[p], stop_route_offsets[p + 1]):
+            route = stop_routes[i]
+            position = stop_route_positions[i]
+            if route_positions[route] == NO_INDEX:
+                route_queue[n_routes] = route
+                n_routes += 1
+                route_positions[route] = position
+            elif route_positions[route] > position:
+                route_positions[route] = position
+
+    # Traverse each route from its first marked position
+    n_new = 0
+    for r in range(n_routes):
+        route = route_queue[r]
+        first_position = route_positions[route]
+        route_positions[route] = NO_INDEX
+
+        stops_start = route_stop_offsets[route]
+        n_stops = route_stop_offsets[route + 1] - stops_start
+        trips_start = route_trip_offsets[route]
+        n_trips = route_trip_offsets[route + 1] - trips_start
+        times_start = stop_time_offsets[route]
+
+        current_trip = NO_INDEX
+        boarding_stop = NO_INDEX
+        for i in range(stops_start + first_position, stops_start + n_stops):
+            p = route_stops[i]
+            position = route_stop_positions[i]
+
+            if current_trip != NO_INDEX:
+                new_arrival_time = stop_times_arr[
+                    times_start + current_trip * n_stops + position
+                ]
+                if new_arrival_time < best[p]:
+                    arrival[p] = new_arrival_time
+                    trip[p] = trip_ids[trips_start + current_trip]
+                    from_stop[p] = boarding_stop
+                    best[p] = new_arrival_time
+                    if not is_marked[p]:
+                        is_marked[p] = True
+                        new_marked_stops[n_new] = p
+                        n_new += 1
+
+            # Can we catch an earlier trip at p, i.e. the first departure >= arrival,
+            # not if we reach p after the current trip has left
+            if (
+                current_trip != NO_INDEX
+                and boarding[p]
+                > stop_times_dep[times_start + current_trip * n_stops + position]
+            ):
+                continue
+            lo = times_start + position * n_trips
+            hi = lo + n_trips
+            end = hi
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if departures[mid] < boarding[p]:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < end:
+                current_trip = departure_trips[lo]
+                boarding_stop = p
+
+    # Transfers between platforms from the stops reached by trip, the trip of a label is kept
+    n_trip_marked = n_new
+    for m in range(n_trip_marked):
+        p = new_marked_stops[m]
+        time_sofar = arrival[p]
+        for i in range(transfer_offsets[p], transfer_offsets[p + 1]):
+            q = transfer_stops[i]
+            new_earliest_arrival = time_sofar + transfer_times[i]
+            if new_earliest_arrival < best[q]:
+                arrival[q] = new_earliest_arrival
+                from_stop[q] = p
+                best[q] = new_earliest_arrival
+                if not is_marked[q]:
+                    is_marked[q] = True
+                    new_marked_stops[n_new] = q
+                    n_new += 1
+
+    for m in range(n_new):
+        p = new_marked_stops[m]
+        is_marked[p] = False
+        boarding[p] = arrival[p]
+
+    return n_new
+
+
+raptor_round_numba = njit(cache=True)(raptor_round) if njit is not None else None
+
+
+class KernelRaptorAlgorithm:
+    """
+    RAPTOR Algorithm running every round with raptor_round, compiled by Numba when it
+    is installed and use_numba is not False, or else interpreted on Python lists
+    """
+
+    def __init__(
+        self,
+        timetable: Timetable,
+        compiled: CompiledTimetable = None,
+        use_numba: bool = None,
+    ):
+        self.timetable = timetable
+        self.compiled = compiled if compiled is not None else compile_timetable(timetable)
+        self.bag_star = None
+
+        if use_numba and raptor_round_numba is None:
+            raise ImportError("Numba is not installed")
+        self.use_numba = raptor_round_numba is not None and use_numba is not False
+
+        if self.use_numba:
+            self.kernel = raptor_round_numba
+            self.arrays = [getattr(self.compiled, name) for name in KERNEL_ARRAYS]
+        else:
+            self.kernel = raptor_round
+            lists = self.compiled.lists()
+            self.arrays = [lists[name] for name in KERNEL_ARRAYS]
+
+    def buffer(self, size: int, value):
+        """Label or scratch buffer of the kernel"""
+        if self.use_numba:
+            dtype = np.bool_ if isinstance(value, bool) else np.int64
+            return np.full(size, value, dtype=dtype)
+        return [value] * size
+
+    def run(self, from_stops, dep_secs, rounds) -> LabelStore:
+        """Run Round-Based Algorithm"""
+
+        bag_round_stop = LabelStore(self.timetable, rounds)
+
+        n_stops = self.compiled.n_stops
+        n_routes = self.compiled.n_routes
+        arrival = self.buffer(n_stops, LARGE_NUMBER)
+        trip = self.buffer(n_stops, NO_INDEX)
+        from_stop = self.buffer(n_stops, NO_INDEX)
+        best = self.buffer(n_stops, LARGE_NUMBER)
+        boarding = self.buffer(n_stops, LARGE_NUMBER)
+        marked_stops = self.buffer(n_stops, NO_INDEX)
+        new_marked_stops = self.buffer(n_stops, NO_INDEX)
+        is_marked = self.buffer(n_stops, False)
+        route_queue = self.buffer(n_routes, NO_INDEX)
+        route_positions = self.buffer(n_routes, NO_INDEX)
+
+        logger.debug(f"Starting from Stop IDs: {str(from_stops)}")
+        n_marked = 0
+        for stop in from_stops:
+            arrival[stop.index] = dep_secs
+            best[stop.index] = dep_secs
+            boarding[stop.index] = dep_secs
+            marked_stops[n_marked] = stop.index
+            n_marked += 1
+        bag_round_stop.earliest_arrival_time[0] = arrival
+
+        for k in range(1, rounds + 1):
+            logger.info(f"Analyzing possibilities round {k}")
+
+            if n_marked > 0:
+                n_marked = self.kernel(
+                    *self.arrays,
+                    marked_stops,
+                    n_marked,
+                    arrival,
+                    trip,
+                    from_stop,
+                    best,
+                    boarding,
+                    route_queue,
+                    route_positions,
+                    new_marked_stops,
+                    is_marked,
+                )
+                marked_stops, new_marked_stops = new_marked_stops, marked_stops
+                logger.debug(f"{n_marked} stops to evaluate in next round")
+
+            bag_round_stop.earliest_arrival_time[k] = arrival
+            bag_round_stop.trip[k] = trip
+            bag_round_stop.from_stop[k] = from_stop
+
+        self.bag_star = np.array(best, dtype=np.int64)
+        logger.info("Finish round-based algorithm to create bag with best labels")
+
+        return bag_round_stop
@@ -1,14 +1,16 @@
 """RAPTOR algorithm"""
 from __future__ import annotations
-from typing import List, Tuple, Dict
+from typing import Iterator, List, Tuple
 from dataclasses import dataclass
-from copy import deepcopy
+from bisect import bisect_left
 
+import numpy as np
 from loguru import logger
 
 from pyraptor.dao.timetable import Timetable
 from pyraptor.model.structures import Stop, Trip, Route, Leg, Journey
-from pyraptor.util import LARGE_NUMBER, TRANSFER_TRIP
+from pyraptor.model.compiled import CompiledTimetable, compile_timetable
+from pyraptor.util import LARGE_NUMBER, NO_INDEX
 
 
 @dataclass
@@ -36,40 +38,100 @@ class Label:
         return f"Label(earliest_arrival_time={self.earliest_arrival_time}, trip={self.trip}, from_stop={self.from_stop})"
 
 
+class LabelStore:
+    """
+    Labels of all rounds and stops in integer arrays of shape (rounds + 1, n_stops),
+    updated in place. Columns are Stop.index, trips are stored by Trip.id and
+    NO_INDEX stands for no trip or stop.
+    """
+
+    def __init__(self, timetable: Timetable, rounds: int):
+        self.timetable = timetable
+
+        # Stop indexes start at 1, column 0 is never used
+        n_stops = max((stop.index for stop in timetable.stops), default=0) + 1
+        shape = (rounds + 1, n_stops)
+        self.earliest_arrival_time = np.full(shape, LARGE_NUMBER, dtype=np.int64)
+        self.trip = np.full(shape, NO_INDEX, dtype=np.int64)
+        self.from_stop = np.full(shape, NO_INDEX, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.earliest_arrival_time)
+
+    def __getitem__(self, k: int) -> RoundLabels:
+        return RoundLabels(self, k)
+
+    def copy_round(self, k_from: int, k_to: int) -> None:
+        """Start round k_to from the labels of round k_from"""
+        self.earliest_arrival_time[k_to] = self.earliest_arrival_time[k_from]
+        self.trip[k_to] = self.trip[k_from]
+        self.from_stop[k_to] = self.from_stop[k_from]
+
+    def label(self, k: int, stop_index: int) -> Label:
+        """Label of a stop index in round k"""
+        trip_id = int(self.trip[k, stop_index])
+        from_stop = int(self.from_stop[k, stop_index])
+        return Label(
+            earliest_arrival_time=int(self.earliest_arrival_time[k, stop_index]),
+            trip=self.timetable.trips[trip_id] if trip_id != NO_INDEX else None,
+            from_stop=self.timetable.stops.get_by_index(from_stop)
+            if from_stop != NO_INDEX
+            else None,
+        )
+
+
+class RoundLabels:
+    """Labels of one round of a LabelStore by Stop, i.e. B_k"""
+
+    def __init__(self, store: LabelStore, k: int):
+        self.store = store
+        self.k = k
+
+    def __getitem__(self, stop: Stop) -> Label:
+        return self.store.label(self.k, stop.index)
+
+    def __len__(self):
+        return len(self.store.timetable.stops)
+
+    def __iter__(self):
+        return iter(self.store.timetable.stops)
+
+    def items(self):
+        """(Stop, Label) of all stops"""
+        return ((stop, self[stop]) for stop in self)
+
+
 class RaptorAlgorithm:
     """RAPTOR Algorithm"""
 
     def __init__(self, timetable: Timetable):
         self.timetable = timetable
+        # Earliest arrival time per Stop.index over all rounds, i.e. t*
         self.bag_star = None
 
-    def run(self, from_stops, dep_secs, rounds) -> Dict[int, Dict[Stop, Label]]:
+    def run(self, from_stops, dep_secs, rounds) -> LabelStore:
         """Run Round-Based Algorithm"""
 
         # Initialize empty bag of labels, i.e. B_k(p) = Label() for every k and p
-        bag_round_stop: Dict[int, Dict[Stop, Label]] = {}
-        for k in range(0, rounds + 1):
-            bag_round_stop[k] = {}
-            for p in self.timetable.stops:
-                bag_round_stop[k][p] = Label()
+        bag_round_stop = LabelStore(self.timetable, rounds)
 
         # Initialize bag with earliest arrival tiems
-        self.bag_star = {}
-        for p in self.timetable.stops:
-            self.bag_star[p] = Label()
+        self.bag_star = np.full(
+            bag_round_stop.earliest_arrival_time.shape[1], LARGE_NUMBER, dtype=np.int64
+        )
 
         # Initialize bag with start node taking DEP_SECS seconds to reach
         logger.debug(f"Starting from Stop IDs: {str(from_stops)}")
         marked_stops = []
         for from_stop in from_stops:
-            bag_round_stop[0][from_stop].update(dep_secs, None, None)
-            self.bag_star[from_stop].update(dep_secs, None, None)
+            bag_round_stop.earliest_arrival_time[0, from_stop.index] = dep_secs
+            self.bag_star[from_stop.index] = dep_secs
             marked_stops.append(from_stop)
 
         # Run rounds
         for k in range(1, rounds + 1):
             logger.info(f"Analyzing possibilities round {k}")
-            bag_round_stop[k] = deepcopy(bag_round_stop[k - 1])
+            bag_round_stop.copy_round(k - 1, k)
 
             # Get list of stops to evaluate in the process
             logger.debug(f"Stops to evaluate count: {len(marked_stops)}")
@@ -90,9 +152,13 @@ class RaptorAlgorithm:
                 )
                 logger.debug(f"{len(marked_transfer_stops)} transferable stops added")
 
-                marked_stops = set(marked_trip_stops).union(marked_transfer_stops)
+                # Ordered, so the routes are scanned in the same order on every run
+                marked_stops = list(dict.fromkeys(marked_trip_stops + marked_transfer_stops))
                 logger.debug(f"{len(marked_stops)} stops to evaluate in next round")
             else:
+                # Nothing can improve anymore, the later rounds keep these labels
+                for k_next in range(k + 1, rounds + 1):
+                    bag_round_stop.copy_round(k, k_next)
                 break
 
         logger.info("Finish round-based algorithm to create bag with best labels")   
@@ -118,22 +184,29 @@ class RaptorAlgorithm:
 
     def traverse_routes(
         self,
-        bag_round_stop: Dict[int, Dict[Stop, Label]],
+        bag_round_stop: LabelStore,
         k: int,
         route_marked_stops: List[Tuple[Route, Stop]],
     ) -> Tuple:
         """
         Iterator through the stops reachable and add all new reachable stops
         by following all trips from the reached stations. Trips are only followed
-        in the direction of travel and beyond already added points.
+        in the direction of travel and beyond already added points. Trips are caught
+        from the labels of round k - 1, so round k holds journeys of at most k trips.
 
-        :param bag_round_stop: Bag per round per stop
+        :param bag_round_stop: Labels per round per stop
         :param k: current round
         :param route_marked_stops: list of marked (route, stop) for evaluation
         """
         logger.debug(f"Traverse routes for round {k}")
 
-        bag_round_stop = deepcopy(bag_round_stop)
+        # Labels of round k, updated in place, and of round k - 1 to catch trips from
+        arrival_k = bag_round_stop.earliest_arrival_time[k]
+        arrival_previous = bag_round_stop.earliest_arrival_time[k - 1]
+        trip_k = bag_round_stop.trip[k]
+        from_stop_k = bag_round_stop.from_stop[k]
+        bag_star = self.bag_star
+
         new_stops = []
         n_evaluations = 0
         n_improvements = 0
@@ -152,36 +225,38 @@ class RaptorAlgorithm:
             for current_stop_index, current_stop in enumerate(remaining_stops_in_route):
                 # Can the label be improved in this round?
                 n_evaluations += 1
+                p = current_stop.index
 
                 # t != _|_
                 if current_trip is not None:
                     # Arrival time at stop, i.e. arr(current_trip, next_stop)
                     new_arrival_time = current_trip.get_stop(current_stop).dts_arr
-                    best_arrival_time = self.bag_star[
-                        current_stop
-                    ].earliest_arrival_time
+                    best_arrival_time = bag_star[p]
 
                     if new_arrival_time < best_arrival_time:
                         # Update arrival by trip, i.e.
                         #   t_k(next_stop) = t_arr(t, pi)
                         #   t_star(p_i) = t_arr(t, pi)
 
-                        bag_round_stop[k][current_stop].update(
-                            new_arrival_time, current_trip, boarding_stop
-                        )
-                        self.bag_star[current_stop].update(
-                            new_arrival_time, current_trip, boarding_stop
-                        )
+                        arrival_k[p] = new_arrival_time
+                        trip_k[p] = current_trip.id
+                        from_stop_k[p] = boarding_stop.index
+                        bag_star[p] = new_arrival_time
 
                         # Logging
                         n_improvements += 1
                         new_stops.append(current_stop)
 
                 # Can we catch an earlier trip at p_i
-                # if tau_{k-1}(next_stop) <= tau_dep(t, next_stop)
-                previous_earliest_arrival_time = bag_round_stop[k][
-                    current_stop
-                ].earliest_arrival_time
+                # if tau_{k-1}(next_stop) <= tau_dep(t, next_stop), not if we reach
+                # p_i after the current trip has left
+                previous_earliest_arrival_time = int(arrival_previous[p])
+                if (
+                    current_trip is not None
+                    and previous_earliest_arrival_time
+                    > current_trip.get_stop(current_stop).dts_dep
+                ):
+                    continue
                 earliest_trip_stop_time = marked_route.earliest_trip_stop_time(
                     previous_earliest_arrival_time, current_stop
                 )
@@ -200,18 +275,22 @@ class RaptorAlgorithm:
 
     def add_transfer_time(
         self,
-        bag_round_stop: Dict[int, Dict[Stop, Label]],
+        bag_round_stop: LabelStore,
         k: int,
         marked_stops: List[Stop],
     ) -> Tuple:
         """
         Add transfers between platforms.
 
-        :param bag_round_stop: Label per round per stop
+        :param bag_round_stop: Labels per round per stop
         :param k: current round
         :param marked_stops: list of marked stops for evaluation
         """
 
+        arrival_k = bag_round_stop.earliest_arrival_time[k]
+        from_stop_k = bag_round_stop.from_stop[k]
+        bag_star = self.bag_star
+
         new_stops = []
 
         # Add in transfers to other platforms
@@ -220,25 +299,19 @@ class RaptorAlgorithm:
                 st for st in current_stop.station.stops if st != current_stop
             ]
 
-            time_sofar = bag_round_stop[k][current_stop].earliest_arrival_time
+            time_sofar = int(arrival_k[current_stop.index])
             for arrive_stop in other_station_stops:
                 new_earliest_arrival = time_sofar + self.get_transfer_time(
                     current_stop, arrive_stop
                 )
-                previous_earliest_arrival = self.bag_star[
-                    arrive_stop
-                ].earliest_arrival_time
+                previous_earliest_arrival = bag_star[arrive_stop.index]
 
                 # Domination criteria
                 if new_earliest_arrival < previous_earliest_arrival:
-                    bag_round_stop[k][arrive_stop].update(
-                        new_earliest_arrival,
-                        TRANSFER_TRIP,
-                        current_stop,
-                    )
-                    self.bag_star[arrive_stop].update(
-                        new_earliest_arrival, TRANSFER_TRIP, current_stop
-                    )
+                    # The trip of the label is kept, a transfer leg has no trip of its own
+                    arrival_k[arrive_stop.index] = new_earliest_arrival
+                    from_stop_k[arrive_stop.index] = current_stop.index
+                    bag_star[arrive_stop.index] = new_earliest_arrival
                     new_stops.append(arrive_stop)
 
         return bag_round_stop, new_stops
@@ -251,29 +324,296 @@ class RaptorAlgorithm:
         return transfers.stop_to_stop_idx[(stop_from, stop_to)].layovertime
 
 
-def best_stop_at_target_station(to_stops: List[Stop], bag: Dict[Stop, Label]) -> Stop:
+class ArrayRaptorAlgorithm:
+    """
+    RAPTOR Algorithm on the arrays of a CompiledTimetable, finds the same labels
+    as RaptorAlgorithm with plain integer lookups instead of Stop, Route and Trip objects
+    """
+
+    def __init__(self, timetable: Timetable, compiled: CompiledTimetable = None):
+        self.timetable = timetable
+        self.compiled = compiled if compiled is not None else compile_timetable(timetable)
+        self.bag_star = None
+
+        # Python lists index faster than NumPy arrays in the interpreted loops below
+        self.arrays = self.compiled.lists()
+
+    def run(self, from_stops, dep_secs, rounds) -> LabelStore:
+        """Run Round-Based Algorithm"""
+
+        bag_round_stop = LabelStore(self.timetable, rounds)
+
+        # Labels of the current round, arrivals of the previous round and earliest
+        # arrival times over all rounds
+        n_stops = self.compiled.n_stops
+        arrival = [LARGE_NUMBER] * n_stops
+        trip = [NO_INDEX] * n_stops
+        from_stop = [NO_INDEX] * n_stops
+        best = [LARGE_NUMBER] * n_stops
+
+        logger.debug(f"Starting from Stop IDs: {str(from_stops)}")
+        marked_stops = []
+        for stop in from_stops:
+            arrival[stop.index] = dep_secs
+            best[stop.index] = dep_secs
+            marked_stops.append(stop.index)
+        bag_round_stop.earliest_arrival_time[0] = arrival
+        boarding = list(arrival)
+
+        for k in range(1, rounds + 1):
+            logger.info(f"Analyzing possibilities round {k}")
+
+            if len(marked_stops) > 0:
+                route_marked_positions = self.accumulate_routes(marked_stops)
+                marked_trip_stops = self.traverse_routes(
+                    route_marked_positions, arrival, trip, from_stop, best, boarding
+                )
+                marked_transfer_stops = self.add_transfer_time(
+                    marked_trip_stops, arrival, from_stop, best
+                )
+                marked_stops = list(dict.fromkeys(marked_trip_stops + marked_transfer_stops))
+                logger.debug(f"{len(marked_stops)} stops to evaluate in next round")
+
+                # Only the marked stops changed in this round
+                for p in marked_stops:
+                    boarding[p] = arrival[p]
+
+            bag_round_stop.earliest_arrival_time[k] = arrival
+            bag_round_stop.trip[k] = trip
+            bag_round_stop.from_stop[k] = from_stop
+
+        self.bag_star = np.array(best, dtype=np.int64)
+        logger.info("Finish round-based algorithm to create bag with best labels")
+
+        return bag_round_stop
+
+    def accumulate_routes(self, marked_stops: List[int]) -> List[Tuple[int, int]]:
+        """Accumulate (route, first marked position) of routes serving marked stops, i.e. Q"""
+        stop_route_offsets = self.arrays["stop_route_offsets"]
+        stop_routes = self.arrays["stop_routes"]
+        stop_route_positions = self.arrays["stop_route_positions"]
+
+        route_marked_positions = {}
+        for p in marked_stops:
+            for i in range(stop_route_offsets[p], stop_route_offsets[p + 1]):
+                route = stop_routes[i]
+                position = stop_route_positions[i]
+                current = route_marked_positions.get(route)
+                if current is None or current > position:
+                    route_marked_positions[route] = position
+
+        return list(route_marked_positions.items())
+
+    def traverse_routes(
+        self,
+        route_marked_positions: List[Tuple[int, int]],
+        arrival: List[int],
+        trip: List[int],
+        from_stop: List[int],
+        best: List[int],
+        boarding: List[int],
+    ) -> List[int]:
+        """
+        Follow the earliest trip catchable along each marked route from its first
+        marked position, updating the labels of the round in place.
+
+        :param boarding: arrivals of the previous round, trips are caught from these
+            so round k holds journeys of at most k trips
+        """
+        route_stop_offsets = self.arrays["route_stop_offsets"]
+        route_stops = self.arrays["route_stops"]
+        route_stop_positions = self.arrays["route_stop_positions"]
+        route_trip_offsets = self.arrays["route_trip_offsets"]
+        trip_ids = self.arrays["trip_ids"]
+        stop_time_offsets = self.arrays["stop_time_offsets"]
+        stop_times_arr = self.arrays["stop_times_arr"]
+        stop_times_dep = self.arrays["stop_times_dep"]
+        departures = self.arrays["departures"]
+        departure_trips = self.arrays["departure_trips"]
+
+        new_stops = []
+        for route, first_position in route_marked_positions:
+            stops_start = route_stop_offsets[route]
+            n_stops = route_stop_offsets[route + 1] - stops_start
+            trips_start = route_trip_offsets[route]
+            n_trips = route_trip_offsets[route + 1] - trips_start
+            times_start = stop_time_offsets[route]
+
+            current_trip = NO_INDEX
+            boarding_stop = NO_INDEX
+            for i in range(stops_start + first_position, stops_start + n_stops):
+                p = route_stops[i]
+                position = route_stop_positions[i]
+
+                if current_trip != NO_INDEX:
+                    new_arrival_time = stop_times_arr[
+                        times_start + current_trip * n_stops + position
+                    ]
+                    if new_arrival_time < best[p]:
+                        arrival[p] = new_arrival_time
+                        trip[p] = trip_ids[trips_start + current_trip]
+                        from_stop[p] = boarding_stop
+                        best[p] = new_arrival_time
+                        new_stops.append(p)
+
+                # Can we catch an earlier trip at p, not if we reach p after the
+                # current trip has left
+                if (
+                    current_trip != NO_INDEX
+                    and boarding[p]
+                    > stop_times_dep[times_start + current_trip * n_stops + position]
+                ):
+                    continue
+                lo = times_start + position * n_trips
+                hi = lo + n_trips
+                j = bisect_left(departures, boarding[p], lo, hi)
+                if j < hi:
+                    current_trip = departure_trips[j]
+                    boarding_stop = p
+
+        return new_stops
+
+    def add_transfer_time(
+        self,
+        marked_stops: List[int],
+        arrival: List[int],
+        from_stop: List[int],
+        best: List[int],
+    ) -> List[int]:
+        """Add transfers between platforms, the trip of a label is kept"""
+        transfer_offsets = self.arrays["transfer_offsets"]
+        transfer_stops = self.arrays["transfer_stops"]
+        transfer_times = self.arrays["transfer_times"]
+
+        new_stops = []
+        for p in marked_stops:
+            time_sofar = arrival[p]
+            for i in range(transfer_offsets[p], transfer_offsets[p + 1]):
+                q = transfer_stops[i]
+                new_earliest_arrival = time_sofar + transfer_times[i]
+                if new_earliest_arrival < best[q]:
+                    arrival[q] = new_earliest_arrival
+                    from_stop[q] = p
+                    best[q] = new_earliest_arrival
+                    new_stops.append(q)
+
+        return new_stops
+
+
+class RangeRaptorAlgorithm(ArrayRaptorAlgorithm):
+    """
+    rRAPTOR: profile search over several departure times, latest first, keeping the
+    labels of every round between departures. The labels of a later departure are
+    valid for an earlier one (wait at the origin), so each departure only scans the
+    routes of the stops it improves. As in every engine trips are caught from the
+    labels of the previous round, so round k holds the earliest arrivals with at most
+    k trips. Without overtaking trips each departure finds the labels of a standalone
+    ArrayRaptorAlgorithm run.
+    """
+
+    def run_range(
+        self, from_stops, dep_secs_list, rounds
+    ) -> Iterator[Tuple[int, LabelStore, List[Stop]]]:
+        """
+        Run Round-Based Algorithm for each departure time, latest first.
+
+        Yields (dep_secs, bag_round_stop, improved_stops) after each departure time,
+        improved_stops are the stops whose label of the last round this departure
+        improved. bag_round_stop is the same LabelStore every time, updated in place
+        by the next departure.
+        """
+        bag_round_stop = LabelStore(self.timetable, rounds)
+
+        # Labels of every round, kept between departures
+        n_stops = self.compiled.n_stops
+        arrival = [[LARGE_NUMBER] * n_stops for _ in range(rounds + 1)]
+        trip = [[NO_INDEX] * n_stops for _ in range(rounds + 1)]
+        from_stop = [[NO_INDEX] * n_stops for _ in range(rounds + 1)]
+
+        for dep_secs in sorted(set(dep_secs_list), reverse=True):
+            logger.debug(f"Analyzing departure time {dep_secs}")
+
+            # Stops to scan the routes of, and stops whose label changed in the last round
+            marked_stops = []
+            for stop in from_stops:
+                if dep_secs < arrival[0][stop.index]:
+                    arrival[0][stop.index] = dep_secs
+                    marked_stops.append(stop.index)
+            changed_stops = list(marked_stops)
+            self.write_labels(bag_round_stop, 0, changed_stops, arrival, trip, from_stop)
+
+            for k in range(1, rounds + 1):
+                arrival_k, trip_k, from_stop_k = arrival[k], trip[k], from_stop[k]
+
+                # Round k starts from round k - 1, which only changed at changed_stops
+                copied_stops = []
+                for p in changed_stops:
+                    if arrival[k - 1][p] < arrival_k[p]:
+                        arrival_k[p] = arrival[k - 1][p]
+                        trip_k[p] = trip[k - 1][p]
+                        from_stop_k[p] = from_stop[k - 1][p]
+                        copied_stops.append(p)
+
+                if len(marked_stops) > 0:
+                    route_marked_positions = self.accumulate_routes(marked_stops)
+                    # A label only has to beat the label of its own round, which may
+                    # come from a later departure
+                    marked_trip_stops = self.traverse_routes(
+                        route_marked_positions,
+                        arrival_k,
+                        trip_k,
+                        from_stop_k,
+                        arrival_k,
+                        arrival[k - 1],
+                    )
+                    marked_transfer_stops = self.add_transfer_time(
+                        marked_trip_stops, arrival_k, from_stop_k, arrival_k
+                    )
+                    marked_stops = list(
+                        dict.fromkeys(marked_trip_stops + marked_transfer_stops)
+                    )
+
+                changed_stops = list(dict.fromkeys(marked_stops + copied_stops))
+                self.write_labels(bag_round_stop, k, changed_stops, arrival, trip, from_stop)
+
+            improved_stops = [self.timetable.stops.get_by_index(p) for p in changed_stops]
+            yield dep_secs, bag_round_stop, improved_stops
+
+        self.bag_star = bag_round_stop.earliest_arrival_time[rounds].copy()
+
+    @staticmethod
+    def write_labels(bag_round_stop, k, stops, arrival, trip, from_stop) -> None:
+        """Copy the labels of round k at the given stop indexes into the LabelStore"""
+        if stops:
+            bag_round_stop.earliest_arrival_time[k, stops] = [arrival[k][p] for p in stops]
+            bag_round_stop.trip[k, stops] = [trip[k][p] for p in stops]
+            bag_round_stop.from_stop[k, stops] = [from_stop[k][p] for p in stops]
+
+
+def best_stop_at_target_station(to_stops: List[Stop], bag: RoundLabels) -> Stop:
     """
     Find the destination Stop with the shortest distance.
     Required in order to prevent adding travel time to the arrival time.
     """
     final_stop = 0
     distance = LARGE_NUMBER
+    arrival = bag.store.earliest_arrival_time[bag.k]
     for stop in to_stops:
-        if bag[stop].earliest_arrival_time < distance:
-            distance = bag[stop].earliest_arrival_time
+        if arrival[stop.index] < distance:
+            distance = arrival[stop.index]
             final_stop = stop
     return final_stop
 
 
-def reconstruct_journey(destination: Stop, bag: Dict[Stop, Label]) -> Journey:
-    """Construct journey for destination from values in bag."""
+def reconstruct_journey(destination: Stop, bag: RoundLabels) -> Journey:
+    """Construct journey for destination from the label arrays of a round."""
 
     # Create journey with list of legs
     jrny = Journey()
     to_stop = destination
     while to_stop is not None:
-        from_stop = bag[to_stop].from_stop
         bag_to_stop = bag[to_stop]
+        from_stop = bag_to_stop.from_stop
         leg = Leg(
             from_stop, to_stop, bag_to_stop.trip, bag_to_stop.earliest_arrival_time
         )
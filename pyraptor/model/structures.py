@@ -2,8 +2,8 @@
 from __future__ import annotations
 
 from itertools import compress
+from bisect import bisect_left
 from collections import defaultdict
-from operator import attrgetter
 from typing import List, Dict, Tuple
 from dataclasses import dataclass, field
 from copy import copy
@@ -357,32 +357,56 @@ class Route:
     def add_trip(self, trip: Trip) -> None:
         """Add trip"""
         self.trips.append(trip)
+        self._departure_index = None
 
     def add_stop(self, stop: Stop) -> None:
         """Add stop"""
         self.stops.append(stop)
         # (re)make dict to save the order of the stops in the route
         self.stop_order = {stop: index for index, stop in enumerate(self.stops)}
+        self._departure_index = None
 
     def stop_index(self, stop: Stop):
         """Stop index"""
         return self.stop_order[stop]
 
+    def departure_index(self) -> Tuple[List[List[float]], List[List[Trip]]]:
+        """
+        Departure times per stop index sorted ascending, with the trips in the same order.
+        Built on first use and rebuilt after trips or stops are added.
+        """
+        index = getattr(self, "_departure_index", None)
+        if index is None:
+            dts_dep = np.array(
+                [[tst.dts_dep for tst in trip.stop_times] for trip in self.trips],
+                dtype=float,
+            ).reshape(len(self.trips), len(self.stops))
+            # Stable, so equal departures keep the order of the trips like sorted() did
+            order = np.argsort(dts_dep, axis=0, kind="stable")
+            departures = np.take_along_axis(dts_dep, order, axis=0)
+            index = (
+                departures.T.tolist(),
+                [[self.trips[i] for i in column] for column in order.T.tolist()],
+            )
+            self._departure_index = index
+        return index
+
     def earliest_trip(self, dts_arr: int, stop: Stop) -> Trip:
         """Returns earliest trip after time dts (sec)"""
-        stop_idx = self.stop_index(stop)
-        trip_stop_times = [trip.stop_times[stop_idx] for trip in self.trips]
-        trip_stop_times = [tst for tst in trip_stop_times if tst.dts_dep >= dts_arr]
-        trip_stop_times = sorted(trip_stop_times, key=attrgetter("dts_dep"))
-        return trip_stop_times[0].trip if len(trip_stop_times) > 0 else None
+        trip_stop_time = self.earliest_trip_stop_time(dts_arr, stop)
+        return trip_stop_time.trip if trip_stop_time is not None else None
 
     def earliest_trip_stop_time(self, dts_arr: int, stop: Stop) -> TripStopTime:
         """Returns earliest trip stop time after time dts (sec)"""
         stop_idx = self.stop_index(stop)
-        trip_stop_times = [trip.stop_times[stop_idx] for trip in self.trips]
-        trip_stop_times = [tst for tst in trip_stop_times if tst.dts_dep >= dts_arr]
-        trip_stop_times = sorted(trip_stop_times, key=attrgetter("dts_dep"))
-        return trip_stop_times[0] if len(trip_stop_times) > 0 else None
+        departures, trips = self.departure_index()
+        departures, trips = departures[stop_idx], trips[stop_idx]
+
+        i = bisect_left(departures, dts_arr)
+        # Missing (NaN) departures sort last and never match
+        if i == len(departures) or not departures[i] >= dts_arr:
+            return None
+        return trips[i].stop_times[stop_idx]
 
 
 class Routes:
@@ -7,12 +7,11 @@ from loguru import logger
 from pyraptor.dao.timetable import read_timetable
 from pyraptor.model.structures import Journey, Timetable
 from pyraptor.model.raptor import (
-    RaptorAlgorithm,
+    RangeRaptorAlgorithm,
     best_stop_at_target_station,
     reconstruct_journey,
-    is_dominated,
 )
-from pyraptor.util import str2sec, sec2str
+from pyraptor.util import str2sec, sec2str, LARGE_NUMBER
 
 
 def parse_arguments():
@@ -58,7 +57,8 @@ def parse_arguments():
         "--rounds",
         type=int,
         default=5,
-        help="Number of rounds to execute the RAPTOR algorithm",
+        help="Number of rounds to execute the RAPTOR algorithm, i.e. the maximum "
+        "number of trips of a journey",
     )
     arguments = parser.parse_args()
 
@@ -115,7 +115,8 @@ def run_range_raptor(
     rounds: int,
 ) -> Dict[str, List[Journey]]:
     """
-    Perform the RAPTOR algorithm for a range query
+    Perform the rRAPTOR algorithm for a range query, a journey is kept for each
+    departure time that arrives earlier at the destination than all later departures
     """
 
     # Get stops for origins and destinations
@@ -142,30 +143,34 @@ def run_range_raptor(
     journeys_to_destinations = {
         station_name: [] for station_name, _ in destination_stops.items()
     }
-    last_round_labels = {
-        station_name: None for station_name, _ in destination_stops.items()
+    # Earliest arrival found so far at each destination, from a later departure
+    last_round_arrivals = {
+        station_name: LARGE_NUMBER for station_name, _ in destination_stops.items()
     }
 
-    for dep_index, dep_secs in enumerate(potential_dep_secs):
+    # rRAPTOR, departures are processed latest first on labels kept between them
+    raptor = RangeRaptorAlgorithm(timetable)
+    departures = raptor.run_range(from_stops, potential_dep_secs, rounds)
+    for dep_index, (dep_secs, bag_round_stop, improved_stops) in enumerate(departures):
         logger.info(f"Processing {dep_index} / {len(potential_dep_secs)}")
         logger.info(f"Analyzing best journey for departure time {dep_secs}")
 
-        # Run Round-Based Algorithm
-        raptor = RaptorAlgorithm(timetable)
-        bag_round_stop = raptor.run(from_stops, dep_secs, rounds)
         best_labels = bag_round_stop[rounds]
 
-        # Determine the best destination ID, destination is a platform
-        for destination_station_name, to_stops in destination_stops.items():
+        # Only destinations with an improved stop can arrive earlier than before,
+        # the journeys of all other destinations are dominated by a later departure
+        improved_stations = {stop.station.name for stop in improved_stops}
+        for destination_station_name in improved_stations & destination_stops.keys():
+            to_stops = destination_stops[destination_station_name]
             dest_stop = best_stop_at_target_station(to_stops, best_labels)
+            if dest_stop == 0:
+                continue
 
-            if dest_stop != 0:
+            arrival = best_labels[dest_stop].earliest_arrival_time
+            if arrival < last_round_arrivals[destination_station_name]:
+                last_round_arrivals[destination_station_name] = arrival
                 journey = reconstruct_journey(dest_stop, best_labels)
-                last_round_journey = last_round_labels[destination_station_name]
-                last_round_labels[destination_station_name] = journey
-
-                if not is_dominated(last_round_journey, journey):
-                    journeys_to_destinations[destination_station_name].append(journey)
+                journeys_to_destinations[destination_station_name].append(journey)
 
     return journeys_to_destinations
 
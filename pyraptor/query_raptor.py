@@ -8,12 +8,21 @@ from pyraptor.dao.timetable import read_timetable
 from pyraptor.model.structures import Journey, Station, Timetable
 from pyraptor.model.raptor import (
     RaptorAlgorithm,
+    ArrayRaptorAlgorithm,
     reconstruct_journey,
     best_stop_at_target_station,
 )
+from pyraptor.model.kernel import KernelRaptorAlgorithm
 from pyraptor.util import str2sec
 
 
+ENGINES = {
+    "object": RaptorAlgorithm,
+    "array": ArrayRaptorAlgorithm,
+    "kernel": KernelRaptorAlgorithm,
+}
+
+
 def parse_arguments():
     """Parse arguments"""
     parser = argparse.ArgumentParser()
@@ -46,7 +55,17 @@ def parse_arguments():
         "--rounds",
         type=int,
         default=5,
-        help="Number of rounds to execute the RAPTOR algorithm",
+        help="Number of rounds to execute the RAPTOR algorithm, i.e. the maximum "
+        "number of trips of a journey",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        type=str,
+        choices=list(ENGINES),
+        default="object",
+        help="RAPTOR implementation, object-based, on the compiled timetable arrays"
+        " or the round kernel on those arrays (Numba-compiled when installed)",
     )
     arguments = parser.parse_args()
     return arguments
@@ -58,6 +77,7 @@ def main(
     destination_station,
     departure_time,
     rounds,
+    engine="object",
 ):
     """Run RAPTOR algorithm"""
 
@@ -66,6 +86,7 @@ def main(
     logger.debug("Destination station : {}", destination_station)
     logger.debug("Departure time      : {}", departure_time)
     logger.debug("Rounds              : {}", str(rounds))
+    logger.debug("Engine              : {}", engine)
 
     timetable = read_timetable(input_folder)
 
@@ -81,6 +102,7 @@ def main(
         origin_station,
         dep_secs,
         rounds,
+        engine,
     )
 
     # Print journey to destination
@@ -92,6 +114,7 @@ def run_raptor(
     origin_station: str,
     dep_secs: int,
     rounds: int,
+    engine: str = "object",
 ) -> Dict[Station, Journey]:
     """
     Run the Raptor algorithm.
@@ -100,6 +123,7 @@ def run_raptor(
     :param origin_station: Name of origin station
     :param dep_secs: Time of departure in seconds
     :param rounds: Number of iterations to perform
+    :param engine: Key of ENGINES, the RAPTOR implementation to run
     """
 
     # Get stops for origin and all destinations
@@ -110,7 +134,7 @@ def run_raptor(
     destination_stops.pop(origin_station, None)
 
     # Run Round-Based Algorithm
-    raptor = RaptorAlgorithm(timetable)
+    raptor = ENGINES[engine](timetable)
     bag_round_stop = raptor.run(from_stops, dep_secs, rounds)
     best_labels = bag_round_stop[rounds]
 
@@ -133,4 +157,5 @@ if __name__ == "__main__":
         args.destination,
         args.time,
         args.rounds,
+        args.engine,
     )
@@ -6,6 +6,7 @@ import numpy as np
 TRANSFER_COST = 2 * 60  # Default transfer time is 2 minutes
 LARGE_NUMBER = 2147483647  # Earliest arrival time at start of algorithm
 TRANSFER_TRIP = None
+NO_INDEX = -1  # No trip or stop in the label arrays of RAPTOR
 
 
 def mkdir_if_not_exists(name: str) -> None:
@@ -3,18 +3,387 @@ import requests
 import time
 import csv
 import os
+import bisect
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import gtfsrt
+
+
+# index of one trip in a FeedSnapshot, never modified once created so the snapshots
+# after it share it until an entity of the trip changes
+# entity_ids: ids of the trip updates and vehicles of the trip
+# stop_times: {(stop_sequence, stop_id): (arrival_time, arrival_delay, departure_time, departure_delay)},
+#             either key part None when the update leaves it out, see find_stop_time
+# sequences, updates: [stop_sequence] and [gtfsrt.StopTimeUpdate] in stop_sequence order
+# vehicles: [gtfsrt.VehiclePosition]
+TripIndex = namedtuple('TripIndex', 'entity_ids stop_times sequences updates vehicles')
+
+
+def entity_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def find_stop_time(stop_times, stop_id, stop_sequence=None):
+    '''
+    looks up the times of a stop in TripIndex.stop_times, by stop_sequence and stop_id as
+    a loop trip visits a stop more than once, falling back to an update that only gives
+    one of them
+    
+    stop_sequence: None for the first visit of the stop among the updates
+    '''
+    if stop_sequence is None:
+        visits = [key for key in stop_times if key[1] == stop_id]
+        return stop_times[min(visits, key=lambda key: (key[0] is None, key[0]))] if visits else None
+    
+    times = stop_times.get((stop_sequence, stop_id))
+    if times is None:
+        times = stop_times.get((stop_sequence, None))
+    if times is None:
+        times = stop_times.get((None, stop_id))
+    return times
+
+
+class FeedSnapshot:
+    '''
+    a decoded feed with the time it describes, never modified once created
+    
+    Realtime replaces the snapshot of a feed as a whole, so a reader holding one
+    never sees a feed half parsed or changing under it
+    
+    the entities are diffed by id and content hash against the previous snapshot of the
+    feed, only new or changed entities are decoded (with gtfsrt.decode_entity) and only
+    the trips of added, changed or removed entities are indexed again, the TripIndex of
+    every other trip is shared with the previous snapshot
+    
+    FeedEntity messages are parsed from the kept bytes of an entity only when asked
+    for, by entity, message, trip_data or vehicle_data
+    '''
+    __slots__ = (
+        'header', 'timestamp', 'fetched_at', 'entities', 'parsed', 'trips',
+        'added', 'changed', 'removed', '_message', '_trip_data', '_vehicle_data',
+    )
+    
+    # parses of entities no longer in the feed the shared cache holds before it is pruned
+    PARSED_SLACK = 64
+    
+    def __init__(self, header, entities, fetched_at=None, previous=None):
+        '''
+        header: FeedHeader of the feed
+        entities: [(gtfsrt.Entity, serialized FeedEntity, content hash)] in feed order
+        previous: the snapshot the feed updates, a DIFFERENTIAL feed only carries the
+                  entities that changed (is_deleted for the removed ones) since then
+        '''
+        self.header = header
+        # POSIX time of the feed header, 0 when the feed did not set it
+        self.timestamp = header.timestamp
+        self.fetched_at = fetched_at
+        
+        # shallow copies of the previous snapshot's indexes, the entries of unchanged
+        # entities and trips are shared rather than copied
+        # {entity id: (gtfsrt.Entity, serialized FeedEntity, content hash)} of the current feed state
+        self.entities = dict(previous.entities) if previous else {}
+        # {trip_id: TripIndex} of every trip with a trip update or vehicle
+        self.trips = dict(previous.trips) if previous else {}
+        # {content hash: FeedEntity} of the entities parsed so far, see entity, one
+        # cache for the snapshots of the feed as the hash identifies the content
+        self.parsed = previous.parsed if previous else {}
+        
+        # entity ids that differ from the previous snapshot
+        self.added = []
+        self.changed = []
+        self.removed = []
+        
+        self._message = None
+        self._trip_data = None
+        self._vehicle_data = None
+        
+        self.apply(entities)
+        
+        # older snapshots still parse into the shared cache after they are replaced, once
+        # it outgrows the current feed this snapshot starts a new one with its own entities
+        if len(self.parsed) > 2 * len(self.entities) + self.PARSED_SLACK:
+            parsed = self.parsed
+            self.parsed = {digest: parsed[digest] for _, _, digest in self.entities.values() if digest in parsed}
+        
+    @classmethod
+    def from_message(cls, message, fetched_at=None, previous=None):
+        return cls.from_bytes(message.SerializePartialToString(), fetched_at, previous)
+        
+    @classmethod
+    def from_bytes(cls, data, fetched_at=None, previous=None):
+        '''
+        builds the snapshot of a serialized FeedMessage, hashing the bytes of each entity
+        and decoding only the entities whose hash differs from the previous snapshot
+        '''
+        data = bytes(data)
+        view = memoryview(data)
+        header = gtfs_realtime_pb2.FeedHeader()
+        entities = []
+        for number, wire_type, start, end in gtfsrt.wire_fields(data):
+            # FeedMessage: 1 header, 2 entity, anything else (extensions) is not kept
+            if wire_type != 2:
+                continue
+            if number == 1:
+                header.MergeFromString(data[start:end])
+            elif number == 2:
+                digest = entity_digest(view[start:end])
+                if previous is not None:
+                    kept = previous.entities.get(gtfsrt.entity_id(data, start, end))
+                    if kept is not None and kept[2] == digest:
+                        entities.append(kept)
+                        continue
+                entities.append((gtfsrt.decode_entity(data, start, end), data[start:end], digest))
+        return cls(header, entities, fetched_at, previous)
+        
+    def entity(self, entity_id):
+        '''
+        returns the FeedEntity of an entity id, parsed on first use
+        '''
+        _, raw, digest = self.entities[entity_id]
+        entity = self.parsed.get(digest)
+        if entity is None:
+            entity = gtfs_realtime_pb2.FeedEntity.FromString(raw)
+            self.parsed[digest] = entity
+        return entity
+        
+    @property
+    def message(self):
+        '''
+        the current feed state as one FULL_DATASET FeedMessage, assembled on first use
+        '''
+        if self._message is None:
+            message = gtfs_realtime_pb2.FeedMessage()
+            message.header.CopyFrom(self.header)
+            # FULL_DATASET is the default
+            message.header.ClearField('incrementality')
+            message.entity.extend(self.entity(entity_id) for entity_id in self.entities)
+            self._message = message
+        return self._message
+        
+    @property
+    def trip_data(self):
+        '''
+        {trip_id: [stop_time_update containers]}, see Realtime.get_trip_data
+        '''
+        if self._trip_data is None:
+            trip_data = {}
+            for trip_id, trip in self.trips.items():
+                updates = [self.entity(entity_id).trip_update.stop_time_update for entity_id in trip.entity_ids if self.entities[entity_id][0].stop_time_updates is not None]
+                if updates:
+                    trip_data[trip_id] = updates
+            self._trip_data = trip_data
+        return self._trip_data
+        
+    @property
+    def vehicle_data(self):
+        '''
+        {trip_id: [VehiclePosition]}, see Realtime.get_vehicle_data
+        '''
+        if self._vehicle_data is None:
+            vehicle_data = {}
+            for trip_id, trip in self.trips.items():
+                vehicles = [self.entity(entity_id).vehicle for entity_id in trip.entity_ids if self.entities[entity_id][0].vehicle is not None]
+                if vehicles:
+                    vehicle_data[trip_id] = vehicles
+            self._vehicle_data = vehicle_data
+        return self._vehicle_data
+        
+    def apply(self, entities):
+        differential = self.header.incrementality == gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+        
+        # {entity id: entity before this feed} of every added, changed or removed entity
+        replaced = {}
+        seen = set()
+        for entity, raw, digest in entities:
+            # ids must be unique within a feed, only the first entity of a repeated id is kept
+            if entity.id in seen:
+                continue
+            seen.add(entity.id)
+            
+            if entity.is_deleted:
+                if entity.id in self.entities:
+                    self.removed.append(entity.id)
+                    replaced[entity.id] = self.remove(entity.id)
+                continue
+            
+            previous = self.entities.get(entity.id)
+            if previous is not None and previous[2] == digest:
+                continue
+            
+            (self.added if previous is None else self.changed).append(entity.id)
+            replaced[entity.id] = previous[0] if previous is not None else None
+            if previous is not None:
+                self.parsed.pop(previous[2], None)
+            self.entities[entity.id] = (entity, raw, digest)
+        
+        # a full dataset drops every entity it does not list
+        if not differential:
+            for entity_id in [entity_id for entity_id in self.entities if entity_id not in seen]:
+                self.removed.append(entity_id)
+                replaced[entity_id] = self.remove(entity_id)
+        
+        # {trip_id: [entity id]} of the trips to index again, from their previous entities
+        trip_entities = {}
+        def entity_ids(trip_id):
+            if trip_id not in trip_entities:
+                trip = self.trips.get(trip_id)
+                trip_entities[trip_id] = list(trip.entity_ids) if trip is not None else []
+            return trip_entities[trip_id]
+        
+        for entity_id, old in replaced.items():
+            if old is not None:
+                trip_entities[old.trip_id] = [other for other in entity_ids(old.trip_id) if other != entity_id]
+            if entity_id in self.entities:
+                entity_ids(self.entities[entity_id][0].trip_id).append(entity_id)
+        
+        for trip_id, ids in trip_entities.items():
+            self.index_trip(trip_id, ids)
+            
+    def remove(self, entity_id):
+        entity, _, digest = self.entities.pop(entity_id)
+        self.parsed.pop(digest, None)
+        return entity
+            
+    def index_trip(self, trip_id, entity_ids):
+        '''
+        replaces the TripIndex of a trip by one built from its current entities, a stop
+        updated by several entities of the trip takes the times of the entity updated last
+        '''
+        if not entity_ids:
+            self.trips.pop(trip_id, None)
+            return
+        
+        entities = [self.entities[entity_id][0] for entity_id in entity_ids]
+        vehicles = [entity.vehicle for entity in entities if entity.vehicle is not None]
+        
+        updates = [update for entity in entities for update in entity.stop_time_updates or ()]
+        stop_times = {(update.stop_sequence, update.stop_id): (update.arrival_time, update.arrival_delay, update.departure_time, update.departure_delay) for update in updates}
+        
+        # updates without stop_sequence cannot be placed along the trip
+        updates = sorted((update for update in updates if update.stop_sequence is not None), key=lambda update: update.stop_sequence)
+        
+        self.trips[trip_id] = TripIndex(tuple(entity_ids), stop_times, [update.stop_sequence for update in updates], updates, vehicles)
+            
+    def get_stop_time_update(self, trip_id, stop_id, stop_sequence=None):
+        '''
+        stop_sequence: the visit of the stop, the first one when None, see find_stop_time
+        
+        return: (arrival_time, arrival_delay, departure_time, departure_delay) of the update
+                for the stop, None if the trip has no update for it
+        '''
+        trip = self.trips.get(trip_id)
+        return find_stop_time(trip.stop_times, stop_id, stop_sequence) if trip is not None else None
+        
+    def get_delay(self, trip_id, stop_sequence):
+        '''
+        predicted delay in seconds at stop_sequence of a trip, carried forward from the
+        nearest update at or before it as GTFS-rt prescribes: the departure delay of an
+        earlier stop, or the arrival delay at the stop itself
+        
+        return: None when no update precedes the stop
+        '''
+        trip = self.trips.get(trip_id)
+        if trip is None:
+            return None
+        sequences, updates = trip.sequences, trip.updates
+        
+        index = bisect.bisect_right(sequences, stop_sequence) - 1
+        while index >= 0:
+            _, _, _, arrival_delay, _, departure_delay = updates[index]
+            if updates[index][0] == stop_sequence and arrival_delay is not None:
+                return arrival_delay
+            delay = departure_delay if departure_delay is not None else arrival_delay
+            if delay is not None:
+                return delay
+            index -= 1
+        return None
+        
+    def get_delays(self, trip_ids, stop_ids, stop_sequences, scheduled):
+        '''
+        predicted delays of many scheduled stop times in one pass, e.g. a departure board
+        
+        trip_ids, stop_ids, stop_sequences: the stop times
+        scheduled: POSIX times of their scheduled arrivals
+        
+        return: [delay in seconds or None], from the predicted arrival time or delay of
+                the update for the stop when there is one, see get_delay otherwise
+        '''
+        trips = self.trips
+        
+        delays = []
+        for trip_id, stop_id, stop_sequence, arrival in zip(trip_ids, stop_ids, stop_sequences, scheduled):
+            trip = trips.get(trip_id)
+            if trip is None:
+                delays.append(None)
+                continue
+            update = find_stop_time(trip.stop_times, stop_id, stop_sequence)
+            if update is not None and update[0]:
+                delays.append(update[0] - arrival)
+            elif update is not None and update[1] is not None:
+                delays.append(update[1])
+            else:
+                delays.append(self.get_delay(trip_id, stop_sequence))
+        return delays
+        
+    @property
+    def age(self):
+        '''
+        seconds since the feed header timestamp, None before the first fetch
+        '''
+        if not self.timestamp:
+            return None
+        return time.time() - self.timestamp
+
 
 class Realtime:
-    def __init__(self, agency, city):
+    # feed names, <name>_url is the link and <name>_feed the parsed FeedMessage of each
+    FEEDS = ('service_alerts', 'trip_updates', 'vehicle_positions')
+    
+    # seconds to connect and to wait for each read of a feed response
+    TIMEOUT = (5, 30)
+    
+    # seconds between fetches of each feed by the background poller
+    POLL_INTERVALS = {'service_alerts': 60, 'trip_updates': 15, 'vehicle_positions': 15}
+    
+    def __init__(self, agency, city, urls=None):
+        '''
+        urls: (service alerts, trip updates, vehicle positions) links, looked up in
+              transit_gtfs_list.csv when not given
+        '''
         self.agency = agency
         self.city = city
         
-        self.service_alerts_feed = gtfs_realtime_pb2.FeedMessage()
-        self.trip_updates_feed = gtfs_realtime_pb2.FeedMessage()
-        self.vehicle_positions_feed = gtfs_realtime_pb2.FeedMessage()
+        # {feed name: FeedSnapshot}, replaced as a whole on every parsed update
+        self.snapshots = {name: FeedSnapshot(gtfs_realtime_pb2.FeedHeader(), []) for name in self.FEEDS}
         
+        # background poller, see start
+        self.pollers = []
+        self.stop_event = threading.Event()
+        # set once each feed has a first snapshot
+        self.ready = {name: threading.Event() for name in self.FEEDS}
+        # one snapshot update at a time per feed, each is diffed against the one before
+        self.update_locks = {name: threading.Lock() for name in self.FEEDS}
+        # callbacks of add_listener
+        self.listeners = []
+        
+        # kept-alive connections shared by the three feeds, one per concurrent fetch
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=len(self.FEEDS))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        # {feed name: {'etag', 'last_modified'}} of the last parsed response
+        self.validators = {}
+        # {feed name: {'status', 'fetch_s', 'parse_s', 'bytes', 'time'}} of the last fetch
+        self.metrics = {}
+        
+        if urls:
+            self.service_alerts_url, self.trip_updates_url, self.vehicle_positions_url = urls
         # url of transit data does not exist
-        if not os.path.isfile('transit_gtfs_list.csv'):
+        elif not os.path.isfile('transit_gtfs_list.csv'):
             print('you must include transit_gtfs_list.csv for realtime data.')
         else:
              with open('transit_gtfs_list.csv', newline='') as transit_list:
@@ -26,79 +395,183 @@ class Realtime:
                         # 5th column is the trip updates link
                         self.trip_updates_url = row[4]
                         # 6th column is the vehicle update link
-                        self.vehicle_positions_url = row[5]
+                        self.vehicle_positions_url = row[5].strip()
     
-    def update_service_data(self):
+    def update_feed(self, name):
+        '''
+        fetches one GTFS-rt feed ('service_alerts', 'trip_updates' or 'vehicle_positions')
+        over the pooled session and parses it into a new snapshot of the feed
+        
+        the request is conditional on the ETag / Last-Modified of the previous response,
+        an unchanged feed (304) keeps the parsed message without parsing again
+        
+        return: whether the feed changed
+        '''
+        url = getattr(self, f'{name}_url')
+        headers = {}
+        validators = self.validators.get(name, {})
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        
         # get realtime proto file
-        response = requests.get(self.service_alerts_url)
+        start = time.perf_counter()
+        response = self.session.get(url, headers=headers, timeout=self.TIMEOUT)
+        fetched = time.perf_counter()
+        
+        metrics = {'status': response.status_code, 'fetch_s': fetched - start, 'parse_s': 0.0, 'bytes': len(response.content), 'time': time.time()}
+        self.metrics[name] = metrics
+        
+        if response.status_code == 304:
+            self.ready[name].set()
+            return False
+        response.raise_for_status()
+        
+        # Parse the changed entities into a new snapshot, readers keep the previous one meanwhile
+        with self.update_locks[name]:
+            snapshot = FeedSnapshot.from_bytes(response.content, time.time(), self.snapshots[name])
+            self.snapshots[name] = snapshot
+        metrics['parse_s'] = time.perf_counter() - fetched
+        metrics['entities'] = (len(snapshot.added), len(snapshot.changed), len(snapshot.removed))
+        
+        self.validators[name] = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        self.ready[name].set()
+        
+        if snapshot.added or snapshot.changed or snapshot.removed:
+            for listener in self.listeners:
+                listener(name, snapshot)
+        return True
+        
+    def add_listener(self, listener):
+        '''
+        calls listener(feed name, snapshot) after every update that added, changed or
+        removed entities, snapshot.added, changed and removed list their entity ids
+        
+        listeners run on the thread that fetched the feed, e.g. a poller
+        '''
+        self.listeners.append(listener)
         
-        # Parse the response into structured dict
-        self.service_alerts_feed.ParseFromString(response.content)
+    def update_service_data(self):
+        return self.update_feed('service_alerts')
                 
     def update_trip_data(self):
-        # get realtime proto file
-        response = requests.get(self.trip_updates_url)
-        
-        # Parse the response into structured dict
-        self.trip_updates_feed.ParseFromString(response.content)
+        return self.update_feed('trip_updates')
         
     def update_vehicle_data(self):
-        # get realtime proto file
-        response = requests.get(self.vehicle_positions_url)
+        return self.update_feed('vehicle_positions')
         
-        # Parse the response into structured dict
-        self.vehicle_positions_feed.ParseFromString(response.content)
+    def update_all(self):
+        '''
+        fetches the three feeds concurrently over the pooled session
         
-    def get_trip_data(self):
-        trips = {}
+        return: {feed name: whether it changed}
+        '''
+        with ThreadPoolExecutor(len(self.FEEDS)) as pool:
+            futures = {name: pool.submit(self.update_feed, name) for name in self.FEEDS}
+            return {name: future.result() for name, future in futures.items()}
+        
+    def start(self, intervals=None):
+        '''
+        polls every feed in a background thread of its own, fetching it right away and
+        then every POLL_INTERVALS seconds (or intervals[name]), so readers of the
+        snapshots never wait on the network
         
-        # go through the realtime object and store vehicle information
-        for entity in self.trip_updates_feed.entity:
+        a failed fetch is reported in metrics[name]['error'] and keeps the previous snapshot
+        '''
+        if self.pollers:
+            return
+        intervals = {**self.POLL_INTERVALS, **(intervals or {})}
+        self.stop_event.clear()
+        for name in self.FEEDS:
+            poller = threading.Thread(target=self.poll, args=(name, intervals[name]), daemon=True)
+            poller.start()
+            self.pollers.append(poller)
             
-            trip_id = entity.trip_update.trip.trip_id
-            stop_time_update = entity.trip_update.stop_time_update
+    def poll(self, name, interval):
+        while not self.stop_event.is_set():
+            start = time.monotonic()
+            try:
+                self.update_feed(name)
+            except Exception as error:
+                self.metrics[name] = {**self.metrics.get(name, {}), 'error': repr(error), 'time': time.time()}
+            self.stop_event.wait(max(interval - (time.monotonic() - start), 0))
             
-            if trip_id not in trips:
-                trips[trip_id] = [stop_time_update]
-            else:
-                trips[trip_id].append(stop_time_update)
+    def stop(self):
+        self.stop_event.set()
+        for poller in self.pollers:
+            poller.join()
+        self.pollers = []
         
-        return trips
-
-    def get_vehicle_data(self):
-        # realtime vehicle information with trip_id as key
-        vehicles = {}
+    def wait(self, timeout=None):
+        '''
+        waits until every feed has been fetched once, at most timeout seconds overall
         
-        # go through the realtime object and store vehicle information
-        for entity in self.vehicle_positions_feed.entity:
-            trip_id = entity.vehicle.trip.trip_id
-            
-            # if multiple buses of the same trip exist
-            if trip_id not in vehicles:
-                vehicles[trip_id] = [entity.vehicle]
-            else:
-                vehicles[trip_id].append(entity.vehicle)
-            
-        return vehicles
-     
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        return: whether all feeds are ready
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for event in self.ready.values():
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not event.wait(remaining):
+                return False
+        return True
+        
+    def snapshot(self, name):
+        return self.snapshots[name]
+        
+    def get_stop_time_update(self, trip_id, stop_id, stop_sequence=None):
+        '''
+        return: (arrival_time, arrival_delay, departure_time, departure_delay) from the
+                trip updates, None if the trip has no update for the stop, see
+                FeedSnapshot.get_stop_time_update
+        '''
+        return self.snapshots['trip_updates'].get_stop_time_update(trip_id, stop_id, stop_sequence)
+        
+    def get_delay(self, trip_id, stop_sequence):
+        '''
+        see FeedSnapshot.get_delay
+        '''
+        return self.snapshots['trip_updates'].get_delay(trip_id, stop_sequence)
+        
+    def get_delays(self, trip_ids, stop_ids, stop_sequences, scheduled):
+        '''
+        see FeedSnapshot.get_delays
+        '''
+        return self.snapshots['trip_updates'].get_delays(trip_ids, stop_ids, stop_sequences, scheduled)
+        
+    @property
+    def service_alerts_feed(self):
+        return self.snapshots['service_alerts'].message
+        
+    @property
+    def trip_updates_feed(self):
+        return self.snapshots['trip_updates'].message
+        
+    @property
+    def vehicle_positions_feed(self):
+        return self.snapshots['vehicle_positions'].message
+        
+    def close(self):
+        self.stop()
+        self.session.close()
+        
+    def get_trip_data(self):
+        '''
+        return: {trip_id: [stop_time_update containers]} of the trip updates feed
+        '''
+        # indexed when the feed was updated, the copy is the caller's to change
+        return dict(self.snapshots['trip_updates'].trip_data)
 
+    def get_vehicle_positions(self):
+        '''
+        return: {trip_id: [gtfsrt.VehiclePosition]}, the decoded positions without
+                parsing any VehiclePosition message
+        '''
+        trips = self.snapshots['vehicle_positions'].trips
+        return {trip_id: trip.vehicles for trip_id, trip in trips.items() if trip.vehicles}
 
+    def get_vehicle_data(self):
+        '''
+        return: {trip_id: [VehiclePosition]}, several if multiple buses run the same trip
+        '''
+        return dict(self.snapshots['vehicle_positions'].vehicle_data)
@@ -0,0 +1,244 @@
+import os
+import csv
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from gtfs import GTFS
+from realtime import Realtime
+
+
+class Feed:
+    '''
+    one row of transit_gtfs_list.csv and the GTFS + Realtime pair serving it
+    '''
+
+    def __init__(self, agency, city, static_url, realtime_urls, refresh_interval):
+        self.agency = agency
+        self.city = city
+        self.static_url = static_url
+        # (service alerts, trip updates, vehicle positions)
+        self.realtime_urls = realtime_urls
+
+        # seconds between static refreshes of this feed, and when the next one is due
+        self.refresh_interval = refresh_interval
+        self.next_refresh = 0
+
+        self.gtfs = None
+        self.realtime = None
+        # serializes loading and refreshing the same feed
+        self.lock = threading.Lock()
+
+    @property
+    def key(self):
+        return self.agency, self.city
+
+    def __repr__(self):
+        return f'Feed({self.agency!r}, {self.city!r})'
+
+
+class FeedRegistry:
+    '''
+    parses transit_gtfs_list.csv once and keeps a GTFS + Realtime pair per feed
+
+    static feeds are loaded and refreshed concurrently by at most max_workers threads,
+    each feed on its own schedule of refresh_interval seconds, the realtime feeds of a
+    loaded feed are polled by its Realtime, see Realtime.start
+    '''
+
+    def __init__(self, list_path='transit_gtfs_list.csv', max_workers=4, refresh_interval=24 * 3600, realtime=True, poll_intervals=None, **gtfs_options):
+        '''
+        realtime: start polling the realtime feeds of each feed as it is loaded, False
+                  leaves feed.realtime to the caller (start or update_all) and departures
+                  have no predictions until then
+        poll_intervals: {feed name: seconds} overriding Realtime.POLL_INTERVALS
+        gtfs_options: keyword arguments of every GTFS, e.g. backend='memory' or workers=4
+        '''
+        self.list_path = list_path
+        self.max_workers = max_workers
+        self.poll_realtime = realtime
+        self.poll_intervals = poll_intervals
+        self.gtfs_options = gtfs_options
+
+        # {(agency, city): Feed} in the order of the list
+        self.feeds = {}
+
+        if not os.path.isfile(list_path):
+            print(f'{list_path} does not exist, no feeds registered.')
+        else:
+            with open(list_path, newline='') as transit_list:
+                for row in csv.DictReader(transit_list):
+                    feed = Feed(
+                        row['agency'].strip(),
+                        row['city'].strip(),
+                        row['static_data'].strip(),
+                        (row['service_alerts'].strip(), row['trip_updates'].strip(), row['vehicle_positions'].strip()),
+                        refresh_interval,
+                    )
+                    self.feeds[feed.key] = feed
+
+        # background refresh thread, see start
+        self.stop_event = threading.Event()
+        self.scheduler = None
+
+    def __len__(self):
+        return len(self.feeds)
+
+    def __iter__(self):
+        return iter(self.feeds.values())
+
+    def __getitem__(self, key):
+        '''
+        returns the Feed of an (agency, city) key, loading its GTFS on first use
+        '''
+        feed = self.feeds[key]
+        if feed.gtfs is None:
+            self.load_feed(feed)
+        return feed
+
+    def gtfs(self, agency, city):
+        return self[agency, city].gtfs
+
+    def realtime(self, agency, city):
+        return self[agency, city].realtime
+
+    def schedule(self, agency, city, refresh_interval):
+        '''
+        sets the static refresh interval of one feed, the next refresh moves accordingly
+        '''
+        feed = self.feeds[agency, city]
+        feed.next_refresh += refresh_interval - feed.refresh_interval
+        feed.refresh_interval = refresh_interval
+
+    def load_feed(self, feed):
+        with feed.lock:
+            if feed.gtfs is None:
+                feed.gtfs = GTFS(feed.agency, feed.city, url=feed.static_url, **self.gtfs_options)
+                feed.realtime = Realtime(feed.agency, feed.city, feed.realtime_urls)
+                if self.poll_realtime:
+                    feed.realtime.start(self.poll_intervals)
+                feed.next_refresh = time.time() + feed.refresh_interval
+        return feed
+
+    def refresh_feed(self, feed):
+        '''
+        return: whether the static feed changed, see GTFS.refresh
+        '''
+        with feed.lock:
+            # the refresh is rescheduled even when it fails, so a broken feed does not retry in a loop
+            feed.next_refresh = time.time() + feed.refresh_interval
+            return feed.gtfs.refresh(feed.static_url, workers=self.gtfs_options.get('workers', 1))
+
+    def run_all(self, function, feeds):
+        '''
+        calls function on every feed in the worker pool
+
+        return: {(agency, city): result}, the exception raised for a feed that failed
+        '''
+        results = {}
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = {feed.key: pool.submit(function, feed) for feed in feeds}
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result()
+                except Exception as error:
+                    print(f'{key[0]} {key[1]}: {error}')
+                    results[key] = error
+        return results
+
+    def load(self):
+        '''
+        loads every registered feed that is not loaded yet
+        '''
+        return self.run_all(self.load_feed, [feed for feed in self if feed.gtfs is None])
+
+    def refresh_due(self, now=None):
+        '''
+        refreshes the loaded feeds whose next refresh is due
+
+        return: {(agency, city): changed or the exception raised}
+        '''
+        now = time.time() if now is None else now
+        due = [feed for feed in self if feed.gtfs is not None and feed.next_refresh <= now]
+        return self.run_all(self.refresh_feed, due) if due else {}
+
+    def start(self):
+        '''
+        refreshes the feeds in a background thread as they fall due
+        '''
+        if self.scheduler is not None:
+            return
+        self.stop_event.clear()
+        self.scheduler = threading.Thread(target=self.run_scheduler, daemon=True)
+        self.scheduler.start()
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.stop_event.set()
+            self.scheduler.join()
+            self.scheduler = None
+
+    def run_scheduler(self):
+        while not self.stop_event.is_set():
+            self.refresh_due()
+
+            # sleep until the earliest refresh, waking up at least every minute for new feeds
+            loaded = [feed.next_refresh for feed in self if feed.gtfs is not None]
+            delay = min(loaded, default=time.time() + 60) - time.time()
+            self.stop_event.wait(min(max(delay, 1), 60))
+
+    def get_nearby_bus_stops(self, lon, lat, radius_km=1, limit=0):
+        '''
+        nearby stops across every loaded feed
+
+        return: List[((agency, city), stop_id, stop_name, stop_lat, stop_lon, distance_km)]
+                sorted by distance, only the nearest limit stops if limit > 0
+        '''
+        nearby = []
+        for feed in self:
+            if feed.gtfs is not None:
+                stops = feed.gtfs.get_nearby_bus_stops(lon, lat, radius_km, limit)
+                nearby.extend((feed.key, *stop) for stop in stops)
+
+        nearby.sort(key=lambda stop: stop[5])
+        return nearby[:limit] if limit > 0 else nearby
+
+    def get_departures(self, stops, query_date=None, query_time=None, count=1):
+        '''
+        departure boards of stops across feeds, one GTFS.get_departures query per feed
+        with the trip updates of that feed's Realtime merged in
+
+        predictions come from the last polled trip updates, a feed loaded by this call has
+        none until its first fetch completes, see Realtime.wait
+
+        parameters: stops: sequence of ((agency, city), stop_id, ...), e.g. the stops of
+                           get_nearby_bus_stops, a feed not loaded yet is loaded first
+                    count: how many rows to return per stop
+
+        return: {((agency, city), stop_id): List[(arrival_time, route_id, trip_headsign, trip_id, predicted_time, delay)]}
+                in the order of stops
+        '''
+        stop_ids = {}
+        for key, stop_id, *_ in stops:
+            stop_ids.setdefault(key, []).append(stop_id)
+
+        departures = {}
+        for key, feed_stop_ids in stop_ids.items():
+            feed = self[key]
+            boards = feed.gtfs.get_departures(feed_stop_ids, feed.realtime, query_date, query_time, count)
+            for stop_id, buses in boards.items():
+                departures[key, stop_id] = buses
+
+        return {(key, stop_id): departures[key, stop_id] for key, stop_id, *_ in stops}
+
+    def close(self):
+        '''
+        stops the scheduler and closes the database connections, realtime pollers and
+        sessions of every loaded feed
+        '''
+        self.stop()
+        for feed in self:
+            if feed.gtfs is not None:
+                feed.gtfs.close()
+            if feed.realtime is not None:
+                feed.realtime.close()
@@ -0,0 +1,71 @@
+'''
+checks that ConnectionPool closes the connection of a thread when the thread exits and
+refuses connections once closed
+
+run with: python -m pytest test_connection_pool.py, or python test_connection_pool.py
+'''
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from gtfs import ConnectionPool
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, 'test.db')
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('CREATE TABLE stops (stop_id TEXT)')
+            conn.execute("INSERT INTO stops VALUES ('101')")
+        conn.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def query(self, pool, results):
+        conn = pool.connection()
+        # the same connection for every call on a thread
+        self.assertIs(pool.connection(), conn)
+        results.append((conn, conn.execute('SELECT stop_id FROM stops').fetchall()))
+
+    def test_thread_exit_closes_connection(self):
+        pool = ConnectionPool(self.db_path)
+        results = []
+        for _ in range(20):
+            thread = threading.Thread(target=self.query, args=(pool, results))
+            thread.start()
+            thread.join()
+
+        self.assertEqual([rows for _, rows in results], [[('101',)]] * 20)
+        self.assertEqual(pool.connections, set())
+        for conn, _ in results:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                conn.execute('SELECT 1')
+        pool.close()
+
+    def test_close(self):
+        pool = ConnectionPool(self.db_path)
+        results = []
+        self.query(pool, results)
+        pool.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            results[0][0].execute('SELECT 1')
+        with self.assertRaises(sqlite3.ProgrammingError):
+            pool.connection()
+
+    def test_uri(self):
+        self.assertTrue(ConnectionPool(self.db_path).uri().endswith('?mode=ro'))
+        self.assertTrue(ConnectionPool(self.db_path, immutable=True).uri().endswith('?mode=ro&immutable=1'))
+        self.assertNotIn('?', ConnectionPool(self.db_path, read_only=False).uri())
+
+        pool = ConnectionPool(self.db_path, immutable=True)
+        self.assertEqual(pool.connection().execute('SELECT stop_id FROM stops').fetchall(), [('101',)])
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+'''
+checks that the memory backend (ColumnarTimetable) answers the timetable queries exactly
+like the SQL path, on a random feed with loops, ties and service exceptions
+
+run with: python -m pytest test_memory_backend.py, or python test_memory_backend.py
+'''
+import os
+import random
+import tempfile
+import unittest
+
+import test_query_plans
+from gtfs import GTFS
+
+
+AGENCY = 'test'
+CITY = 'town'
+
+# weekdays, a Saturday the calendar_dates add service on and a removed Wednesday
+QUERY_DATES = ['20240102', '20240103', '20240106', '20240107', '20240110']
+QUERY_TIMES = ['00:00:00', '05:59:00', '08:00:00', '08:17:30', '12:30:00', '23:50:00', '25:10:00']
+
+
+def random_feed(rng):
+    '''
+    returns a feed in the format of test_query_plans.FEED, every file the loader reads
+    '''
+    feed = dict(test_query_plans.FEED)
+    stop_ids = [f'{100 + i}' for i in range(30)]
+    feed['stops.txt'] = (
+        feed['stops.txt'][0],
+        [[stop_id, stop_id, f'Stop {stop_id}', 48.4 + i / 1000, -123.4, 0] for i, stop_id in enumerate(stop_ids)],
+    )
+    feed['calendar.txt'] = (
+        feed['calendar.txt'][0],
+        [['WK', 1, 1, 1, 1, 1, 0, 0, '20240101', '20241231'], ['SA', 0, 0, 0, 0, 0, 1, 0, '20240101', '20241231']],
+    )
+    feed['calendar_dates.txt'] = (
+        feed['calendar_dates.txt'][0],
+        [['WK', '20240106', 1], ['WK', '20240110', 2], ['SA', '20240106', 2]],
+    )
+    feed['routes.txt'] = (
+        feed['routes.txt'][0],
+        [[f'{route}-TST', str(route), f'Route {route}', 3, '', ''] for route in range(4)],
+    )
+
+    trips = []
+    stop_times = []
+    for route in range(4):
+        path = rng.sample(stop_ids, 8)
+        # route 0 is a loop that visits its first stop again at the end
+        if route == 0:
+            path.append(path[0])
+        for direction in (0, 1):
+            stops = path if direction == 0 else path[::-1]
+            for number, start in enumerate(range(5 * 3600, 26 * 3600, rng.choice((900, 1200, 1800)))):
+                trip_id = f'{route}-{direction}-{number}'
+                trips.append([f'{route}-TST', rng.choice(('WK', 'WK', 'SA')), trip_id, f'Route {route} {direction}', direction, ''])
+                # whole minutes, so trips of different routes tie at shared stops
+                secs = start + 60 * rng.randint(0, 10)
+                for stop_sequence, stop_id in enumerate(stops, 1):
+                    # unpadded hours, as some feeds write them
+                    hms = f'{secs // 3600}:{secs % 3600 // 60:02d}:{secs % 60:02d}'
+                    stop_times.append([trip_id, stop_id, stop_sequence, hms, hms, '', 0, 0, '', 1])
+                    secs += 60 * rng.randint(1, 4)
+
+    feed['trips.txt'] = (feed['trips.txt'][0], trips)
+    feed['stop_times.txt'] = (feed['stop_times.txt'][0], stop_times)
+    return feed, stop_ids
+
+
+class MemoryBackendTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # GTFS keeps its feed and database relative to the working directory
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.chdir(cls.tmp.name)
+
+        cls.feed, cls.stop_ids = random_feed(random.Random(9))
+        original = test_query_plans.FEED
+        test_query_plans.FEED = cls.feed
+        try:
+            test_query_plans.write_feed(f'{GTFS.STATIC_DIR}/{AGENCY}/{CITY}')
+        finally:
+            test_query_plans.FEED = original
+
+        cls.sql = GTFS(AGENCY, CITY)
+        cls.memory = GTFS(AGENCY, CITY, update_db=False, backend='memory')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sql.close()
+        cls.memory.close()
+        os.chdir(cls.cwd)
+        cls.tmp.cleanup()
+
+    def assert_same(self, method, *args):
+        expected = [tuple(row) for row in getattr(self.sql, method)(*args)]
+        actual = [tuple(row) for row in getattr(self.memory, method)(*args)]
+        self.assertEqual(actual, expected, (method, args))
+        return expected
+
+    def test_get_incoming_buses(self):
+        found = 0
+        for stop_id in self.stop_ids + ['missing']:
+            for query_date in QUERY_DATES:
+                for query_time in QUERY_TIMES:
+                    for count in (1, 3):
+                        found += len(self.assert_same('get_incoming_buses', stop_id, query_date, query_time, count))
+        self.assertGreater(found, 0)
+
+    def test_get_incoming_buses_many(self):
+        for query_date in QUERY_DATES:
+            for query_time in QUERY_TIMES:
+                stop_ids = self.stop_ids[:10] + ['missing']
+                expected = self.sql.get_incoming_buses_many(stop_ids, query_date, query_time, 2)
+                actual = self.memory.get_incoming_buses_many(stop_ids, query_date, query_time, 2)
+                self.assertEqual(
+                    {stop_id: [tuple(row) for row in rows] for stop_id, rows in actual.items()},
+                    {stop_id: [tuple(row) for row in rows] for stop_id, rows in expected.items()},
+                    (query_date, query_time),
+                )
+
+    def test_get_all_trip_stops(self):
+        found = 0
+        for route in range(4):
+            for direction in (0, 1, '0', '1'):
+                for query_date in QUERY_DATES:
+                    for query_time in QUERY_TIMES:
+                        for offset in (0, 1):
+                            found += len(self.assert_same('get_all_trip_stops', f'{route}-TST', direction, query_date, query_time, offset))
+        self.assertGreater(found, 0)
+
+    def test_get_remaining_stops(self):
+        found = 0
+        for route in range(4):
+            for stop_id in self.stop_ids:
+                for query_date in QUERY_DATES:
+                    for query_time in QUERY_TIMES[::2]:
+                        found += len(self.assert_same('get_remaining_stops', f'{route}-TST', stop_id, query_date, query_time))
+        self.assertGreater(found, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+'''
+checks that the GTFS timetable queries search stop_times and trips through GTFS.INDEXES
+
+builds a tiny feed in a temporary directory, records the SQL each query method runs and
+asserts on its EXPLAIN QUERY PLAN
+
+run with: python -m pytest test_query_plans.py, or python test_query_plans.py
+'''
+import os
+import csv
+import tempfile
+import unittest
+
+from gtfs import GTFS
+
+
+AGENCY = 'test'
+CITY = 'town'
+QUERY_DATE = '20240102'
+QUERY_TIME = '08:00:00'
+
+# feed file: (header, rows), every column GTFS.FILES_TO_LOAD reads
+FEED = {
+    'agency.txt': (
+        ['agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_phone', 'agency_lang'],
+        [['1', 'Test Transit', 'http://example.com', 'America/Vancouver', '', 'en']],
+    ),
+    'shapes.txt': (['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'], []),
+    'calendar.txt': (
+        ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'],
+        [['WK', 1, 1, 1, 1, 1, 0, 0, '20240101', '20241231']],
+    ),
+    'calendar_dates.txt': (['service_id', 'date', 'exception_type'], [['WK', '20240106', 1]]),
+    'routes.txt': (
+        ['route_id', 'route_short_name', 'route_long_name', 'route_type', 'route_color', 'route_text_color'],
+        [['1-TST', '1', 'Route 1', 3, '', '']],
+    ),
+    'stops.txt': (
+        ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon', 'wheelchair_boarding'],
+        [[f'10{i}', str(i), f'Stop {i}', 48.4 + i / 1000, -123.4, 0] for i in range(3)],
+    ),
+    'trips.txt': (
+        ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id', 'shape_id'],
+        [['1-TST', 'WK', f't{hour}', 'Downtown', 0, ''] for hour in (7, 8, 9)],
+    ),
+    'stop_times.txt': (
+        ['trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time', 'stop_headsign', 'pickup_type', 'drop_off_type', 'shape_dist_traveled', 'timepoint'],
+        [
+            [f't{hour}', f'10{i}', i + 1, f'{hour}:{10 * i:02d}:00', f'{hour}:{10 * i:02d}:00', '', 0, 0, '', 1]
+            for hour in (7, 8, 9) for i in range(3)
+        ],
+    ),
+}
+
+
+def write_feed(directory):
+    os.makedirs(directory, exist_ok=True)
+    for file_name, (header, rows) in FEED.items():
+        with open(os.path.join(directory, file_name), 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # GTFS keeps its feed and database relative to the working directory
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.chdir(cls.tmp.name)
+        write_feed(f'{GTFS.STATIC_DIR}/{AGENCY}/{CITY}')
+        cls.gtfs = GTFS(AGENCY, CITY)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.gtfs.close()
+        os.chdir(cls.cwd)
+        cls.tmp.cleanup()
+
+    def query_plan(self, method, *args):
+        '''
+        runs a query method and returns the EXPLAIN QUERY PLAN details of the last
+        statement it executed, with its parameters bound
+        '''
+        conn = self.gtfs.pool.connection()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            result = method(*args)
+        finally:
+            conn.set_trace_callback(None)
+        self.assertTrue(result, 'the query found no rows, the feed does not exercise it')
+
+        return [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {statements[-1]}')]
+
+    def assert_searches(self, plan, *expected):
+        for step in expected:
+            self.assertTrue(any(detail.startswith(step) for detail in plan), f'{step!r} not in plan {plan}')
+        # neither large table is read in full
+        for detail in plan:
+            self.assertNotRegex(detail, r'^SCAN (st|stop_times|trips)\b', f'full scan in plan {plan}')
+
+    def test_get_incoming_buses(self):
+        plan = self.query_plan(self.gtfs.get_incoming_buses, '101', QUERY_DATE, QUERY_TIME, 2)
+        self.assert_searches(plan, 'SEARCH st USING INDEX stop_times_stop_arrival')
+
+    def test_get_all_trip_stops(self):
+        plan = self.query_plan(self.gtfs.get_all_trip_stops, '1-TST', 0, QUERY_DATE, QUERY_TIME)
+        self.assert_searches(
+            plan,
+            'SEARCH trips USING INDEX trips_route_direction',
+            'SEARCH st USING INDEX stop_times_trip_sequence',
+        )
+
+    def test_get_remaining_stops(self):
+        plan = self.query_plan(self.gtfs.get_remaining_stops, '1-TST', '101', QUERY_DATE, QUERY_TIME)
+        self.assert_searches(
+            plan,
+            'SEARCH trips USING INDEX trips_route_direction',
+            'SEARCH st USING INDEX stop_times_trip_sequence',
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+'''
+checks that Realtime fetches its three feeds concurrently over kept-alive connections
+and honors ETag / Last-Modified, against a local HTTP stub
+
+run with: python -m pytest test_realtime_fetch.py, or python test_realtime_fetch.py
+'''
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from google.transit import gtfs_realtime_pb2
+
+from realtime import Realtime
+
+
+def feed_bytes(trip_id, delay):
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = '2.0'
+    message.header.timestamp = 1
+    entity = message.entity.add(id=f'tu-{trip_id}')
+    entity.trip_update.trip.trip_id = trip_id
+    update = entity.trip_update.stop_time_update.add(stop_sequence=1, stop_id='101')
+    update.arrival.delay = delay
+    return message.SerializeToString()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    '''
+    serves server.feeds {path: (body, etag, last_modified)}, answering 304 to a matching
+    If-None-Match or If-Modified-Since, and records (path, headers, client port) of
+    every request in server.requests
+    '''
+    # keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers), self.client_address[1]))
+        if server.barrier is not None:
+            # every feed is requested before any is answered
+            server.barrier.wait()
+
+        body, etag, last_modified = server.feeds[self.path]
+        not_modified = (
+            (etag is not None and self.headers.get('If-None-Match') == etag)
+            or (etag is None and last_modified is not None and self.headers.get('If-Modified-Since') == last_modified)
+        )
+        self.send_response(304 if not_modified else 200)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if last_modified is not None:
+            self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', '0' if not_modified else str(len(body)))
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RealtimeFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.barrier = None
+        self.server.feeds = {
+            '/alerts.pb': (feed_bytes('A', 0), None, 'Mon, 01 Jan 2024 00:00:00 GMT'),
+            '/trips.pb': (feed_bytes('T', 60), '"t1"', None),
+            '/vehicles.pb': (feed_bytes('V', 0), '"v1"', 'Mon, 01 Jan 2024 00:00:00 GMT'),
+        }
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        base = f'http://127.0.0.1:{self.server.server_port}'
+        self.realtime = Realtime('test', 'town', (f'{base}/alerts.pb', f'{base}/trips.pb', f'{base}/vehicles.pb'))
+
+    def tearDown(self):
+        self.realtime.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def requests_of(self, path):
+        return [headers for request_path, headers, _ in self.server.requests if request_path == path]
+
+    def test_fetches_concurrently(self):
+        # a sequential fetcher would never release the barrier
+        self.server.barrier = threading.Barrier(3, timeout=5)
+        self.assertEqual(self.realtime.update_all(), {name: True for name in Realtime.FEEDS})
+        self.assertEqual(self.realtime.get_delay('T', 1), 60)
+
+        for name in Realtime.FEEDS:
+            metrics = self.realtime.metrics[name]
+            self.assertEqual(metrics['status'], 200)
+            self.assertGreaterEqual(metrics['fetch_s'], 0)
+            self.assertGreaterEqual(metrics['parse_s'], 0)
+            self.assertEqual(metrics['entities'], (1, 0, 0))
+
+    def test_unchanged_feeds_are_not_parsed(self):
+        self.realtime.update_all()
+        snapshots = dict(self.realtime.snapshots)
+
+        self.assertEqual(self.realtime.update_all(), {name: False for name in Realtime.FEEDS})
+        for name in Realtime.FEEDS:
+            self.assertIs(self.realtime.snapshots[name], snapshots[name])
+            self.assertEqual(self.realtime.metrics[name]['status'], 304)
+            self.assertEqual(self.realtime.metrics[name]['parse_s'], 0.0)
+
+        # ETag when the server sends one, Last-Modified otherwise
+        self.assertEqual(self.requests_of('/trips.pb')[-1].get('If-None-Match'), '"t1"')
+        self.assertNotIn('If-Modified-Since', self.requests_of('/trips.pb')[-1])
+        self.assertEqual(self.requests_of('/alerts.pb')[-1].get('If-Modified-Since'), 'Mon, 01 Jan 2024 00:00:00 GMT')
+        self.assertNotIn('If-None-Match', self.requests_of('/alerts.pb')[-1])
+        self.assertEqual(self.requests_of('/vehicles.pb')[-1].get('If-None-Match'), '"v1"')
+
+    def test_changed_feed_is_parsed(self):
+        self.realtime.update_all()
+        self.server.feeds['/trips.pb'] = (feed_bytes('T', 120), '"t2"', None)
+
+        self.assertTrue(self.realtime.update_feed('trip_updates'))
+        self.assertEqual(self.realtime.get_delay('T', 1), 120)
+        self.assertEqual(self.realtime.metrics['trip_updates']['entities'], (0, 1, 0))
+        self.assertEqual(self.realtime.validators['trip_updates']['etag'], '"t2"')
+
+    def test_connections_are_kept_alive(self):
+        for _ in range(4):
+            self.realtime.update_all()
+        ports = {port for _, _, port in self.server.requests}
+        self.assertEqual(len(self.server.requests), 12)
+        # at most one connection per concurrent fetch, not one per request
+        self.assertLessEqual(len(ports), len(Realtime.FEEDS))
+
+    def test_poller(self):
+        self.realtime.start({name: 0.05 for name in Realtime.FEEDS})
+        self.assertTrue(self.realtime.wait(5))
+        self.realtime.stop()
+        self.assertEqual(self.realtime.get_delay('T', 1), 60)
+        self.assertEqual(self.realtime.pollers, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
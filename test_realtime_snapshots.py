@@ -0,0 +1,197 @@
+'''
+checks that FeedSnapshots diffed against the previous snapshot of a feed answer every
+query like a snapshot built from scratch out of the same feed state
+
+run with: python -m pytest test_realtime_snapshots.py, or python test_realtime_snapshots.py
+'''
+import random
+import unittest
+
+from google.transit import gtfs_realtime_pb2
+
+from realtime import FeedSnapshot
+
+
+def trip_update(message, entity_id, trip_id, delays):
+    '''
+    adds a trip update entity with {stop_sequence: arrival delay} to a FeedMessage
+    '''
+    entity = message.entity.add(id=entity_id)
+    entity.trip_update.trip.trip_id = trip_id
+    for stop_sequence, delay in sorted(delays.items()):
+        update = entity.trip_update.stop_time_update.add(stop_sequence=stop_sequence, stop_id=f'stop{stop_sequence}')
+        update.arrival.delay = delay
+    return entity
+
+
+def vehicle(message, entity_id, trip_id, latitude):
+    entity = message.entity.add(id=entity_id)
+    entity.vehicle.trip.trip_id = trip_id
+    entity.vehicle.position.latitude = latitude
+    entity.vehicle.position.longitude = -123.4
+    return entity
+
+
+def feed(*entities, differential=False, timestamp=1):
+    '''
+    entities: (kind, entity id, trip_id, payload), kind 'trip', 'vehicle' or 'deleted'
+    '''
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = '2.0'
+    message.header.timestamp = timestamp
+    if differential:
+        message.header.incrementality = gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+    for kind, entity_id, trip_id, payload in entities:
+        if kind == 'trip':
+            trip_update(message, entity_id, trip_id, payload)
+        elif kind == 'vehicle':
+            vehicle(message, entity_id, trip_id, payload)
+        else:
+            message.entity.add(id=entity_id, is_deleted=True)
+    return message
+
+
+class FeedSnapshotTest(unittest.TestCase):
+
+    TRIPS = [f'trip{number}' for number in range(6)]
+    STOP_SEQUENCES = range(1, 6)
+
+    def assert_same_state(self, diffed, rebuilt):
+        '''
+        asserts that two snapshots hold the same entities and answer the same queries
+        '''
+        self.assertEqual(set(diffed.entities), set(rebuilt.entities))
+        for entity_id, (_, raw, digest) in rebuilt.entities.items():
+            self.assertEqual(diffed.entities[entity_id][1:], (raw, digest), entity_id)
+
+        self.assertEqual(set(diffed.trips), set(rebuilt.trips))
+        for trip_id, trip in rebuilt.trips.items():
+            other = diffed.trips[trip_id]
+            self.assertEqual(sorted(other.entity_ids), sorted(trip.entity_ids), trip_id)
+            self.assertEqual(other.stop_times, trip.stop_times, trip_id)
+            self.assertEqual(other.sequences, trip.sequences, trip_id)
+
+        for trip_id in self.TRIPS:
+            for stop_sequence in self.STOP_SEQUENCES:
+                self.assertEqual(diffed.get_delay(trip_id, stop_sequence), rebuilt.get_delay(trip_id, stop_sequence), (trip_id, stop_sequence))
+                stop_id = f'stop{stop_sequence}'
+                self.assertEqual(diffed.get_stop_time_update(trip_id, stop_id), rebuilt.get_stop_time_update(trip_id, stop_id), (trip_id, stop_id))
+
+        self.assertEqual(diffed.trip_data.keys(), rebuilt.trip_data.keys())
+        self.assertEqual(diffed.vehicle_data.keys(), rebuilt.vehicle_data.keys())
+        self.assertEqual(
+            sorted(entity.SerializeToString() for entity in diffed.message.entity),
+            sorted(entity.SerializeToString() for entity in rebuilt.message.entity),
+        )
+
+    def test_repeated_entity_id(self):
+        # the feed repeats e1, only its first entity (on trip A) is kept and trip C loses e1
+        first = FeedSnapshot.from_message(feed(('trip', 'e1', 'C', {1: 10})))
+        second = FeedSnapshot.from_message(feed(('trip', 'e1', 'A', {1: 20}), ('trip', 'e1', 'B', {1: 30})), previous=first)
+        self.assertEqual(set(second.trips), {'A'})
+        self.assertEqual(second.get_delay('A', 1), 20)
+        self.assertIsNone(second.get_delay('C', 1))
+
+        third = FeedSnapshot.from_message(feed(('trip', 'e2', 'D', {1: 5})), previous=second)
+        self.assertEqual(set(third.trips), {'D'})
+        self.assertIsNone(third.get_delay('C', 1))
+        self.assertEqual(set(third.trip_data), {'D'})
+
+        for snapshot, message in (
+            (second, feed(('trip', 'e1', 'A', {1: 20}), ('trip', 'e1', 'B', {1: 30}))),
+            (third, feed(('trip', 'e2', 'D', {1: 5}))),
+        ):
+            self.assert_same_state(snapshot, FeedSnapshot.from_message(message))
+
+    def test_repeated_deleted_entity_id(self):
+        first = FeedSnapshot.from_message(feed(('trip', 'e1', 'C', {1: 10})))
+        # the first entity of e1 deletes it, the repeated one is ignored
+        second = FeedSnapshot.from_message(
+            feed(('deleted', 'e1', None, None), ('trip', 'e1', 'A', {1: 20}), differential=True),
+            previous=first,
+        )
+        self.assertEqual(second.entities, {})
+        self.assertEqual(second.trips, {})
+        self.assertEqual(second.removed, ['e1'])
+
+    def test_loop_trip(self):
+        # the trip visits stop1 twice, at stop_sequence 1 and 3, stop2 is only given by id
+        message = feed()
+        entity = message.entity.add(id='loop')
+        entity.trip_update.trip.trip_id = 'L'
+        for stop_sequence, stop_id, delay in ((1, 'stop1', 30), (3, 'stop1', 90), (None, 'stop2', 60)):
+            update = entity.trip_update.stop_time_update.add(stop_id=stop_id)
+            if stop_sequence is not None:
+                update.stop_sequence = stop_sequence
+            update.arrival.delay = delay
+        snapshot = FeedSnapshot.from_message(message)
+
+        self.assertEqual(snapshot.get_stop_time_update('L', 'stop1', 1)[1], 30)
+        self.assertEqual(snapshot.get_stop_time_update('L', 'stop1', 3)[1], 90)
+        self.assertEqual(snapshot.get_stop_time_update('L', 'stop1')[1], 30)
+        self.assertEqual(snapshot.get_stop_time_update('L', 'stop2', 2)[1], 60)
+        self.assertIsNone(snapshot.get_stop_time_update('L', 'stop3', 4))
+        self.assertEqual(
+            snapshot.get_delays(['L', 'L', 'L', 'L'], ['stop1', 'stop2', 'stop1', 'stop3'], [1, 2, 3, 4], [0, 0, 0, 0]),
+            [30, 60, 90, 90],
+        )
+
+    def test_parsed_cache_is_bounded(self):
+        snapshot = None
+        for timestamp in range(1, 200):
+            previous = snapshot
+            snapshot = FeedSnapshot.from_message(
+                feed(*(('trip', f'e{number}', f'trip{number}', {1: timestamp}) for number in range(10)), timestamp=timestamp),
+                previous=previous,
+            )
+            # a reader still holding the replaced snapshot parses its entities
+            if previous is not None:
+                previous.message
+            snapshot.message
+            self.assertLessEqual(len(snapshot.parsed), 3 * len(snapshot.entities) + FeedSnapshot.PARSED_SLACK)
+
+    def random_entities(self, rng):
+        '''
+        a random feed state: at most one trip update and one vehicle per trip, so that the
+        order of entities within a trip does not change the answers, and some repeated ids
+        '''
+        entities = []
+        for trip_id in rng.sample(self.TRIPS, rng.randint(0, len(self.TRIPS))):
+            if rng.random() < 0.8:
+                delays = {stop_sequence: rng.choice((-30, 0, 60, 120)) for stop_sequence in rng.sample(self.STOP_SEQUENCES, rng.randint(1, 3))}
+                entities.append(('trip', f'tu-{trip_id}', trip_id, delays))
+            if rng.random() < 0.5:
+                entities.append(('vehicle', f'vp-{trip_id}', trip_id, rng.choice((48.41, 48.42))))
+        rng.shuffle(entities)
+
+        # a repeated id, the later copies must be ignored
+        if entities and rng.random() < 0.3:
+            kind, entity_id, _, payload = rng.choice(entities)
+            entities.append((kind, entity_id, rng.choice(self.TRIPS), payload))
+        return entities
+
+    def test_full_dataset_sequences(self):
+        rng = random.Random(18)
+        for _ in range(50):
+            snapshot = None
+            for timestamp in range(1, 8):
+                message = feed(*self.random_entities(rng), timestamp=timestamp)
+                snapshot = FeedSnapshot.from_message(message, previous=snapshot)
+                self.assert_same_state(snapshot, FeedSnapshot.from_message(message))
+
+    def test_differential_sequences(self):
+        rng = random.Random(17)
+        for _ in range(50):
+            snapshot = FeedSnapshot.from_message(feed(*self.random_entities(rng)))
+            for timestamp in range(2, 8):
+                entities = self.random_entities(rng)
+                # delete some entities, and some that are not in the feed
+                entities += [('deleted', entity_id, None, None) for entity_id in rng.sample(sorted(snapshot.entities), min(2, len(snapshot.entities)))]
+                entities.append(('deleted', 'unknown', None, None))
+                snapshot = FeedSnapshot.from_message(feed(*entities, differential=True, timestamp=timestamp), previous=snapshot)
+                # the assembled FULL_DATASET message describes the same state
+                self.assert_same_state(snapshot, FeedSnapshot.from_message(snapshot.message))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+'''
+checks the conditional and resumable static feed download of GTFS.fetch_static_gtfs
+against a local http.server that honors ETag, If-None-Match, Range and If-Range
+
+run with: python -m pytest test_static_download.py, or python test_static_download.py
+'''
+import io
+import os
+import csv
+import zipfile
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import test_query_plans
+from gtfs import GTFS
+
+
+AGENCY = 'test'
+CITY = 'town'
+
+
+def feed_zip(headsign='Downtown'):
+    '''
+    returns the bytes of a zip of test_query_plans.FEED, with every trip_headsign set to headsign
+    '''
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for file_name, (header, rows) in test_query_plans.FEED.items():
+            if file_name == 'trips.txt':
+                rows = [row[:3] + [headsign] + row[4:] for row in rows]
+            text = io.StringIO()
+            writer = csv.writer(text)
+            writer.writerow(header)
+            writer.writerows(rows)
+            archive.writestr(file_name, text.getvalue())
+    return buffer.getvalue()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    '''
+    serves server.body with server.etag, records the headers of every request in
+    server.requests and ends the next response after server.truncate bytes when set
+    '''
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body, etag = server.body, server.etag
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = 0
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') in (None, etag):
+            start = int(range_header[len('bytes='):-1])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        self.end_headers()
+
+        payload = body[start:]
+        if server.truncate is not None:
+            # a dropped connection, the body ends before Content-Length
+            payload = payload[:server.truncate]
+            server.truncate = None
+            self.close_connection = True
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StaticDownloadTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        cls.server.body = feed_zip()
+        cls.server.etag = '"v1"'
+        cls.server.truncate = None
+        cls.server.requests = []
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/gtfs.zip'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        # GTFS keeps its feed and database relative to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+
+        self.server.body = feed_zip()
+        self.server.etag = '"v1"'
+        self.server.truncate = None
+        self.gtfs = GTFS(AGENCY, CITY, url=self.url)
+        self.gtfs.DOWNLOAD_BACKOFF = 0
+        self.server.requests.clear()
+
+    def tearDown(self):
+        self.gtfs.close()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def zip_bytes(self):
+        with open(self.gtfs.zip_path(), 'rb') as file:
+            return file.read()
+
+    def test_first_download_builds_database(self):
+        self.assertEqual(self.zip_bytes(), self.server.body)
+        self.assertEqual(self.gtfs.read_validators(self.gtfs.zip_path())['etag'], '"v1"')
+        self.assertEqual(self.gtfs.get_incoming_buses('101', '20240102', '08:00:00')[0][2], 'Downtown')
+
+    def test_not_modified_skips_rebuild(self):
+        db_mtime = os.stat(self.gtfs.db_path).st_mtime_ns
+
+        self.assertFalse(self.gtfs.refresh(self.url))
+        self.assertEqual(self.server.requests[-1].get('If-None-Match'), '"v1"')
+        self.assertEqual(os.stat(self.gtfs.db_path).st_mtime_ns, db_mtime)
+
+    def test_changed_feed_rebuilds(self):
+        self.server.body = feed_zip('Uptown')
+        self.server.etag = '"v2"'
+
+        self.assertTrue(self.gtfs.refresh(self.url))
+        self.assertEqual(self.zip_bytes(), self.server.body)
+        self.assertEqual(self.gtfs.get_incoming_buses('101', '20240102', '08:00:00')[0][2], 'Uptown')
+
+    def test_dropped_connection_resumes(self):
+        self.server.body = feed_zip('Uptown')
+        self.server.etag = '"v2"'
+        self.server.truncate = len(self.server.body) // 2
+
+        self.assertTrue(self.gtfs.fetch_static_gtfs(self.url))
+        first, second = self.server.requests
+        self.assertNotIn('Range', first)
+        self.assertEqual(second['Range'], f'bytes={len(self.server.body) // 2}-')
+        self.assertEqual(second['If-Range'], '"v2"')
+        self.assertEqual(self.zip_bytes(), self.server.body)
+        self.assertFalse(os.path.exists(self.gtfs.zip_path() + '.part'))
+
+    def test_changed_while_resuming_restarts(self):
+        # the download of v2 drops, then the feed changes to v3 before the retry
+        self.server.body = feed_zip('Uptown')
+        self.server.etag = '"v2"'
+        self.server.truncate = len(self.server.body) // 2
+        with self.assertRaises(OSError):
+            self.gtfs.fetch_static_gtfs(self.url, retries=0)
+
+        self.server.body = feed_zip('Midtown')
+        self.server.etag = '"v3"'
+        self.assertTrue(self.gtfs.fetch_static_gtfs(self.url))
+        self.assertEqual(self.server.requests[-1]['If-Range'], '"v2"')
+        self.assertEqual(self.zip_bytes(), self.server.body)
+
+    def test_complete_part_file_restarts(self):
+        # a .part file as long as the feed, the server answers 416 to its Range
+        part_path = self.gtfs.zip_path() + '.part'
+        self.server.body = feed_zip('Uptown')
+        self.server.etag = '"v2"'
+        with open(part_path, 'wb') as file:
+            file.write(b'\0' * len(self.server.body))
+        self.gtfs.write_validators(part_path, self.url, {'ETag': '"v2"'})
+
+        self.assertTrue(self.gtfs.fetch_static_gtfs(self.url))
+        self.assertEqual(self.zip_bytes(), self.server.body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,15 @@
-from gtfs import GTFS
+from gtfs import GTFS, time_to_seconds
 import time
-import datetime
 # IOS only module
 import location
 from realtime import Realtime
 
 victoria = GTFS('bctransit', 'victoria', update_db=False)
 
+# realtime feeds polled in the background, the functions below only read the latest snapshot
+realtime = Realtime('bctransit', 'victoria')
+realtime.start()
+
 # get current location coordinates from the IOS location module
 def get_location():
     location.start_updates()
@@ -16,31 +19,26 @@ def get_location():
         return {'lat': loc['latitude'], 'lon': loc['longitude']}
 
 def get_vehicle():
-    rt = Realtime('bctransit','victoria')
-    rt.update_vehicle_data()
-    vehicle = rt.get_vehicle_data()
+    vehicle = realtime.get_vehicle_data()
     
     return vehicle
 
-def get_trip():
-    rt = Realtime('bctransit', 'victoria')
-    rt.update_trip_data()
-    trip = rt.get_trip_data()
-    
-    return trip
-
 
 def print_nearby_stops_and_buses():
     loc = get_location()
     nearby = victoria.get_nearby_bus_stops(loc['lon'], loc['lat'], radius_km=1, limit=9)
        
-    # realtime vehicle position and trip update data
+    # realtime vehicle position and trip update data, once the first fetch is in
+    realtime.wait(timeout=10)
     vehicle = get_vehicle()
-    trip = get_trip()
+    
+    # departure board of every nearby stop in one query, with the realtime predictions
+    # merged in and sorted by predicted arrival
+    departures = victoria.get_departures([stop[0] for stop in nearby], realtime, count=5)
        
     for stop in nearby:
         print(f'[{stop[0]}] {stop[1]} ({stop[4]*1000:.0f}m)')
-        incoming = victoria.get_incoming_buses(stop[0], count=5)    
+        incoming = departures[stop[0]]
         for bus in incoming:
             print(f'[{bus[1][:-4]}]', end='')
             
@@ -49,29 +47,11 @@ def print_nearby_stops_and_buses():
             	
             print(f' {bus[0][:-3]}', end='')
             
-            if bus[3] in trip:
-                for trip_stops in trip[bus[3]]:
-                    got_time = False
-                    for trip_stop in trip_stops:
-                        if stop[0] == trip_stop.stop_id and trip_stop.arrival.delay > 0:
-                            # get arrival time in epoch
-                            epoch_time = trip_stop.arrival.time
-                            
-                            # convert epoch to HH:MM time
-                            time_from_epoch = datetime.datetime.fromtimestamp(epoch_time).strftime('%H:%M')
-                            
-                            if time_from_epoch == bus[0][:-3]:
-                            	break
-                            
-                            print(f' → {time_from_epoch}',end='')
-                            got_time = True
-                            break
-                        elif stop[0] == trip_stop.stop_id:
-                            print(f'        ',end='')
-                            got_time = True
-                            break
-                    if not got_time:
-                        print(f'        ',end='')
+            # predicted arrival when the trip updates move it to another minute, compared
+            # in seconds as the feed may not zero-pad the hours of the scheduled time
+            scheduled = time_to_seconds(bus[0])
+            if bus[5] is not None and (scheduled + bus[5]) // 60 != scheduled // 60:
+                print(f' → {bus[4][:-3]}',end='')
             else:
                 print(f'        ',end='')
 